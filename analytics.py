@@ -0,0 +1,327 @@
+""" Rolling occupancy, dwell time and revenue metrics of a ParkingLotController, kept up to date as cars come and go
+instead of computed from the tickets table on demand.
+
+Time is cut into buckets of bucket_seconds. For every lot group, every size class and the whole garage there is a
+ring of the last bucket_count buckets, and each bucket holds what happened in its stretch of time: cars parked,
+cars returned, their summed dwell time and what they paid, and the occupancy seconds (the number of parked cars
+integrated over time). A park, return or relocation adds to the current bucket of a few rings, and a window query
+adds up the buckets of the window, so neither costs more when there is more traffic. Memory is bucket_count
+buckets per ring, however long the process runs.
+
+    analytics = RollingAnalytics(bucket_seconds=300, bucket_count=288)      # a day of 5 minute buckets
+    analytics.attach(pc)
+    ...
+    print analytics.get_metrics(3600)                                       # last hour, whole garage
+    print analytics.get_metrics(86400, size_class=LotSize.LARGE)            # last day, large lot groups
+    print analytics.get_metrics(3600, lot_group_index=2)
+
+A returned car counts, with its whole dwell time and cost, for the lot group it left from. Windows are rounded up
+to whole buckets and never reach further back than bucket_count buckets or than attach().
+"""
+
+import math
+from array import array
+
+
+class _Ring(object):
+    """ The buckets of one lot group, one size class or the whole garage. Bucket i holds the bucket numbers
+    (time // bucket_seconds) that are i modulo the bucket count. """
+
+    __slots__ = ('epoch', 'cars', 'parks', 'returns', 'dwell', 'revenue', 'occupancy')
+
+    def __init__(self, bucket_count, epoch, cars):
+        # bucket number of the current bucket, and the number of cars parked right now.
+        self.epoch = epoch
+        self.cars = cars
+
+        self.parks = array('l', [0]) * bucket_count
+        self.returns = array('l', [0]) * bucket_count
+        self.dwell = array('d', [0.0]) * bucket_count
+        self.revenue = array('d', [0.0]) * bucket_count
+
+        # occupancy seconds of every bucket, counted up to the end of the bucket as if the cars parked right now
+        # stayed that long. every change corrects it for the rest of the current bucket.
+        self.occupancy = array('d', [0.0]) * bucket_count
+
+
+class RollingAnalytics(object):
+    """ Occupancy, dwell time and revenue over sliding windows of one controller. The analytics are a controller
+    listener, so they change right along with the controller, under its index lock. """
+
+    def __init__(self, bucket_seconds=300, bucket_count=288):
+        super(RollingAnalytics, self).__init__()
+
+        assert bucket_seconds > 0
+        assert bucket_count > 0
+
+        self._bucket_seconds = bucket_seconds
+        self._bucket_count = bucket_count
+        self._controller = None
+        self._listening = False
+
+        # time of attach() and the latest time seen. events are sorted into buckets by that, so one that comes in
+        # with a time a little behind the one before it (another thread read the clock first) still goes into
+        # the current bucket.
+        self._start_time = None
+        self._latest = None
+
+        self._group_rings = []
+        self._size_class_rings = {}
+        self._total_ring = None
+        self._size_class_spots = {}
+        self._total_spots = 0
+        # lot group index -> the distinct rings a change to that lot group goes into.
+        self._rings_of = []
+
+        # ticket number -> (lot group index, issue time, start time in current spot, cost accrued before current
+        # spot), to work out dwell and cost on return. the ticket itself is gone by then.
+        self._tickets = {}
+
+    def get_bucket_seconds(self):
+        return self._bucket_seconds
+
+    def get_bucket_count(self):
+        return self._bucket_count
+
+    def attach(self, controller):
+        """ Start counting from the cars parked in controller right now. """
+
+        assert self._controller is None
+
+        # the controller tells listeners about a change in the same index lock critical section that updates the
+        # spot index, so a change is either in the spot index by the time _fill() reads it, and its car is part of
+        # the starting occupancy rather than a park or return in the first bucket, or it is heard afterwards. a
+        # park heard in between add_listener() and _fill() finds no rings yet and is skipped, returns and
+        # relocations are skipped anyway for tickets _fill() has not put in self._tickets.
+        self._controller = controller
+        self._listening = True
+        controller.add_listener(self)
+        with controller._index_lock:
+            self._fill(controller, controller.get_clock().get_time())
+
+    def _fill(self, controller, now):
+        """ Start over with empty buckets and the cars in the spot index of controller. Call with its index lock
+        held. """
+
+        lot_groups = controller._lot_groups
+        epoch = int(now // self._bucket_seconds)
+
+        records = dict((record[0], record[1:]) for record in
+                       controller._tickets_table.iter_ticket_records(controller._lot_group_index))
+
+        # the spot index, not the tickets table, is what listeners have been told about so far.
+        self._tickets = {}
+        for group_idx, spot_index in enumerate(controller._spot_index):
+            for ticket_no in spot_index.itervalues():
+                record = records.get(ticket_no)
+                if record is None:
+                    # returned, and the return not told yet.
+                    self._tickets[ticket_no] = (group_idx, now, now, 0.0)
+                else:
+                    self._tickets[ticket_no] = (group_idx, record[2], record[3], record[4])
+
+        self._group_rings = [_Ring(self._bucket_count, epoch, len(spot_index)) for spot_index in controller._spot_index]
+        self._size_class_rings = {}
+        self._size_class_spots = {}
+        for lot_group, ring in zip(lot_groups, self._group_rings):
+            size_class = lot_group.get_size_class()
+            if size_class not in self._size_class_rings:
+                self._size_class_rings[size_class] = _Ring(self._bucket_count, epoch, 0)
+            self._size_class_rings[size_class].cars += ring.cars
+            self._size_class_spots[size_class] = self._size_class_spots.get(size_class, 0) + \
+                lot_group.get_spot_count()
+        self._total_ring = _Ring(self._bucket_count, epoch, len(self._tickets))
+        self._total_spots = sum(lot_group.get_spot_count() for lot_group in lot_groups)
+
+        self._rings_of = [(ring, self._size_class_rings[lot_group.get_size_class()], self._total_ring)
+                          for lot_group, ring in zip(lot_groups, self._group_rings)]
+
+        slot = epoch % self._bucket_count
+        rest_of_bucket = (epoch + 1) * self._bucket_seconds - now
+        for ring in self._group_rings + self._size_class_rings.values() + [self._total_ring]:
+            ring.occupancy[slot] = ring.cars * rest_of_bucket
+
+        self._start_time = now
+        self._latest = now
+
+    def detach(self):
+        """ Stop counting. The metrics can still be read, as if nothing changed in the controller since. """
+
+        if self._listening:
+            self._controller.remove_listener(self)
+            self._listening = False
+
+    def _advance(self, ring, epoch):
+        """ Make epoch the current bucket of ring. Buckets skipped on the way had no events, so whoever was parked
+        stayed for all of them. """
+
+        if epoch <= ring.epoch:
+            return
+
+        bucket_count = self._bucket_count
+        full = ring.cars * self._bucket_seconds
+        for skipped in xrange(max(ring.epoch + 1, epoch - bucket_count + 1), epoch + 1):
+            slot = skipped % bucket_count
+            ring.parks[slot] = 0
+            ring.returns[slot] = 0
+            ring.dwell[slot] = 0.0
+            ring.revenue[slot] = 0.0
+            ring.occupancy[slot] = full
+
+        ring.epoch = epoch
+
+    def _to_bucket(self, now):
+        """ Return (time, bucket number, slot) an event at now goes into. """
+
+        if now < self._latest:
+            now = self._latest
+        else:
+            self._latest = now
+
+        epoch = int(now // self._bucket_seconds)
+        return now, epoch, epoch % self._bucket_count
+
+    def on_park(self, ticket_no, car, lot_group_index, lot_id, now):
+        if self._total_ring is None:
+            # attach() has not filled in from the spot index yet, which will count this car.
+            return
+
+        self._tickets[ticket_no] = (lot_group_index, now, now, 0.0)
+
+        now, epoch, slot = self._to_bucket(now)
+        rest_of_bucket = (epoch + 1) * self._bucket_seconds - now
+        for ring in self._rings_of[lot_group_index]:
+            self._advance(ring, epoch)
+            ring.parks[slot] += 1
+            ring.cars += 1
+            ring.occupancy[slot] += rest_of_bucket
+
+    def on_return(self, ticket_no, now):
+        record = self._tickets.pop(ticket_no, None)
+        if record is None:
+            return
+
+        group_idx, issue_time, spot_start, cost_so_far = record
+        cost = cost_so_far + self._controller._lot_groups[group_idx].get_cost_for_interval(spot_start, now)
+        dwell = now - issue_time
+
+        now, epoch, slot = self._to_bucket(now)
+        rest_of_bucket = (epoch + 1) * self._bucket_seconds - now
+        for ring in self._rings_of[group_idx]:
+            self._advance(ring, epoch)
+            ring.returns[slot] += 1
+            ring.dwell[slot] += dwell
+            ring.revenue[slot] += cost
+            ring.cars -= 1
+            ring.occupancy[slot] -= rest_of_bucket
+
+    def on_relocate(self, ticket_no, lot_group_index, lot_id, now):
+        record = self._tickets.get(ticket_no)
+        if record is None:
+            return
+
+        group_idx, issue_time, spot_start, cost_so_far = record
+        cost_so_far += self._controller._lot_groups[group_idx].get_cost_for_interval(spot_start, now)
+        self._tickets[ticket_no] = (lot_group_index, issue_time, now, cost_so_far)
+
+        if group_idx == lot_group_index:
+            return
+
+        # only the rings the car left or entered change, not the ones both lot groups count towards.
+        now, epoch, slot = self._to_bucket(now)
+        rest_of_bucket = (epoch + 1) * self._bucket_seconds - now
+        old_rings = self._rings_of[group_idx]
+        new_rings = self._rings_of[lot_group_index]
+        for ring, delta in [(ring, -1) for ring in old_rings if ring not in new_rings] + \
+                           [(ring, 1) for ring in new_rings if ring not in old_rings]:
+            self._advance(ring, epoch)
+            ring.cars += delta
+            ring.occupancy[slot] += delta * rest_of_bucket
+
+    def _sum_window(self, column, first_slot, last_slot):
+        if first_slot <= last_slot:
+            return sum(column[first_slot:last_slot + 1])
+
+        return sum(column[first_slot:]) + sum(column[:last_slot + 1])
+
+    def _summarize(self, ring, spots, window, now):
+        """ Return the metrics dict of ring over the window seconds up to now, see get_metrics(). Call with the
+        index lock held. """
+
+        now, epoch, last_slot = self._to_bucket(now)
+        self._advance(ring, epoch)
+
+        bucket_seconds = self._bucket_seconds
+        buckets = min(self._bucket_count, int(math.ceil(window / float(bucket_seconds))))
+        first_slot = (epoch - buckets + 1) % self._bucket_count
+        start = max((epoch - buckets + 1) * bucket_seconds, self._start_time)
+
+        # the current bucket counts its cars up to the end of the bucket, which has not come yet.
+        occupancy = self._sum_window(ring.occupancy, first_slot, last_slot) - \
+            ring.cars * ((epoch + 1) * bucket_seconds - now)
+        seconds = now - start
+        average_occupancy = (occupancy / seconds) if seconds > 0 else float(ring.cars)
+
+        returns = self._sum_window(ring.returns, first_slot, last_slot)
+        dwell = self._sum_window(ring.dwell, first_slot, last_slot)
+
+        return {'start': start, 'end': now, 'spots': spots, 'cars': ring.cars,
+                'parks': self._sum_window(ring.parks, first_slot, last_slot), 'returns': returns,
+                'revenue': self._sum_window(ring.revenue, first_slot, last_slot),
+                'average_dwell': (dwell / returns) if returns else None,
+                'average_occupancy': average_occupancy,
+                'utilization': (average_occupancy / spots) if spots else 0.0}
+
+    def get_metrics(self, window, lot_group_index=None, size_class=None, now=None):
+        """ Return the metrics of the last window seconds, up to now or the current time of the controller, for the
+        lot group at lot_group_index, for the lot groups of size_class, or by default for the whole garage. The
+        result is a dict with:
+            'start', 'end': the stretch of time the metrics are for, window rounded up to whole buckets.
+            'spots': number of spots.
+            'cars': number of cars parked at the end.
+            'parks', 'returns': number of cars parked and returned.
+            'revenue': what the returned cars paid.
+            'average_dwell': mean seconds the returned cars were parked, None if there were no returns.
+            'average_occupancy': mean number of parked cars over time.
+            'utilization': average_occupancy as a fraction of the spots. """
+
+        assert window > 0
+        assert lot_group_index is None or size_class is None
+
+        controller = self._controller
+        if now is None:
+            now = controller.get_clock().get_time()
+
+        with controller._index_lock:
+            if lot_group_index is not None:
+                ring = self._group_rings[lot_group_index]
+                spots = controller._lot_groups[lot_group_index].get_spot_count()
+            elif size_class is not None:
+                ring = self._size_class_rings[size_class]
+                spots = self._size_class_spots[size_class]
+            else:
+                ring = self._total_ring
+                spots = self._total_spots
+
+            return self._summarize(ring, spots, window, now)
+
+    def get_all_metrics(self, window, now=None):
+        """ Return the metrics of get_metrics() for everything at once and for the same time, as a dict with:
+            'total': the whole garage.
+            'by_lot_group': list of metrics, parallel to the lot groups.
+            'by_size_class': dict of lot group size class to metrics. """
+
+        controller = self._controller
+        if now is None:
+            now = controller.get_clock().get_time()
+
+        with controller._index_lock:
+            lot_groups = controller._lot_groups
+            by_lot_group = [self._summarize(ring, lot_group.get_spot_count(), window, now)
+                            for lot_group, ring in zip(lot_groups, self._group_rings)]
+
+            by_size_class = dict((size_class, self._summarize(ring, self._size_class_spots[size_class], window, now))
+                                 for size_class, ring in self._size_class_rings.iteritems())
+            total = self._summarize(self._total_ring, self._total_spots, window, now)
+
+        return {'total': total, 'by_lot_group': by_lot_group, 'by_size_class': by_size_class}
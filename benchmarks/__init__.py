@@ -0,0 +1,2 @@
+""" Benchmarks for the parking lot controller. Run the individual modules from the repository root,
+e.g. python -m benchmarks.park_latency """
@@ -0,0 +1,58 @@
+""" Run parks and returns on a virtual clock with and without RollingAnalytics attached, then time window queries
+against the one pass over the tickets table that get_outstanding_revenue() takes, at the same lot size.
+
+usage: python -m benchmarks.analytics_windows [spots] [ops] [seconds_per_op]
+"""
+
+import sys
+import time
+
+from analytics import RollingAnalytics
+from benchmarks.suite import make_controller
+from benchmarks.util import churn
+from parkinglot import LotSize, VirtualClock
+
+
+def time_call(call, repeat):
+    """ Return the mean seconds per call of call() over repeat calls. """
+
+    t0 = time.time()
+    for _ in xrange(repeat):
+        call()
+    return (time.time() - t0) / repeat
+
+
+def main(spots=100000, ops=200000, seconds_per_op=1):
+    clock = VirtualClock(1500000000)
+    pc = make_controller(spots, compact_storage=False)
+    pc.set_clock(clock)
+    plain_rate = churn(pc, ops, seed=1, clock=clock, seconds_per_op=seconds_per_op)
+    print "%d spots, %d parks/returns: %.0f ops/sec without analytics" % (spots, ops, plain_rate)
+
+    clock = VirtualClock(1500000000)
+    pc = make_controller(spots, compact_storage=False)
+    pc.set_clock(clock)
+    analytics = RollingAnalytics()
+    analytics.attach(pc)
+    analytics_rate = churn(pc, ops, seed=1, clock=clock, seconds_per_op=seconds_per_op)
+    print "%.0f ops/sec with analytics (%.2fx), %d buckets of %d sec" % (
+        analytics_rate, analytics_rate / plain_rate, analytics.get_bucket_count(), analytics.get_bucket_seconds())
+
+    print "%-40s %12s" % ("query", "us/call")
+    for name, call, repeat in [
+            ("get_metrics(3600)", lambda: analytics.get_metrics(3600), 1000),
+            ("get_metrics(86400)", lambda: analytics.get_metrics(86400), 1000),
+            ("get_metrics(86400, size_class=LARGE)", lambda: analytics.get_metrics(86400, size_class=LotSize.LARGE),
+             1000),
+            ("get_all_metrics(86400)", lambda: analytics.get_all_metrics(86400), 100),
+            ("get_outstanding_revenue()", pc.get_outstanding_revenue, 3)]:
+        print "%-40s %12.1f" % (name, time_call(call, repeat) * 1e6)
+
+    metrics = analytics.get_metrics(3600)
+    print "last hour: %d parks, %d returns, revenue %.0f, average dwell %.0f sec, utilization %.1f%%" % (
+        metrics['parks'], metrics['returns'], metrics['revenue'], metrics['average_dwell'] or 0,
+        100.0 * metrics['utilization'])
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
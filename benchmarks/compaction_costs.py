@@ -0,0 +1,109 @@
+""" Check that compaction only ever moves a car to a spot its placement policy ranks better, so under the 'cheapest'
+placement compaction never makes parking dearer. Random parks, returns and compactions on a virtual clock run
+against lots where big spots can be cheaper than small ones, and every relocation and every returned cost is
+checked.
+
+usage: python -m benchmarks.compaction_costs [ops] [seed]
+"""
+
+import random
+import sys
+
+from benchmarks.util import SIZES
+from parkinglot import Car, LotSize, ParkingLotController, VirtualClock
+
+
+LOT_GROUPS = [(20, 1, 5), (10, 1, 2), (15, 2, 4), (10, 2, 1), (10, 3, 1), (10, 3, 6)]
+
+
+class RateChecker(object):
+    """ A controller listener that remembers the hourly rate and park time of every car and fails on a relocation
+    to a spot the placement policy does not rank better. """
+
+    def __init__(self, pc):
+        super(RateChecker, self).__init__()
+
+        self._pc = pc
+        # ticket number -> (lot group index parked in first, lot group index parked in now, park time).
+        self._parked = {}
+        self.relocations = 0
+
+    def on_park(self, ticket_no, car, lot_group_index, lot_id, now):
+        self._parked[ticket_no] = (lot_group_index, lot_group_index, now)
+
+    def on_return(self, ticket_no, now):
+        del self._parked[ticket_no]
+
+    def on_relocate(self, ticket_no, lot_group_index, lot_id, now):
+        first_index, old_index, park_time = self._parked[ticket_no]
+        keys = self._pc._placement_keys
+        assert keys[lot_group_index] < keys[old_index], "ticket %d moved from %r to %r" % (ticket_no, keys[old_index],
+                                                                                           keys[lot_group_index])
+        self._parked[ticket_no] = (first_index, lot_group_index, park_time)
+        self.relocations += 1
+
+    def max_cost(self, ticket_no, now):
+        """ Return what ticket_no would cost at time now had its car never been moved. Compaction may move a
+        car to a cheaper spot but to no dearer one, so that is the most it may cost. """
+
+        first_index, _, park_time = self._parked[ticket_no]
+        return self._pc._lot_groups[first_index].get_cost_for_interval(park_time, now)
+
+
+def check_small_car_stays_cheap():
+    """ A small car parked in a cheap large spot is not moved to a dear small spot once one frees up. """
+
+    clock = VirtualClock(start_time=1000000)
+    pc = ParkingLotController(lot_groups=[(1, LotSize.SMALL, 10), (2, LotSize.LARGE, 1)], placement='cheapest',
+                              auto_compactify=True, clock=clock)
+    blocker = pc.park_car_and_return_ticket_number(Car(plate='BLOCK', model='check', size=LotSize.SMALL))
+    ticket_no = pc.park_car_and_return_ticket_number(Car(plate='CHEAP', model='check', size=LotSize.SMALL))
+    pc.return_car_and_get_cost_for_ticket_number(blocker)
+
+    clock.advance(3600)
+    _, cost = pc.return_car_and_get_cost_for_ticket_number(ticket_no)
+    assert abs(cost - 1.0) < 1e-9, cost
+
+
+def run(placement, ops, seed):
+    rng = random.Random(seed)
+    clock = VirtualClock(start_time=1000000)
+    pc = ParkingLotController(lot_groups=LOT_GROUPS, placement=placement, clock=clock)
+    checker = RateChecker(pc)
+    pc.add_listener(checker)
+    tickets = []
+
+    for op in xrange(ops):
+        roll = rng.random()
+        if roll < 0.45 and tickets:
+            idx = rng.randrange(len(tickets))
+            tickets[idx], tickets[-1] = tickets[-1], tickets[idx]
+            ticket_no = tickets.pop()
+            max_cost = checker.max_cost(ticket_no, clock.get_time())
+            _, cost = pc.return_car_and_get_cost_for_ticket_number(ticket_no)
+            if 'cheapest' == placement:
+                assert cost <= max_cost + 1e-9, (ticket_no, cost, max_cost)
+        elif roll < 0.5:
+            pc.compactify_parking_lot()
+        else:
+            ticket_no = pc.park_car_and_return_ticket_number(Car(plate='C%d' % op, model='check',
+                                                                 size=rng.choice(SIZES)))
+            if ticket_no is not None:
+                tickets.append(ticket_no)
+
+        clock.advance(rng.randrange(600))
+
+    return checker.relocations
+
+
+def main(ops=20000, seed=1):
+    check_small_car_stays_cheap()
+    print "cheapest: a small car in a cheap large spot is not moved to a dear small spot"
+
+    for placement in ParkingLotController.PLACEMENT_POLICIES:
+        relocations = run(placement, ops, seed)
+        print "%-9s %d ops, %d relocations, every one to a better ranked spot" % (placement, ops, relocations)
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,96 @@
+""" Hammer one concurrent ParkingLotController from several threads, report park/return throughput against a
+single thread and check afterwards that no spot was ever double booked.
+
+usage: python -m benchmarks.concurrency_stress [ops_per_thread] [max_threads]
+"""
+
+import random
+import sys
+import threading
+import time
+
+from benchmarks.util import SIZES
+from parkinglot import Car, ParkingLotController
+
+
+def gate(pc, gate_no, ops, results):
+    """ Simulate one gate terminal: park and return cars at random, checking every returned car is ours. """
+
+    rng = random.Random(gate_no)
+    parked = {}
+    for op in xrange(ops):
+        if parked and (rng.random() < 0.5 or len(parked) > 200):
+            ticket_no = rng.choice(parked.keys())
+            car, cost = pc.return_car_and_get_cost_for_ticket_number(ticket_no)
+            # a double booked spot would hand back some other gate's car.
+            assert car is parked.pop(ticket_no), "ticket %d returned the wrong car" % ticket_no
+        else:
+            car = Car(plate='G%d-%d' % (gate_no, op), model='stress', size=rng.choice(SIZES))
+            ticket_no = pc.park_car_and_return_ticket_number(car)
+            if ticket_no is not None:
+                assert ticket_no not in parked
+                parked[ticket_no] = car
+
+        if 0 == op % 500:
+            pc.compactify_parking_lot()
+
+    results[gate_no] = parked
+
+
+def check_no_double_booking(pc, parked_by_gate):
+    """ Check every parked car is in exactly one spot and every spot holds at most the car of its ticket. """
+
+    all_parked = {}
+    for parked in parked_by_gate.itervalues():
+        all_parked.update(parked)
+
+    assert len(all_parked) == len(pc._tickets_table)
+
+    seen_spots = set()
+    for ticket_no, car in all_parked.iteritems():
+        lot_group, lot_id = pc._tickets_table[ticket_no].get_current_car_spot()
+        spot = (id(lot_group), lot_id)
+        assert spot not in seen_spots, "spot %r is booked twice" % (spot,)
+        seen_spots.add(spot)
+        assert lot_group.get_car(lot_id) is car
+        assert pc.get_ticket_for_spot(pc._lot_group_index[lot_group], lot_id) == ticket_no
+
+    assert sum(lot_group.get_car_count() for lot_group in pc._lot_groups) == len(all_parked)
+
+
+def run(thread_count, ops_per_thread, concurrent):
+    pc = ParkingLotController(small_count=300, small_rate=1, medium_count=300, medium_rate=2, large_count=300,
+                              large_rate=3, auto_compactify=True, concurrent=concurrent)
+
+    results = {}
+    threads = [threading.Thread(target=gate, args=(pc, gate_no, ops_per_thread, results))
+               for gate_no in xrange(thread_count)]
+
+    t0 = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - t0
+
+    assert len(results) == thread_count, "a gate thread failed"
+    check_no_double_booking(pc, results)
+    return (thread_count * ops_per_thread) / elapsed
+
+
+def main(ops_per_thread=20000, max_threads=8):
+    baseline = run(1, ops_per_thread, concurrent=False)
+    print "%8s %14s %10s" % ("threads", "ops/sec", "vs 1 thread")
+    print "%8s %14.0f %10.2f" % ("1 (off)", baseline, 1.0)
+
+    thread_count = 1
+    while thread_count <= max_threads:
+        ops_per_sec = run(thread_count, ops_per_thread, concurrent=True)
+        print "%8d %14.0f %10.2f" % (thread_count, ops_per_sec, ops_per_sec / baseline)
+        thread_count *= 2
+
+    print "no spot was double booked"
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
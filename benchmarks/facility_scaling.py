@@ -0,0 +1,67 @@
+""" Measure how FacilityRouter throughput scales with the number of worker processes.
+
+Every round submits a batch of park and return requests spread over all facilities and flushes it.
+usage: python -m benchmarks.facility_scaling [facility_count] [requests_per_round] [rounds]
+"""
+
+import multiprocessing
+import random
+import sys
+import time
+
+from benchmarks.util import SIZES
+from facilities import FacilityRouter
+
+
+def make_facilities(facility_count):
+    controller_kwargs = dict(small_count=2000, small_rate=1, medium_count=2000, medium_rate=2, large_count=2000,
+                             large_rate=3)
+    return [('facility-%d' % idx, (idx % 10, idx // 10), controller_kwargs) for idx in xrange(facility_count)]
+
+
+def run(worker_count, facility_count, requests_per_round, rounds):
+    """ Return the requests/sec of FacilityRouter with worker_count workers. """
+
+    rng = random.Random(5)
+    router = FacilityRouter(make_facilities(facility_count), worker_count=worker_count)
+    facility_ids = sorted(router.get_facility_ids())
+    tickets = dict((facility_id, []) for facility_id in facility_ids)
+
+    t0 = time.time()
+    for round_no in xrange(rounds):
+        submitted = []
+        for request_no in xrange(requests_per_round):
+            facility_id = facility_ids[request_no % len(facility_ids)]
+            if tickets[facility_id] and rng.random() < 0.5:
+                router.submit(facility_id, 'return', tickets[facility_id].pop())
+                submitted.append(None)
+            else:
+                router.submit(facility_id, 'park', 'R%d-%d' % (round_no, request_no), 'bench', rng.choice(SIZES))
+                submitted.append(facility_id)
+
+        for facility_id, result in zip(submitted, router.flush()):
+            if facility_id is not None and result is not None:
+                tickets[facility_id].append(result)
+
+    elapsed = time.time() - t0
+    router.close()
+
+    return (requests_per_round * rounds) / elapsed
+
+
+def main(facility_count=32, requests_per_round=20000, rounds=10):
+    print "%d facilities, %d requests per batch, %d cores" % (facility_count, requests_per_round,
+                                                             multiprocessing.cpu_count())
+    print "%8s %14s %10s" % ("workers", "requests/sec", "speedup")
+
+    baseline = None
+    worker_count = 1
+    while worker_count <= min(multiprocessing.cpu_count(), facility_count):
+        requests_per_sec = run(worker_count, facility_count, requests_per_round, rounds)
+        baseline = baseline or requests_per_sec
+        print "%8d %14.0f %10.2f" % (worker_count, requests_per_sec, requests_per_sec / baseline)
+        worker_count *= 2
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
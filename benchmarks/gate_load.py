@@ -0,0 +1,104 @@
+""" Load generator for the gate server. Starts a GateServer in a child process, opens many simulated gate
+connections that each keep a window of pipelined requests in flight, and reports requests/sec and latency
+percentiles.
+
+usage: python -m benchmarks.gate_load [gate_count] [requests_per_gate] [window]
+"""
+
+import asyncore
+import multiprocessing
+import random
+import sys
+import time
+
+from benchmarks.util import percentile
+from gateserver import AsyncGateClient, GateServer
+from parkinglot import LotSize, ParkingLotController
+
+
+def serve(spots_per_group, port_pipe):
+    """ Run a gate server for a fresh controller, and send the port it listens on back through port_pipe. """
+
+    pc = ParkingLotController(small_count=spots_per_group, small_rate=1, medium_count=spots_per_group, medium_rate=2,
+                              large_count=spots_per_group, large_rate=3)
+    server = GateServer(pc, host='127.0.0.1', port=0)
+    port_pipe.send(server.get_port())
+    server.serve_forever()
+
+
+class SimulatedGate(object):
+    """ One gate terminal: keeps window requests in flight until it has sent its share of requests. """
+
+    def __init__(self, gate_no, port, channel_map, request_count, window, latencies):
+        super(SimulatedGate, self).__init__()
+
+        self._rng = random.Random(gate_no)
+        self._gate_no = gate_no
+        self._client = AsyncGateClient('127.0.0.1', port, channel_map=channel_map)
+        self._left_to_send = request_count
+        self._latencies = latencies
+
+        # tickets this gate got back and has not returned yet.
+        self._tickets = []
+
+        for _ in xrange(min(window, request_count)):
+            self._send_next()
+
+    def _send_next(self):
+        self._left_to_send -= 1
+        sent_at = time.time()
+
+        def on_response(result):
+            self._latencies.append(time.time() - sent_at)
+            self._on_result(kind, result)
+
+            if self._left_to_send > 0:
+                self._send_next()
+            elif 0 == self._client.get_in_flight_count():
+                self._client.close()
+
+        roll = self._rng.random()
+        if self._tickets and roll < 0.45:
+            kind = 'RETURN'
+            self._client.request(on_response, 'RETURN', self._tickets.pop(self._rng.randrange(len(self._tickets))))
+        elif self._tickets and roll < 0.55:
+            kind = 'COST'
+            self._client.request(on_response, 'COST', self._rng.choice(self._tickets))
+        else:
+            kind = 'PARK'
+            size = self._rng.choice([LotSize.SMALL, LotSize.MEDIUM, LotSize.LARGE])
+            self._client.request(on_response, 'PARK', 'G%d %d' % (self._gate_no, self._left_to_send), 'load', size)
+
+    def _on_result(self, kind, result):
+        if 'PARK' == kind and result is not None and not isinstance(result, ValueError):
+            self._tickets.append(result)
+
+
+def main(gate_count=200, requests_per_gate=500, window=16):
+    port_pipe, child_pipe = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(10000, child_pipe))
+    server.daemon = True
+    server.start()
+    port = port_pipe.recv()
+
+    channel_map = {}
+    latencies = []
+    gates = [SimulatedGate(gate_no, port, channel_map, requests_per_gate, window, latencies)
+             for gate_no in xrange(gate_count)]
+
+    t0 = time.time()
+    asyncore.loop(timeout=1.0, use_poll=True, map=channel_map)
+    elapsed = time.time() - t0
+
+    server.terminate()
+
+    latencies.sort()
+    print "%d gates, %d requests each, %d in flight per gate" % (len(gates), requests_per_gate, window)
+    print "requests/sec: %.0f" % (len(latencies) / elapsed)
+    print "latency p50: %.2f ms  p99: %.2f ms  max: %.2f ms" % (percentile(latencies, 50) * 1e3,
+                                                               percentile(latencies, 99) * 1e3,
+                                                               latencies[-1] * 1e3)
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,117 @@
+""" Drive a saturated garage on a virtual clock two ways: gates that retry a turned away car every few seconds, and
+gates that put it on the controller's waitlist instead. Drivers give up after the same patience either way. Print
+the park calls each way took, how long it ran and how many cars got in after how long a wait.
+
+usage: python -m benchmarks.gate_waitlist [spots] [hours] [demand_percent] [retry_seconds] [patience_minutes]
+"""
+
+import sys
+import time
+
+from benchmarks.suite import make_controller
+from benchmarks.trace import TraceGenerator
+from parkinglot import Car
+from simulation import Simulation
+
+
+class GateTraffic(object):
+    """ Arrivals that get a spot, retry or wait on a Simulation. Counts park calls and waits. """
+
+    def __init__(self, sim, controller, mode, retry_seconds, patience):
+        super(GateTraffic, self).__init__()
+
+        assert mode in ('retry', 'waitlist')
+
+        self._sim = sim
+        self._controller = controller
+        self._mode = mode
+        self._retry_seconds = retry_seconds
+        self._patience = patience
+
+        self.park_calls = 0
+        self.parked = 0
+        self.parked_after_wait = 0
+        self.gave_up = 0
+        self.total_wait = 0.0
+
+    def arrive(self, car, dwell, arrived=None):
+        """ Try to park car, which first arrived at time arrived or just now, for dwell seconds. """
+
+        now = self._sim.get_time()
+        if arrived is None:
+            arrived = now
+
+        self.park_calls += 1
+        ticket_no = self._controller.park_car_and_return_ticket_number(car)
+        if ticket_no is not None:
+            self._parked(ticket_no, dwell, now - arrived)
+        elif now - arrived + self._retry_seconds > self._patience:
+            self.gave_up += 1
+        elif 'retry' == self._mode:
+            self._sim.schedule(now + self._retry_seconds, self.arrive, car, dwell, arrived)
+        else:
+            wait_id = self._controller.join_waitlist(
+                car, lambda ticket_no, car: self._parked(ticket_no, dwell, self._sim.get_time() - arrived))
+            self._sim.schedule(now + self._patience, self._give_up, wait_id)
+
+    def _give_up(self, wait_id):
+        if self._controller.leave_waitlist(wait_id):
+            self.gave_up += 1
+
+    def _parked(self, ticket_no, dwell, waited):
+        self.parked += 1
+        if waited:
+            self.parked_after_wait += 1
+            self.total_wait += waited
+        self._sim.schedule(self._sim.get_time() + dwell, self._controller.return_car_and_get_cost_for_ticket_number,
+                           ticket_no)
+
+
+def iter_arrivals(generator, sim, traffic):
+    """ Schedule the arrivals of generator on sim one at a time, so the event heap stays small. """
+
+    arrivals = generator.iter_arrivals()
+
+    def schedule_next():
+        for arrival_time, car_no, size, dwell in arrivals:
+            sim.schedule(arrival_time, arrive, Car(plate='W %d' % car_no, model='sim', size=size), dwell)
+            return
+
+    def arrive(car, dwell):
+        traffic.arrive(car, dwell)
+        schedule_next()
+
+    schedule_next()
+
+
+def run(mode, spots, hours, demand_percent, retry_seconds, patience):
+    mean_dwell = 3600.0
+    arrival_rate = TraceGenerator.arrival_rate_for_occupancy(spots, demand_percent / 100.0, mean_dwell)
+    generator = TraceGenerator(seed=3, arrival_rate=arrival_rate, mean_dwell=mean_dwell)
+
+    pc = make_controller(spots, compact_storage=False)
+    sim = Simulation(pc)
+    traffic = GateTraffic(sim, pc, mode, retry_seconds, patience)
+    iter_arrivals(generator, sim, traffic)
+
+    t0 = time.time()
+    sim.run(until=hours * 3600)
+    elapsed = time.time() - t0
+
+    print "%-9s %12d %10.2f %10d %12d %10d %12.0f" % (
+        mode, traffic.park_calls, elapsed, traffic.parked, traffic.parked_after_wait, traffic.gave_up,
+        traffic.total_wait / max(1, traffic.parked_after_wait))
+
+
+def main(spots=5000, hours=24, demand_percent=120, retry_seconds=5, patience_minutes=20):
+    print "%d spots, %d hours, demand %d%% of capacity, retry every %d sec, drivers give up after %d min" % (
+        spots, hours, demand_percent, retry_seconds, patience_minutes)
+    print "%-9s %12s %10s %10s %12s %10s %12s" % ("mode", "park calls", "seconds", "parked", "after wait",
+                                                  "gave up", "mean wait")
+
+    for mode in ('retry', 'waitlist'):
+        run(mode, spots, hours, demand_percent, retry_seconds, patience_minutes * 60)
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,125 @@
+""" Run random parks, returns, bulk parks and returns and compactions (which relocate cars) against controllers of
+every storage layout, and check after every round that the plate and spot indexes agree with a rebuild from the
+tickets table and the lot groups. Then do the same with gate threads against a concurrent controller, checked once
+they are done. Plates repeat on purpose, so the plate index sees plates with several parked cars.
+
+usage: python -m benchmarks.index_consistency [rounds] [ops_per_round] [seed]
+"""
+
+import random
+import sys
+import threading
+
+from benchmarks.util import SIZES
+from parkinglot import Car, ParkingLotController
+
+
+# few enough plates that many of them have several cars parked at once.
+PLATE_COUNT = 150
+
+
+def make_controller(compact_storage, concurrent=False):
+    return ParkingLotController(lot_groups=[(120, 1, 1), (40, 1, 2), (100, 2, 3), (80, 3, 4), (30, 3, 6)],
+                                auto_compactify=False, compact_storage=compact_storage, concurrent=concurrent)
+
+
+def random_car(rng):
+    return Car(plate='IDX %d' % rng.randrange(PLATE_COUNT), model='check', size=rng.choice(SIZES))
+
+
+def check_indexes(pc):
+    """ Rebuild both indexes from the tickets table and the lot groups and compare them with what the query
+    methods of pc return, for every plate and every spot. """
+
+    expected_spots = [{} for _ in pc._lot_groups]
+    expected_plates = {}
+    for ticket_no, ticket in pc._tickets_table.iteritems():
+        lot_group, lot_id = ticket.get_current_car_spot()
+        car = lot_group.get_car(lot_id)
+        assert car is not None, "ticket %d points at free spot %d" % (ticket_no, lot_id)
+
+        spots = expected_spots[pc._lot_group_index[lot_group]]
+        assert lot_id not in spots, "spot %d has two tickets" % lot_id
+        spots[lot_id] = ticket_no
+        expected_plates.setdefault(car.get_plate(), []).append(ticket_no)
+
+    for plate_no in xrange(PLATE_COUNT):
+        plate = 'IDX %d' % plate_no
+        assert pc.find_tickets_by_plate(plate) == sorted(expected_plates.get(plate, [])), plate
+
+    for lot_group_index, lot_group in enumerate(pc._lot_groups):
+        spots = expected_spots[lot_group_index]
+        for lot_id in xrange(lot_group.get_spot_count()):
+            assert pc.get_ticket_for_spot(lot_group_index, lot_id) == spots.get(lot_id), (lot_group_index, lot_id)
+        assert sorted(pc.get_tickets_in_lot_group(lot_group_index)) == sorted(spots.values()), lot_group_index
+        assert len(pc._spot_index[lot_group_index]) == len(spots), lot_group_index
+
+
+def churn(pc, rng, ops, tickets):
+    """ Do ops random changes to pc, keeping tickets, the list of ticket numbers of parked cars, up to date. """
+
+    for _ in xrange(ops):
+        roll = rng.random()
+        if roll < 0.35 and tickets:
+            idx = rng.randrange(len(tickets))
+            tickets[idx], tickets[-1] = tickets[-1], tickets[idx]
+            car, _ = pc.return_car_and_get_cost_for_ticket_number(tickets.pop())
+            assert car is not None
+        elif roll < 0.40 and tickets:
+            rng.shuffle(tickets)
+            count = rng.randrange(1, min(20, len(tickets)) + 1)
+            pc.return_cars(tickets[-count:])
+            del tickets[-count:]
+        elif roll < 0.45:
+            tickets.extend(ticket_no for ticket_no in pc.park_cars(random_car(rng) for _ in xrange(rng.randrange(20)))
+                           if ticket_no is not None)
+        elif roll < 0.48:
+            # moves cars into the spots returns just freed up in smaller lot groups.
+            pc.compactify_parking_lot()
+        else:
+            ticket_no = pc.park_car_and_return_ticket_number(random_car(rng))
+            if ticket_no is not None:
+                tickets.append(ticket_no)
+
+
+def run_single(compact_storage, rounds, ops_per_round, seed):
+    rng = random.Random(seed)
+    pc = make_controller(compact_storage)
+    tickets = []
+    for _ in xrange(rounds):
+        churn(pc, rng, ops_per_round, tickets)
+        check_indexes(pc)
+
+
+def run_threads(compact_storage, rounds, ops_per_round, seed, thread_count=4):
+    pc = make_controller(compact_storage, concurrent=True)
+    failures = []
+
+    def gate(gate_no):
+        try:
+            churn(pc, random.Random(seed * 100 + gate_no), rounds * ops_per_round, [])
+        except Exception as e:
+            failures.append(e)
+            raise
+
+    threads = [threading.Thread(target=gate, args=(gate_no,)) for gate_no in xrange(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not failures, "a gate thread failed"
+    check_indexes(pc)
+
+
+def main(rounds=50, ops_per_round=200, seed=1):
+    for compact_storage in (False, True):
+        layout = 'compact' if compact_storage else 'objects'
+        run_single(compact_storage, rounds, ops_per_round, seed)
+        print "%-8s %d rounds of %d ops: indexes consistent" % (layout, rounds, ops_per_round)
+        run_threads(compact_storage, rounds, ops_per_round, seed)
+        print "%-8s %d ops from each of 4 threads: indexes consistent" % (layout, rounds * ops_per_round)
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
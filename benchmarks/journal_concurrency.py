@@ -0,0 +1,83 @@
+""" Churn a concurrent controller from several gate threads with a journal attached, then recover a fresh controller
+from the journal and check it ends up with the same tickets in the same spots. The lot is small and compaction is on,
+so freed spots get reused and cars relocated all the time, and the thread switch interval is cut to a single
+bytecode to make races between the gates likely.
+
+usage: python -m benchmarks.journal_concurrency [ops_per_thread] [thread_count] [seed]
+"""
+
+import shutil
+import sys
+import tempfile
+import threading
+
+from benchmarks.util import churn
+from parkinglot import ParkingLotController
+from persistence import Journal, recover
+
+
+def make_controller(compact_storage):
+    return ParkingLotController(lot_groups=[(20, 1, 1), (10, 2, 2), (10, 3, 3)], auto_compactify=True,
+                                compact_storage=compact_storage, concurrent=True)
+
+
+def parked_cars(pc):
+    """ Return {ticket number: (lot group index, lot id, plate, size)} for every car parked in pc. """
+
+    cars = {}
+    for ticket_no, ticket in pc._tickets_table.iteritems():
+        lot_group, lot_id = ticket.get_current_car_spot()
+        car = lot_group.get_car(lot_id)
+        cars[ticket_no] = (pc._lot_group_index[lot_group], lot_id, car.get_plate(), car.get_size())
+    return cars
+
+
+def run(compact_storage, ops_per_thread, thread_count, seed, snapshot_every):
+    directory = tempfile.mkdtemp(prefix='parkinglot-journal-concurrency-')
+
+    try:
+        pc = make_controller(compact_storage)
+        journal = Journal(directory, batch_size=16, fsync=False, snapshot_every=snapshot_every)
+        journal.attach(pc)
+        failures = []
+
+        def gate(gate_no):
+            try:
+                churn(pc, ops_per_thread, seed=seed * 100 + gate_no, tickets=[])
+            except Exception as e:
+                failures.append(e)
+                raise
+
+        threads = [threading.Thread(target=gate, args=(gate_no,)) for gate_no in xrange(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        journal.close()
+        assert not failures, "a gate thread failed"
+
+        recovered = make_controller(compact_storage)
+        replayed = recover(recovered, directory)
+        assert parked_cars(recovered) == parked_cars(pc), "recovered lot differs from the journaled one"
+        return replayed
+    finally:
+        shutil.rmtree(directory)
+
+
+def main(ops_per_thread=5000, thread_count=6, seed=1):
+    check_interval = sys.getcheckinterval()
+    sys.setcheckinterval(1)
+    try:
+        for compact_storage in (False, True):
+            layout = 'compact' if compact_storage else 'objects'
+            for snapshot_every in (None, 97):
+                replayed = run(compact_storage, ops_per_thread, thread_count, seed, snapshot_every)
+                print "%-8s snapshot every %-4s %d ops from each of %d threads: recovered the same lot " \
+                      "(%d journal records replayed)" % (layout, snapshot_every or '-', ops_per_thread, thread_count,
+                                                         replayed)
+    finally:
+        sys.setcheckinterval(check_interval)
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,95 @@
+""" Poll a shared memory occupancy segment from several reader processes as fast as they can while the controller
+parks and returns cars, and report park/return throughput with and without the publisher, reader poll rates and
+how often a read had to be retried. Every snapshot a reader takes is checked: the count of every lot group must
+match the bits set in its bitmap.
+
+usage: python -m benchmarks.occupancy_readers [spots] [ops] [readers] [mode]
+
+mode is 'counts' (read_counts(), just the per lot group counters) or 'snapshot' (snapshot(), every bit).
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.suite import make_controller
+from benchmarks.util import churn
+from occupancy import OccupancyPublisher, OccupancyReader
+
+
+def poll(path, mode, stop, results):
+    """ Reader process: poll the segment until stop is set, then report (polls, retries, bad snapshots). """
+
+    reader = OccupancyReader(path)
+    polls = 0
+    bad = 0
+    group_count = len(reader.get_spot_counts())
+
+    while not stop.is_set():
+        if 'counts' == mode:
+            reader.read_counts()
+        else:
+            snapshot = reader.snapshot()
+            for group_idx in xrange(group_count):
+                if snapshot.count_bits(group_idx) != snapshot.occupied[group_idx]:
+                    bad += 1
+        polls += 1
+
+    results.put((polls, reader.retries, bad))
+    reader.close()
+
+
+def main(spots=100000, ops=200000, readers=4, mode='counts'):
+    assert mode in ('counts', 'snapshot')
+
+    plain_rate = churn(make_controller(spots, compact_storage=False), ops, seed=1)
+    print "%d spots, %d parks/returns: %.0f ops/sec without publisher" % (spots, ops, plain_rate)
+
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    path = os.path.join(shm_dir, 'parkinglot-bench-%d.occupancy' % os.getpid())
+
+    # the cost of publishing alone, readers also take cpu away from the controller unless there are spare cores.
+    pc = make_controller(spots, compact_storage=False)
+    publisher = OccupancyPublisher(path)
+    publisher.attach(pc)
+    try:
+        unread_rate = churn(pc, ops, seed=1)
+    finally:
+        publisher.close()
+    print "%.0f ops/sec with publisher and no readers (%.2fx)" % (unread_rate, unread_rate / plain_rate)
+
+    pc = make_controller(spots, compact_storage=False)
+    publisher = OccupancyPublisher(path)
+    publisher.attach(pc)
+
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=poll, args=(path, mode, stop, results)) for _ in xrange(readers)]
+    for process in processes:
+        process.start()
+
+    try:
+        t0 = time.time()
+        published_rate = churn(pc, ops, seed=1)
+        elapsed = time.time() - t0
+    finally:
+        stop.set()
+        reader_results = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        publisher.close()
+
+    polls = sum(result[0] for result in reader_results)
+    retries = sum(result[1] for result in reader_results)
+    bad = sum(result[2] for result in reader_results)
+
+    print "%.0f ops/sec with publisher and %d %s readers (%.2fx)" % (published_rate, readers, mode,
+                                                                    published_rate / plain_rate)
+    print "readers: %d polls in %.1f s (%.0f polls/sec), %d retries (%.3f%%), %d inconsistent snapshots" % (
+        polls, elapsed, polls / elapsed, retries, 100.0 * retries / max(1, polls), bad)
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:4]] + sys.argv[4:5])
@@ -0,0 +1,69 @@
+""" Measure LotGroup.find_spot_and_park latency as the lot group fills up.
+
+The allocator should keep park latency flat from an empty lot group to a 99% full one.
+usage: python -m benchmarks.park_latency [spot_count] [samples_per_level]
+"""
+
+import random
+import sys
+import time
+
+from benchmarks.util import percentile
+from parkinglot import Car, LotGroup, LotSize
+
+
+OCCUPANCY_LEVELS = [0, 10, 25, 50, 75, 90, 95, 99]
+
+
+def measure_level(lot_group, occupied_ids, car, samples, rng):
+    """ Keep the occupancy of lot_group fixed while timing park calls. Each sample frees a random occupied
+    spot and then times parking a car into the lowest free spot. Return the sorted latencies in seconds. """
+
+    latencies = []
+    for _ in xrange(samples):
+        if occupied_ids:
+            idx = rng.randrange(len(occupied_ids))
+            lot_group.remove_car(lot_id=occupied_ids[idx])
+            occupied_ids[idx] = occupied_ids[-1]
+            occupied_ids.pop()
+
+        t0 = time.time()
+        lot_id = lot_group.find_spot_and_park(car)
+        t1 = time.time()
+
+        assert lot_id is not None
+        occupied_ids.append(lot_id)
+        latencies.append(t1 - t0)
+
+    latencies.sort()
+    return latencies
+
+
+def main(spot_count=50000, samples=20000):
+    rng = random.Random(1234)
+    car = Car(plate='BENCH 001', model='bench', size=LotSize.SMALL)
+
+    print "park latency for a lot group of %d spots, %d samples per occupancy level" % (spot_count, samples)
+    print "%10s %12s %12s %12s" % ("occupancy", "p50 (us)", "p99 (us)", "max (us)")
+
+    for level in OCCUPANCY_LEVELS:
+        lot_group = LotGroup(lots_count=spot_count, size=LotSize.SMALL, hourly_rate=1)
+
+        # fill to one spot below the target, the measure loop parks one more car before timing the next.
+        target = max(0, (spot_count * level) // 100 - 1)
+        occupied_ids = [lot_group.find_spot_and_park(car) for _ in xrange(target)]
+
+        # shuffle which spots are free so the free structure is not trivially ordered.
+        rng.shuffle(occupied_ids)
+        for _ in xrange(min(len(occupied_ids), spot_count // 100)):
+            lot_group.remove_car(lot_id=occupied_ids.pop())
+        while len(occupied_ids) < target:
+            occupied_ids.append(lot_group.find_spot_and_park(car))
+
+        latencies = measure_level(lot_group, occupied_ids, car, samples, rng)
+        print "%9d%% %12.2f %12.2f %12.2f" % (level, percentile(latencies, 50) * 1e6,
+                                              percentile(latencies, 99) * 1e6, latencies[-1] * 1e6)
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,72 @@
+""" Measure journal overhead per park/return and recovery time of a large lot from a snapshot plus journal tail.
+
+usage: python -m benchmarks.recovery [ticket_count] [tail_ops]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.util import SIZES, churn
+from parkinglot import Car, ParkingLotController
+from persistence import Journal, recover, SNAPSHOT_NAME
+
+
+def make_controller(ticket_count):
+    # leave some head room so the journal tail can park more cars.
+    spots_per_group = ticket_count // 3 + ticket_count // 10
+    return ParkingLotController(small_count=spots_per_group, small_rate=1, medium_count=spots_per_group,
+                                medium_rate=2, large_count=spots_per_group, large_rate=3, compact_storage=True)
+
+
+def main(ticket_count=1000000, tail_ops=100000):
+    directory = tempfile.mkdtemp(prefix='parkinglot-recovery-')
+
+    try:
+        # journal overhead: the same churn with and without a journal attached.
+        plain_pc = make_controller(tail_ops)
+        plain = churn(plain_pc, tail_ops, seed=1, tickets=[])
+
+        journaled_pc = make_controller(tail_ops)
+        journal = Journal(os.path.join(directory, 'overhead'))
+        journal.attach(journaled_pc)
+        journaled = churn(journaled_pc, tail_ops, seed=1, tickets=[])
+        journal.close()
+
+        print "park/return: %.2f us/op without journal, %.2f us/op with journal" % (1e6 / plain, 1e6 / journaled)
+
+        # a full lot, snapshotted, then a journal tail on top.
+        pc = make_controller(ticket_count)
+        journal = Journal(os.path.join(directory, 'lot'))
+        journal.attach(pc)
+
+        t0 = time.time()
+        tickets = [ticket_no for ticket_no in
+                   pc.park_cars(Car(plate='SNAP %d' % i, model='bench', size=SIZES[i % 3])
+                                for i in xrange(ticket_count))]
+        print "parked %d cars in %.1f s" % (len(tickets), time.time() - t0)
+
+        t0 = time.time()
+        journal.write_snapshot()
+        snapshot_size = os.path.getsize(os.path.join(directory, 'lot', SNAPSHOT_NAME))
+        print "snapshot written in %.2f s, %.1f MB" % (time.time() - t0, snapshot_size / 1e6)
+
+        churn(pc, tail_ops, seed=99, tickets=tickets)
+        journal.close()
+
+        recovered = make_controller(ticket_count)
+        t0 = time.time()
+        replayed = recover(recovered, os.path.join(directory, 'lot'))
+        elapsed = time.time() - t0
+
+        assert len(recovered._tickets_table) == len(pc._tickets_table)
+        print "recovered %d tickets (%d journal records replayed) in %.2f s" % (len(recovered._tickets_table),
+                                                                              replayed, elapsed)
+    finally:
+        shutil.rmtree(directory)
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
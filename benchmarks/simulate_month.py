@@ -0,0 +1,56 @@
+""" Simulate a month of gate traffic against a garage on a virtual clock and print how long it took, plus a daily
+summary of the occupancy and revenue time series.
+
+usage: python -m benchmarks.simulate_month [spots] [days] [mean_dwell_minutes] [occupancy_percent]
+"""
+
+import itertools
+import sys
+import time
+
+from benchmarks.suite import make_controller
+from benchmarks.trace import TraceGenerator
+from parkinglot import Car
+from simulation import Simulation
+
+
+def iter_cars(generator):
+    """ Turn the arrivals of a TraceGenerator into the (arrival time, car, dwell) tuples a Simulation takes. """
+
+    for arrival_time, car_no, size, dwell in generator.iter_arrivals():
+        yield arrival_time, Car(plate='SIM %d' % car_no, model='sim', size=size), dwell
+
+
+def main(spots=20000, days=30, mean_dwell_minutes=480, occupancy_percent=85):
+    mean_dwell = mean_dwell_minutes * 60.0
+    arrival_rate = TraceGenerator.arrival_rate_for_occupancy(spots, occupancy_percent / 100.0, mean_dwell)
+    generator = TraceGenerator(seed=7, arrival_rate=arrival_rate, dwell='lognormal', mean_dwell=mean_dwell)
+
+    sim = Simulation(make_controller(spots, compact_storage=False))
+    sim.add_arrivals(iter_cars(generator))
+    sim.add_compaction(interval=900)
+    sim.add_sampling(interval=3600, outstanding_revenue=True)
+
+    t0 = time.time()
+    event_count = sim.run(until=days * 24 * 3600)
+    elapsed = time.time() - t0
+
+    stats = sim.get_stats()
+    print "%d spots, %d days, mean dwell %d min, %.2f arrivals/sec" % (spots, days, mean_dwell_minutes, arrival_rate)
+    print "%d events in %.1f sec (%.0f events/sec)" % (event_count, elapsed, event_count / elapsed)
+    print "parked %d, rejected %d, returned %d, collected %.0f" % (stats['parked'], stats['rejected'],
+                                                                  stats['returned'], stats['collected_revenue'])
+
+    print "%5s %10s %10s %12s %12s" % ("day", "avg occ", "peak occ", "collected", "outstanding")
+    collected_before = 0.0
+    for day, samples in itertools.groupby(sim.get_samples(), key=lambda sample: int(sample['time'] - 1) // 86400):
+        samples = list(samples)
+        occupied = [sample['occupied'] for sample in samples]
+        print "%5d %10.0f %10d %12.0f %12.0f" % (day, sum(occupied) / float(len(occupied)), max(occupied),
+                                                 samples[-1]['collected_revenue'] - collected_before,
+                                                 samples[-1]['outstanding_revenue'])
+        collected_before = samples[-1]['collected_revenue']
+
+
+if '__main__' == __name__:
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,204 @@
+""" Benchmark suite: replay a seeded synthetic trace against ParkingLotController at growing lot sizes and
+report throughput, latency percentiles and peak memory for park, return, cost lookup, __str__ and
+compactify_parking_lot. Results are saved as JSON so runs of different commits can be compared.
+
+usage:
+    python -m benchmarks.suite                                  # 10^3 .. 10^5 spots
+    python -m benchmarks.suite --scales 1000,1000000,10000000 --output results.json
+    python -m benchmarks.suite --compare baseline.json          # run and compare against an earlier result
+"""
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from benchmarks.trace import ARRIVE, DEFAULT_SIZE_MIX, DWELL_DISTRIBUTIONS, TraceGenerator
+from benchmarks.util import max_rss_bytes, summarize_latencies
+from parkinglot import Car, LotSize, ParkingLotController, TimeHelper
+
+
+OPERATIONS = ['prefill', 'park', 'return', 'cost', 'compactify', 'str']
+
+
+def make_controller(spots, compact_storage):
+    """ Return a controller with spots split over the lot groups like the default size mix. """
+
+    total = float(sum(DEFAULT_SIZE_MIX.itervalues()))
+    counts = dict((size, int(spots * weight / total)) for size, weight in DEFAULT_SIZE_MIX.iteritems())
+    return ParkingLotController(small_count=counts[LotSize.SMALL], small_rate=1,
+                                medium_count=counts[LotSize.MEDIUM], medium_rate=2,
+                                large_count=counts[LotSize.LARGE], large_rate=3,
+                                compact_storage=compact_storage)
+
+
+def run_scale(spots, ops, seed, dwell, prefill_occupancy, str_limit, compact_storage):
+    """ Benchmark one lot size in this process and return a dict of results. """
+
+    rng = random.Random(seed)
+    pc = make_controller(spots, compact_storage)
+    latencies = dict((op, []) for op in OPERATIONS)
+
+    # long term parkers fill most of the lot in one bulk call, the trace then churns on top of them.
+    generator = TraceGenerator(seed=seed, arrival_rate=1.0, dwell=dwell,
+                               mean_dwell=max(1.0, min(0.1 * spots, ops / 8.0)))
+    prefill_cars = [Car(plate='PRE %d' % i, model='bench', size=generator.draw_size())
+                    for i in xrange(int(spots * prefill_occupancy))]
+    t0 = time.time()
+    pc.park_cars(prefill_cars)
+    prefill_elapsed = time.time() - t0
+    latencies['prefill'] = [prefill_elapsed / max(1, len(prefill_cars))] * len(prefill_cars)
+    del prefill_cars
+
+    trace = generator.generate(ops)
+    tickets = {}
+    live_tickets = []
+    advanced = 0
+
+    t_trace = time.time()
+    for event_no, (event_time, kind, car_no, size) in enumerate(trace):
+        # let the controller clock follow the trace.
+        if int(event_time) > advanced:
+            TimeHelper.advance_time(int(event_time) - advanced)
+            advanced = int(event_time)
+
+        if ARRIVE == kind:
+            car = Car(plate='T %d' % car_no, model='bench', size=size)
+            t0 = time.time()
+            ticket_no = pc.park_car_and_return_ticket_number(car)
+            latencies['park'].append(time.time() - t0)
+            if ticket_no is not None:
+                tickets[car_no] = ticket_no
+                live_tickets.append(ticket_no)
+        elif car_no in tickets:
+            ticket_no = tickets.pop(car_no)
+            t0 = time.time()
+            pc.return_car_and_get_cost_for_ticket_number(ticket_no)
+            latencies['return'].append(time.time() - t0)
+
+        if 0 == event_no % 10 and live_tickets:
+            ticket_no = live_tickets[rng.randrange(len(live_tickets))]
+            t0 = time.time()
+            pc.get_cost_for_ticket_number(ticket_no)
+            latencies['cost'].append(time.time() - t0)
+
+        if 0 == event_no % 1000:
+            t0 = time.time()
+            pc.compactify_parking_lot()
+            latencies['compactify'].append(time.time() - t0)
+
+        if len(live_tickets) > 4 * len(tickets) + 1000:
+            # drop returned tickets from the lookup sample now and then, stale ones just cost an invalid lookup.
+            live_tickets = tickets.values()
+
+    trace_elapsed = time.time() - t_trace
+
+    if spots <= str_limit:
+        t0 = time.time()
+        str(pc)
+        latencies['str'].append(time.time() - t0)
+
+    TimeHelper.advance_time(-advanced)
+
+    result = {
+        'spots': spots,
+        'trace_events': len(trace),
+        'trace_events_per_sec': len(trace) / trace_elapsed,
+        'peak_rss_bytes': max_rss_bytes(),
+        'operations': {},
+    }
+    for op in OPERATIONS:
+        if latencies[op]:
+            elapsed = prefill_elapsed if 'prefill' == op else None
+            result['operations'][op] = summarize_latencies(latencies[op], elapsed)
+
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result, baseline=None):
+    print "---- %d spots: %.0f trace events/sec, peak rss %.1f MB" % (result['spots'], result['trace_events_per_sec'],
+                                                                     result['peak_rss_bytes'] / 1e6)
+    header = "%12s %8s %14s %10s %10s %10s %12s" % ("op", "count", "ops/sec", "p50 us", "p90 us", "p99 us", "max us")
+    if baseline:
+        header += " %10s %10s" % ("ops/s vs", "p99 vs")
+    print header
+
+    for op in OPERATIONS:
+        stats = result['operations'].get(op)
+        if stats is None:
+            continue
+
+        line = "%12s %8d %14.0f %10.2f %10.2f %10.2f %12.2f" % (op, stats['count'], stats['throughput'],
+                                                               stats['p50_us'], stats['p90_us'], stats['p99_us'],
+                                                               stats['max_us'])
+        old = baseline['operations'].get(op) if baseline else None
+        if old:
+            line += " %10.2f %10.2f" % (stats['throughput'] / old['throughput'] if old['throughput'] else 0,
+                                        stats['p99_us'] / old['p99_us'] if old['p99_us'] else 0)
+        print line
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="parking lot benchmark suite")
+    parser.add_argument('--scales', default='1000,10000,100000',
+                        help="comma separated lot sizes in spots, e.g. 1000,10000000")
+    parser.add_argument('--ops', type=int, default=200000, help="trace events per scale")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--dwell', choices=DWELL_DISTRIBUTIONS, default='exponential')
+    parser.add_argument('--prefill', type=float, default=0.85, help="fraction of spots filled before the trace")
+    parser.add_argument('--str-limit', type=int, default=1000000, help="skip __str__ above this many spots")
+    parser.add_argument('--compact-storage', action='store_true')
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--compare', help="JSON file of an earlier run to compare against")
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child is not None:
+        result = run_scale(args.child, args.ops, args.seed, args.dwell, args.prefill, args.str_limit,
+                           args.compact_storage)
+        print json.dumps(result)
+        return
+
+    baselines = {}
+    if args.compare:
+        with open(args.compare) as compare_file:
+            baselines = dict((result['spots'], result) for result in json.load(compare_file)['results'])
+
+    results = []
+    for spots in [int(scale) for scale in args.scales.split(',')]:
+        # every scale runs in a fresh process, so peak memory is its own.
+        child_args = [sys.executable, '-m', 'benchmarks.suite', '--child', str(spots), '--ops', str(args.ops),
+                      '--seed', str(args.seed), '--dwell', args.dwell, '--prefill', str(args.prefill),
+                      '--str-limit', str(args.str_limit)]
+        if args.compact_storage:
+            child_args.append('--compact-storage')
+
+        result = json.loads(subprocess.check_output(child_args).splitlines()[-1])
+        print_result(result, baselines.get(spots))
+        results.append(result)
+
+    if args.output:
+        report = {
+            'commit': git_commit(),
+            'time': time.time(),
+            'python': platform.python_version(),
+            'params': {'ops': args.ops, 'seed': args.seed, 'dwell': args.dwell, 'prefill': args.prefill,
+                       'compact_storage': args.compact_storage},
+            'results': results,
+        }
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+
+if '__main__' == __name__:
+    main(sys.argv[1:])
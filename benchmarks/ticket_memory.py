@@ -0,0 +1,51 @@
+""" Compare the memory used per parked car by the default dict-of-objects layout and the compact storage layout
+(ParkingLotController(compact_storage=True)).
+
+Each layout is measured in a fresh child process, as the growth of the max resident set size while parking
+ticket_count cars. usage: python -m benchmarks.ticket_memory [ticket_count]
+"""
+
+import gc
+import subprocess
+import sys
+
+from benchmarks.util import max_rss_bytes
+from parkinglot import Car, LotSize, ParkingLotController
+
+
+LAYOUTS = ['objects', 'compact']
+
+
+def measure(layout, ticket_count):
+    """ Park ticket_count cars with the given storage layout, and return the rss growth in bytes. """
+
+    # all tickets share a single car, so only the controller's own per car storage is measured.
+    car = Car(plate='MEM 0001', model='bench', size=LotSize.SMALL)
+
+    gc.collect()
+    before = max_rss_bytes()
+
+    pc = ParkingLotController(small_count=ticket_count, small_rate=1, medium_count=0, medium_rate=2,
+                              large_count=0, large_rate=3, compact_storage=('compact' == layout))
+    pc.park_cars(car for _ in xrange(ticket_count))
+
+    gc.collect()
+    return max_rss_bytes() - before
+
+
+def main(ticket_count=1000000):
+    print "memory for %d parked cars" % ticket_count
+    print "%10s %12s %16s" % ("layout", "total (MB)", "bytes per car")
+
+    for layout in LAYOUTS:
+        out = subprocess.check_output([sys.executable, '-m', 'benchmarks.ticket_memory', '--child', layout,
+                                       str(ticket_count)])
+        grown = int(out.strip())
+        print "%10s %12.1f %16.1f" % (layout, grown / 1e6, float(grown) / ticket_count)
+
+
+if '__main__' == __name__:
+    if len(sys.argv) > 1 and '--child' == sys.argv[1]:
+        print measure(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,110 @@
+""" Seeded synthetic gate traffic.
+
+A trace is a time ordered list of (time, kind, car_no, size) events, kind being ARRIVE or DEPART. Cars arrive as
+a Poisson process, pick a size from a size mix, and stay for a dwell time drawn from a dwell distribution. The
+same seed always gives the same trace.
+"""
+
+import heapq
+import math
+import random
+
+from parkinglot import LotSize
+
+
+ARRIVE = 'arrive'
+DEPART = 'depart'
+
+DWELL_DISTRIBUTIONS = ['exponential', 'lognormal', 'uniform', 'fixed']
+
+DEFAULT_SIZE_MIX = {LotSize.SMALL: 0.3, LotSize.MEDIUM: 0.5, LotSize.LARGE: 0.2}
+
+
+class TraceGenerator(object):
+    """ Generate arrivals and departures with a given arrival rate, size mix and dwell time distribution. """
+
+    def __init__(self, seed=0, arrival_rate=1.0, size_mix=None, dwell='exponential', mean_dwell=7200.0,
+                 dwell_sigma=1.0):
+        """ arrival_rate is in cars per second, size_mix a dict of LotSize to relative weight, dwell one of
+        DWELL_DISTRIBUTIONS with mean mean_dwell seconds. dwell_sigma is the sigma of the underlying normal for
+        lognormal dwell times. """
+
+        super(TraceGenerator, self).__init__()
+
+        assert arrival_rate > 0
+        assert dwell in DWELL_DISTRIBUTIONS
+        assert mean_dwell > 0
+
+        self._rng = random.Random(seed)
+        self._arrival_rate = arrival_rate
+        self._dwell = dwell
+        self._mean_dwell = mean_dwell
+        self._dwell_sigma = dwell_sigma
+
+        size_mix = size_mix or DEFAULT_SIZE_MIX
+        total = float(sum(size_mix.itervalues()))
+        self._sizes = sorted(size_mix)
+        self._cumulative_weights = []
+        running = 0.0
+        for size in self._sizes:
+            running += size_mix[size] / total
+            self._cumulative_weights.append(running)
+
+    @staticmethod
+    def arrival_rate_for_occupancy(spot_count, occupancy, mean_dwell):
+        """ Return the arrival rate that keeps on average occupancy (0..1) of spot_count spots busy. """
+
+        return spot_count * occupancy / float(mean_dwell)
+
+    def draw_size(self):
+        roll = self._rng.random()
+        for size, weight in zip(self._sizes, self._cumulative_weights):
+            if roll < weight:
+                return size
+
+        return self._sizes[-1]
+
+    def draw_dwell(self):
+        if 'exponential' == self._dwell:
+            return self._rng.expovariate(1.0 / self._mean_dwell)
+
+        if 'lognormal' == self._dwell:
+            # pick mu so the mean of the lognormal is mean_dwell.
+            mu = math.log(self._mean_dwell) - (self._dwell_sigma ** 2) / 2.0
+            return self._rng.lognormvariate(mu, self._dwell_sigma)
+
+        if 'uniform' == self._dwell:
+            return self._rng.uniform(0, 2 * self._mean_dwell)
+
+        return self._mean_dwell
+
+    def iter_arrivals(self, start_time=0.0):
+        """ Yield (arrival time, car_no, size, dwell) forever. """
+
+        now = start_time
+        car_no = 0
+        while True:
+            now += self._rng.expovariate(self._arrival_rate)
+            yield now, car_no, self.draw_size(), self.draw_dwell()
+            car_no += 1
+
+    def generate(self, event_count, start_time=0.0):
+        """ Return a time ordered list of event_count (time, kind, car_no, size) events. Departures of cars that
+        arrive within the trace but leave after its last event are left out. """
+
+        events = []
+        departures = []
+        arrivals = self.iter_arrivals(start_time)
+        next_arrival = next(arrivals)
+
+        while len(events) < event_count:
+            if departures and departures[0][0] <= next_arrival[0]:
+                depart_time, car_no, size = heapq.heappop(departures)
+                events.append((depart_time, DEPART, car_no, size))
+            else:
+                arrive_time, car_no, size, dwell = next_arrival
+                events.append((arrive_time, ARRIVE, car_no, size))
+                heapq.heappush(departures, (arrive_time + dwell, car_no, size))
+                next_arrival = next(arrivals)
+
+        return events
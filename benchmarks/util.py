@@ -0,0 +1,78 @@
+""" Helpers shared by the benchmarks. """
+
+import random
+import resource
+import time
+
+from parkinglot import Car, LotSize
+
+
+SIZES = [LotSize.SMALL, LotSize.MEDIUM, LotSize.LARGE]
+
+
+def percentile(sorted_samples, pct):
+    """ Return the pct percentile of an already sorted list of samples. """
+
+    if not sorted_samples:
+        return 0.0
+
+    idx = int(round((pct / 100.0) * (len(sorted_samples) - 1)))
+    return sorted_samples[idx]
+
+
+def summarize_latencies(latencies, elapsed=None):
+    """ Return a dict of count, throughput (ops/sec) and p50/p90/p99/max latency in microseconds for a list of
+    per operation latencies in seconds. Throughput is count / elapsed, or count / sum of latencies if elapsed
+    is not given. Sorts latencies in place. """
+
+    latencies.sort()
+    if elapsed is None:
+        elapsed = sum(latencies)
+
+    return {
+        'count': len(latencies),
+        'throughput': (len(latencies) / elapsed) if elapsed else 0.0,
+        'p50_us': percentile(latencies, 50) * 1e6,
+        'p90_us': percentile(latencies, 90) * 1e6,
+        'p99_us': percentile(latencies, 99) * 1e6,
+        'max_us': (latencies[-1] * 1e6) if latencies else 0.0,
+    }
+
+
+def max_rss_bytes():
+    """ Return the peak resident set size of this process so far. """
+
+    # ru_maxrss is in kilobytes on linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def churn(pc, ops, seed, clock=None, seconds_per_op=0, tickets=None):
+    """ Run ops parks and returns at random against pc, each a coin toss, moving clock on by seconds_per_op after
+    each if a clock is given. Returns pick from tickets, the ticket numbers of cars already parked, which is kept
+    up to date. If tickets is not given the lot is first filled to about 85%. Return ops/sec of the churn. """
+
+    rng = random.Random(seed)
+
+    if tickets is None:
+        spots = sum(lot_group.get_spot_count() for lot_group in pc._lot_groups)
+        tickets = [pc.park_car_and_return_ticket_number(Car(plate='F%d' % i, model='bench', size=rng.choice(SIZES)))
+                   for i in xrange(int(spots * 0.85))]
+        tickets = [ticket_no for ticket_no in tickets if ticket_no is not None]
+
+    t0 = time.time()
+    for op in xrange(ops):
+        if tickets and rng.random() < 0.5:
+            # swap the pick to the end, popping from the middle of a big list is slow.
+            idx = rng.randrange(len(tickets))
+            tickets[idx], tickets[-1] = tickets[-1], tickets[idx]
+            pc.return_car_and_get_cost_for_ticket_number(tickets.pop())
+        else:
+            ticket_no = pc.park_car_and_return_ticket_number(Car(plate='C%d' % op, model='bench',
+                                                                 size=rng.choice(SIZES)))
+            if ticket_no is not None:
+                tickets.append(ticket_no)
+
+        if clock is not None:
+            clock.advance(seconds_per_op)
+
+    return ops / (time.time() - t0)
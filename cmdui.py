@@ -1,4 +1,9 @@
 
+import argparse
+import shlex
+import sys
+import time
+
 from parkinglot import *
 
 
@@ -162,7 +167,204 @@ class ParkingLotCMDUI(object):
                 print "Invalid choice."
 
 
+#-----------------------------------------------------------------------------------------------------------------------
+#-----------------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------ batch mode
+def split_command_line(line):
+    """ Split a batch command line into fields like a shell does. A # outside of quotes starts a comment that runs
+    to the end of the line. Raise ValueError if a quote is not closed. """
+
+    # shlex is a lot slower than split(), only pay for it when there are quotes.
+    if '"' in line or "'" in line:
+        return shlex.split(line, comments=True)
+
+    return line.split('#', 1)[0].split()
+
+
+class BatchRunner(object):
+    """ Run a script of commands against a controller back to back, without menus or prompts. One command per line:
+
+        park <plate> <model> <size>     park a car, size is 1, 2, 3 or small, medium, large. prints the ticket no
+        return <ticket no>              return a car. prints the cost and the car
+        cost <ticket no>                print the cost so far
+        compact                         compactify the parking lot. prints the number of cars moved
+        state                           print the parking lot state
+        advance <seconds>               move the clock forward
+        at <seconds since 1970>         move the clock to a point in time, for replaying time stamped gate logs
+        time                            print the time
+
+    Fields are separated by white space, quote a plate or model with spaces or quotes in it. A # starts a comment
+    that runs to the end of the line, blank lines are skipped. The controller runs on its own VirtualClock, so a
+    script replays the same way every time. A bad command, including one with a quote that is never closed, is
+    reported in the output and counted, and the script goes on. """
+
+    # output lines are written out in batches of this many.
+    FLUSH_EVERY = 1024
+
+    def __init__(self, controller, out=sys.stdout, quiet=False, start_time=None):
+        """ Run scripts against controller and write the outcome of every command to out, or with quiet only the
+        summary. The controller is switched to a VirtualClock at start_time, by default the time of its clock. """
+
+        super(BatchRunner, self).__init__()
+
+        self._controller = controller
+        if start_time is None:
+            start_time = controller.get_clock().get_time()
+
+        self._clock = VirtualClock(start_time)
+        controller.set_clock(self._clock)
+
+        self._out = out
+        self._quiet = quiet
+
+        self._handlers = {
+            'park': self._handle_park,
+            'return': self._handle_return,
+            'cost': self._handle_cost,
+            'compact': self._handle_compact,
+            'state': self._handle_state,
+            'advance': self._handle_advance,
+            'at': self._handle_at,
+            'time': self._handle_time,
+        }
+
+        self._sizes = {}
+        for size, name in LotSize.Names.iteritems():
+            self._sizes[str(size)] = size
+            self._sizes[name.lower()] = size
+
+    def run(self, lines):
+        """ Run every command in lines, any iterable of strings such as an open file, then write a summary.
+        Return a dict with the number of 'commands' run, the number of 'errors', 'elapsed' seconds and
+        'commands_per_sec'. """
+
+        handlers = self._handlers
+        output = []
+        command_count = 0
+        error_count = 0
+
+        t0 = time.time()
+        for line_no, line in enumerate(lines, 1):
+            try:
+                fields = split_command_line(line)
+                split_error = None
+            except ValueError as ex:
+                # e.g. a quote that is never closed, that is a bad command like any other.
+                fields = None
+                split_error = ex
+            else:
+                if not fields:
+                    continue
+
+            command_count += 1
+            try:
+                if split_error is not None:
+                    raise split_error
+                handler = handlers.get(fields[0].lower())
+                if handler is None:
+                    raise ValueError("unknown command " + repr(fields[0]))
+                response = handler(*fields[1:])
+            except (ValueError, TypeError, AssertionError) as ex:
+                error_count += 1
+                response = "error on line %d: %s" % (line_no, ex)
+
+            if not self._quiet:
+                output.append(response)
+                if len(output) >= self.FLUSH_EVERY:
+                    self._write(output)
+                    output = []
+
+        self._write(output)
+        elapsed = time.time() - t0
+
+        summary = {'commands': command_count, 'errors': error_count, 'elapsed': elapsed,
+                   'commands_per_sec': command_count / elapsed if elapsed else 0.0}
+        self._out.write("%d commands, %d errors in %.3f s (%.0f commands/sec)\n" % (
+            command_count, error_count, elapsed, summary['commands_per_sec']))
+        self._out.flush()
+
+        return summary
+
+    def _write(self, output):
+        if output:
+            self._out.write("\n".join(output) + "\n")
+
+    def _handle_park(self, plate, model, size):
+        if size.lower() not in self._sizes:
+            raise ValueError("unknown car size " + repr(size))
+
+        ticket_no = self._controller.park_car_and_return_ticket_number(Car(plate=plate, model=model,
+                                                                           size=self._sizes[size.lower()]))
+        if ticket_no is None:
+            return "park %s: no spot" % plate
+
+        return "park %s: ticket %d" % (plate, ticket_no)
+
+    def _handle_return(self, ticket_no):
+        car, cost = self._controller.return_car_and_get_cost_for_ticket_number(ticket_no=int(ticket_no))
+        if car is None:
+            return "return %s: invalid ticket number" % ticket_no
 
+        return "return %s: cost %s for %s" % (ticket_no, cost, car)
+
+    def _handle_cost(self, ticket_no):
+        cost = self._controller.get_cost_for_ticket_number(ticket_no=int(ticket_no))
+        if cost is None:
+            return "cost %s: invalid ticket number" % ticket_no
+
+        return "cost %s: %s" % (ticket_no, cost)
+
+    def _handle_compact(self):
+        return "compact: moved %d cars" % self._controller.compactify_parking_lot()
+
+    def _handle_state(self):
+        return str(self._controller)
+
+    def _handle_advance(self, seconds):
+        seconds = int(seconds)
+        if seconds < 0:
+            raise ValueError("can not advance time backwards")
+
+        self._clock.advance(seconds)
+        return "time: %d" % self._clock.get_time()
+
+    def _handle_at(self, now):
+        now = int(now)
+        if now < self._clock.get_exact_time():
+            raise ValueError("time %d is in the past" % now)
+
+        self._clock.set_time(now)
+        return "time: %d" % now
+
+    def _handle_time(self):
+        return "time: %d" % self._clock.get_time()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="parking lot command line ui")
+    parser.add_argument('--batch', metavar='SCRIPT', nargs='?', const='-',
+                        help="run the commands in SCRIPT, or stdin if no SCRIPT or -, instead of the menu")
+    parser.add_argument('--counts', default='3,4,10', help="small,medium,large spot counts in batch mode")
+    parser.add_argument('--rates', default='1,2,87000', help="small,medium,large hourly rates in batch mode")
+    parser.add_argument('--start-time', type=int, help="clock start in batch mode, default now")
+    parser.add_argument('--quiet', action='store_true', help="in batch mode only print the summary")
+    return parser.parse_args(argv)
+
+
+def run_batch(args):
+    counts = [int(count) for count in args.counts.split(',')]
+    rates = [int(rate) for rate in args.rates.split(',')]
+    assert 3 == len(counts) and 3 == len(rates), "--counts and --rates take 3 values each"
+
+    pc = ParkingLotController(small_count=counts[0], small_rate=rates[0], medium_count=counts[1],
+                              medium_rate=rates[1], large_count=counts[2], large_rate=rates[2])
+
+    runner = BatchRunner(pc, quiet=args.quiet, start_time=args.start_time)
+    if '-' == args.batch:
+        runner.run(sys.stdin)
+    else:
+        with open(args.batch) as script:
+            runner.run(script)
 
 
 
@@ -172,6 +374,11 @@ if '__main__' == __name__:
     #c1 = Car(plate='ZXw21', model='horse', size=LotSize.LARGE)
     #print str(c1)
 
+    args = parse_args(sys.argv[1:])
+    if args.batch is not None:
+        run_batch(args)
+        sys.exit(0)
+
     cmd_ui = ParkingLotCMDUI()
     try:
         cmd_ui.mainloop()
@@ -179,4 +386,3 @@ if '__main__' == __name__:
         pass
 
     print "Exiting"
-
@@ -0,0 +1,229 @@
+""" Run many facilities, one ParkingLotController each, spread over a pool of worker processes so they are not
+all stuck behind one GIL.
+
+A FacilityRouter owns the workers. Requests are routed to the worker that owns the facility, and are batched:
+submit() only queues a request, flush() sends every worker one message with all its queued requests, lets the
+workers run them in parallel, and gathers the results.
+
+    router = FacilityRouter([('downtown', (0, 0), {...controller kwargs...}), ...])
+    router.submit('downtown', 'park', 'AAA 4001', 'horse', LotSize.MEDIUM)
+    router.submit('airport', 'cost', 1004)
+    ticket_no, cost = router.flush()
+"""
+
+import math
+import multiprocessing
+
+from parkinglot import Car, LotSize, ParkingLotController
+
+
+class FacilityError(Exception):
+    """ A request failed in the worker that owns the facility. """
+    pass
+
+
+def _run_request(controllers, facility_id, op, args):
+    """ Run one request against the controller of facility_id and return its result. Cars go over the wire
+    as (plate, model, size) tuples. """
+
+    controller = controllers[facility_id]
+
+    if 'park' == op:
+        plate, model, size = args
+        return controller.park_car_and_return_ticket_number(Car(plate=plate, model=model, size=size))
+
+    if 'park_many' == op:
+        return controller.park_cars(Car(plate=plate, model=model, size=size) for plate, model, size in args[0])
+
+    if 'return' == op:
+        car, cost = controller.return_car_and_get_cost_for_ticket_number(ticket_no=args[0])
+        if car is None:
+            return None
+        return (car.get_plate(), car.get_model(), car.get_size(), cost)
+
+    if 'cost' == op:
+        return controller.get_cost_for_ticket_number(ticket_no=args[0])
+
+    if 'compact' == op:
+        return controller.compactify_parking_lot()
+
+    if 'free_spots' == op:
+        # a walk-in can not park in spots held for reservations.
+        return controller.availability()[args[0]] - controller.held_spots()[args[0]]
+
+    raise ValueError("unknown facility request: " + repr(op))
+
+
+def _worker_main(conn, facilities):
+    """ Worker process loop: build the controllers of the given facilities, then answer batches of
+    (facility_id, op, args) requests with lists of (ok, result) until a None batch arrives. """
+
+    controllers = dict((facility_id, ParkingLotController(**controller_kwargs))
+                       for facility_id, controller_kwargs in facilities)
+
+    while True:
+        batch = conn.recv()
+        if batch is None:
+            break
+
+        results = []
+        for facility_id, op, args in batch:
+            try:
+                results.append((True, _run_request(controllers, facility_id, op, args)))
+            except Exception as ex:
+                results.append((False, repr(ex)))
+
+        conn.send(results)
+
+    conn.close()
+
+
+class FacilityRouter(object):
+    """ Owns the controllers of many facilities spread over worker processes, routes requests to them by
+    facility id, and answers queries across all facilities. """
+
+    def __init__(self, facilities, worker_count=None):
+        """ facilities is a list of (facility_id, location, controller_kwargs), where location is an (x, y)
+        tuple and controller_kwargs the keyword arguments of the facility's ParkingLotController. Facilities are
+        spread round robin over worker_count processes, by default one per core. """
+
+        super(FacilityRouter, self).__init__()
+
+        if worker_count is None:
+            worker_count = multiprocessing.cpu_count()
+        worker_count = max(1, min(worker_count, len(facilities)))
+
+        self._locations = {}
+        self._worker_of = {}
+        assigned = [[] for _ in xrange(worker_count)]
+
+        for idx, (facility_id, location, controller_kwargs) in enumerate(facilities):
+            assert facility_id not in self._locations, "duplicate facility id " + repr(facility_id)
+
+            self._locations[facility_id] = location
+            self._worker_of[facility_id] = idx % worker_count
+            assigned[idx % worker_count].append((facility_id, controller_kwargs))
+
+        self._conns = []
+        self._workers = []
+        for facilities_of_worker in assigned:
+            parent_conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_worker_main, args=(child_conn, facilities_of_worker))
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+
+            self._conns.append(parent_conn)
+            self._workers.append(worker)
+
+        # queued requests per worker, and for each one its position in the results of the next flush().
+        self._queued = [[] for _ in xrange(worker_count)]
+        self._queued_slots = [[] for _ in xrange(worker_count)]
+        self._queued_count = 0
+
+    def get_facility_ids(self):
+        return self._locations.keys()
+
+    def get_worker_count(self):
+        return len(self._workers)
+
+    def submit(self, facility_id, op, *args):
+        """ Queue a request for facility_id. op is one of 'park' (plate, model, size), 'park_many' (list of
+        (plate, model, size)), 'return' (ticket_no), 'cost' (ticket_no), 'compact' or 'free_spots' (size).
+        Return the position of its result in the list the next flush() returns. """
+
+        worker = self._worker_of[facility_id]
+        self._queued[worker].append((facility_id, op, args))
+        self._queued_slots[worker].append(self._queued_count)
+        self._queued_count += 1
+        return self._queued_count - 1
+
+    def flush(self):
+        """ Run every queued request and return their results in submission order. Every worker gets all its
+        requests in one message and they all run at the same time. Raise FacilityError if any request failed,
+        after all the others have run. """
+
+        results = [None] * self._queued_count
+        busy = []
+
+        for worker, batch in enumerate(self._queued):
+            if batch:
+                self._conns[worker].send(batch)
+                busy.append(worker)
+
+        errors = []
+        for worker in busy:
+            for slot, (ok, result) in zip(self._queued_slots[worker], self._conns[worker].recv()):
+                if ok:
+                    results[slot] = result
+                else:
+                    errors.append(result)
+
+        self._queued = [[] for _ in self._workers]
+        self._queued_slots = [[] for _ in self._workers]
+        self._queued_count = 0
+
+        if errors:
+            raise FacilityError("%d request(s) failed, first: %s" % (len(errors), errors[0]))
+
+        return results
+
+    def execute(self, requests):
+        """ Run a list of (facility_id, op, arg, ...) requests as one batch and return their results. """
+
+        assert 0 == self._queued_count, "flush() queued requests first"
+
+        for request in requests:
+            self.submit(*request)
+
+        return self.flush()
+
+    def park_car_and_return_ticket_number(self, facility_id, car):
+        return self.execute([(facility_id, 'park', car.get_plate(), car.get_model(), car.get_size())])[0]
+
+    def return_car_and_get_cost_for_ticket_number(self, facility_id, ticket_no):
+        result = self.execute([(facility_id, 'return', ticket_no)])[0]
+        if result is None:
+            return (None, None)
+
+        plate, model, size, cost = result
+        return (Car(plate=plate, model=model, size=size), cost)
+
+    def get_cost_for_ticket_number(self, facility_id, ticket_no):
+        return self.execute([(facility_id, 'cost', ticket_no)])[0]
+
+    def compactify_parking_lot(self, facility_id):
+        return self.execute([(facility_id, 'compact')])[0]
+
+    def find_nearest_facility_with_space(self, size, location):
+        """ Return the id of the facility closest to location, an (x, y) tuple, with a free spot for a car of the
+        given size, or None if every facility is full. Asks all workers at once. """
+
+        assert size in LotSize.Sizes
+
+        facility_ids = self._locations.keys()
+        free_spots = self.execute([(facility_id, 'free_spots', size) for facility_id in facility_ids])
+
+        best = None
+        best_distance = None
+        for facility_id, free in zip(facility_ids, free_spots):
+            if free <= 0:
+                continue
+
+            x, y = self._locations[facility_id]
+            distance = math.hypot(x - location[0], y - location[1])
+            if best is None or distance < best_distance:
+                best = facility_id
+                best_distance = distance
+
+        return best
+
+    def close(self):
+        """ Stop every worker process. """
+
+        for conn in self._conns:
+            conn.send(None)
+        for worker in self._workers:
+            worker.join()
+        for conn in self._conns:
+            conn.close()
@@ -0,0 +1,314 @@
+""" Network gate server in front of a ParkingLotController, and client libraries to talk to it.
+
+The protocol is line based. A request is one line of tab separated fields, the command first:
+
+    PARK <plate> <model> <size>     ->  OK <ticket no>                      or FULL
+    RETURN <ticket no>              ->  OK <cost> <plate> <model> <size>    or INVALID
+    COST <ticket no>                ->  OK <cost>                           or INVALID
+    STATE                           ->  DATA <byte count>, then that many bytes of str(controller)
+    COMPACT                         ->  OK <number of cars moved>
+
+anything else is answered with ERR <message>. Responses come back in request order, so a gate can pipeline as
+many requests as it likes on one connection without waiting for each response.
+
+Python 2.7 has no asyncio, so the server and the async client are built on asyncore/asynchat.
+"""
+
+import asynchat
+import asyncore
+import collections
+import socket
+import sys
+
+from parkinglot import Car, ParkingLotController
+
+
+TERMINATOR = '\n'
+SEPARATOR = '\t'
+
+
+def format_request(command, *fields):
+    """ Return the wire format of a request line. Fields must not contain tabs or newlines. """
+
+    return SEPARATOR.join([command] + [str(field) for field in fields]) + TERMINATOR
+
+
+def decode_response(command, fields):
+    """ Turn the fields of a response to command into the value the matching controller method would return. """
+
+    status = fields[0]
+
+    if 'ERR' == status:
+        raise ValueError("gate server error: " + SEPARATOR.join(fields[1:]))
+
+    if 'PARK' == command:
+        return int(fields[1]) if 'OK' == status else None
+
+    if 'RETURN' == command:
+        if 'OK' != status:
+            return (None, None)
+        return (Car(plate=fields[2], model=fields[3], size=int(fields[4])), float(fields[1]))
+
+    if 'COST' == command:
+        return float(fields[1]) if 'OK' == status else None
+
+    if 'COMPACT' == command:
+        return int(fields[1])
+
+    raise ValueError("unknown command: " + str(command))
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+#-----------------------------------------------------------------------------------------------------------------------
+#---------------------------------------------------------------------------------------------------------------- server
+class GateChannel(asynchat.async_chat):
+    """ Serve one gate connection. Every complete request line read from the socket is handled right away, and
+    the responses to all the requests of one read are sent back together. """
+
+    def __init__(self, sock, controller, channel_map):
+        asynchat.async_chat.__init__(self, sock=sock, map=channel_map)
+
+        self._controller = controller
+        self._incoming = []
+        self._outgoing = []
+        self.set_terminator(TERMINATOR)
+
+        self._handlers = {
+            'PARK': self._handle_park,
+            'RETURN': self._handle_return,
+            'COST': self._handle_cost,
+            'STATE': self._handle_state,
+            'COMPACT': self._handle_compact,
+        }
+
+    def collect_incoming_data(self, data):
+        self._incoming.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self._incoming).rstrip('\r')
+        self._incoming = []
+
+        fields = line.split(SEPARATOR)
+        handler = self._handlers.get(fields[0])
+
+        if handler is None:
+            response = format_request('ERR', 'unknown command ' + repr(fields[0]))
+        else:
+            try:
+                response = handler(fields[1:])
+            except (ValueError, TypeError, IndexError, AssertionError) as ex:
+                response = format_request('ERR', 'bad request ' + repr(line) + ' ' + repr(ex))
+
+        self._outgoing.append(response)
+
+    def handle_read(self):
+        asynchat.async_chat.handle_read(self)
+
+        # one send for all the pipelined requests that came in with this read.
+        if self._outgoing:
+            self.push(''.join(self._outgoing))
+            self._outgoing = []
+
+    def _handle_park(self, args):
+        plate, model, size = args
+        ticket_no = self._controller.park_car_and_return_ticket_number(Car(plate=plate, model=model,
+                                                                           size=int(size)))
+        if ticket_no is None:
+            return format_request('FULL')
+
+        return format_request('OK', ticket_no)
+
+    def _handle_return(self, args):
+        car, cost = self._controller.return_car_and_get_cost_for_ticket_number(ticket_no=int(args[0]))
+        if car is None:
+            return format_request('INVALID')
+
+        return format_request('OK', repr(cost), car.get_plate(), car.get_model(), car.get_size())
+
+    def _handle_cost(self, args):
+        cost = self._controller.get_cost_for_ticket_number(ticket_no=int(args[0]))
+        if cost is None:
+            return format_request('INVALID')
+
+        return format_request('OK', repr(cost))
+
+    def _handle_state(self, args):
+        state = str(self._controller)
+        return format_request('DATA', len(state)) + state
+
+    def _handle_compact(self, args):
+        return format_request('OK', self._controller.compactify_parking_lot())
+
+
+class GateServer(asyncore.dispatcher):
+    """ Accept gate connections for a ParkingLotController on a TCP port. """
+
+    def __init__(self, controller, host='127.0.0.1', port=0, channel_map=None):
+        """ Listen on host and port, port 0 picks a free port (see get_port()). Connections are served from
+        channel_map, by default a private one, so several servers can run in one process. """
+
+        self._map = {} if channel_map is None else channel_map
+        asyncore.dispatcher.__init__(self, map=self._map)
+
+        self._controller = controller
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(1024)
+
+    def get_port(self):
+        """ Return the TCP port this server is listening on. """
+
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+
+        sock, _ = pair
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        GateChannel(sock, self._controller, self._map)
+
+    def serve_forever(self, timeout=1.0):
+        """ Serve connections until the server is closed. """
+
+        asyncore.loop(timeout=timeout, use_poll=True, map=self._map)
+
+
+#-----------------------------------------------------------------------------------------------------------------------
+#-----------------------------------------------------------------------------------------------------------------------
+#--------------------------------------------------------------------------------------------------------------- clients
+class GateClient(object):
+    """ Blocking client with the same API as ParkingLotController. Use pipeline() to send many requests in one
+    round trip. """
+
+    def __init__(self, host, port):
+        super(GateClient, self).__init__()
+
+        self._sock = socket.create_connection((host, port))
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self._sock.makefile('rb')
+
+    def close(self):
+        self._reader.close()
+        self._sock.close()
+
+    def pipeline(self, requests):
+        """ Send every request, a tuple of (command, field, ...), in one go and then read all the responses.
+        Return the list of decoded responses in request order. If the server answered any request with ERR, raise
+        ValueError for the first one, but only after every response is read, so the connection stays usable. """
+
+        requests = list(requests)
+        self._sock.sendall(''.join(format_request(*request) for request in requests))
+
+        responses = [self._read_response() for _ in requests]
+        return [self._decode(request[0], fields) for request, fields in zip(requests, responses)]
+
+    def _read_response(self):
+        """ Read one response off the socket and return its fields. The fields of a DATA response are 'DATA' and
+        the data. """
+
+        fields = self._reader.readline().rstrip('\r\n').split(SEPARATOR)
+
+        if 'DATA' == fields[0]:
+            return ['DATA', self._reader.read(int(fields[1]))]
+
+        return fields
+
+    def _decode(self, command, fields):
+        if 'DATA' == fields[0]:
+            return fields[1]
+
+        return decode_response(command, fields)
+
+    def park_car_and_return_ticket_number(self, car):
+        return self.pipeline([('PARK', car.get_plate(), car.get_model(), car.get_size())])[0]
+
+    def return_car_and_get_cost_for_ticket_number(self, ticket_no):
+        return self.pipeline([('RETURN', ticket_no)])[0]
+
+    def get_cost_for_ticket_number(self, ticket_no):
+        return self.pipeline([('COST', ticket_no)])[0]
+
+    def compactify_parking_lot(self):
+        return self.pipeline([('COMPACT',)])[0]
+
+    def get_state(self):
+        return self.pipeline([('STATE',)])[0]
+
+
+class AsyncGateClient(asynchat.async_chat):
+    """ Non blocking client for use in an asyncore loop. request() queues a request and returns right away, the
+    callback gets the decoded response once it arrives. Any number of requests can be in flight at once. """
+
+    def __init__(self, host, port, channel_map=None):
+        asynchat.async_chat.__init__(self, map=channel_map)
+
+        self._incoming = []
+
+        # callbacks and commands of the requests in flight, oldest first.
+        self._pending = collections.deque()
+        self._data_command = None
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.set_terminator(TERMINATOR)
+        self.connect((host, port))
+
+    def request(self, callback, command, *fields):
+        """ Send a request. callback is called with the decoded response, or with the ValueError decoding it
+        raised if the server answered ERR. Either way the channel stays open for the requests behind it. """
+
+        self._pending.append((command, callback))
+        self.push(format_request(command, *fields))
+
+    def get_in_flight_count(self):
+        return len(self._pending)
+
+    def collect_incoming_data(self, data):
+        self._incoming.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self._incoming)
+        self._incoming = []
+
+        if self._data_command is not None:
+            # this was the payload of a DATA response.
+            self._data_command = None
+            self.set_terminator(TERMINATOR)
+            _, callback = self._pending.popleft()
+            callback(data)
+            return
+
+        fields = data.rstrip('\r').split(SEPARATOR)
+
+        if 'DATA' == fields[0]:
+            self._data_command = self._pending[0][0]
+            self.set_terminator(int(fields[1]))
+            return
+
+        command, callback = self._pending.popleft()
+        try:
+            response = decode_response(command, fields)
+        except ValueError as e:
+            response = e
+        callback(response)
+
+    def handle_connect(self):
+        pass
+
+
+if '__main__' == __name__:
+    # serve the same sample lot as cmdui. usage: python gateserver.py [port]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8700
+    pc = ParkingLotController(small_count=3, small_rate=1, medium_count=4, medium_rate=2, large_count=10,
+                              large_rate=87000)
+    server = GateServer(pc, host='127.0.0.1', port=port)
+    print "gate server listening on port " + str(server.get_port())
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
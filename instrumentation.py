@@ -0,0 +1,231 @@
+""" Opt in instrumentation of the hot paths of a ParkingLotController.
+
+While enabled, calls to the public park, return, cost and compactify methods of one controller, and to
+find_spot_and_park of its lot groups, are counted and timed into fixed bucket latency histograms. Every park also
+counts the spots it tried to claim: the placement index hands a park the right lot group right away, so a park
+that needs more than one claim lost a race for the last spot of a lot group to another thread. Enabling wraps those
+methods with instance attributes of the same name, and disabling deletes them again, so a controller that is not
+instrumented runs exactly the code it always did.
+
+    instrumentation = Instrumentation(pc)
+    instrumentation.enable()
+    ...
+    print instrumentation.dump()
+    instrumentation.reset()
+
+Counters are plain ints updated without locks. With a concurrent controller a few updates may be lost under
+contention, which is fine for what they are for.
+"""
+
+import threading
+import time
+
+
+# latency bucket i counts calls that took less than 2**i microseconds (and at least 2**(i-1)), the last bucket
+# counts everything slower.
+BUCKET_COUNT = 32
+
+# bucket i of the claim histogram counts parks that tried to claim a spot i times, the last bucket counts everything
+# more.
+CLAIM_BUCKET_COUNT = 16
+
+INSTRUMENTED_METHODS = ['park_car_and_return_ticket_number', 'return_car_and_get_cost_for_ticket_number',
+                        'get_cost_for_ticket_number', 'compactify_parking_lot']
+
+FIND_SPOT = 'find_spot_and_park'
+
+
+def _latency_bucket(seconds):
+    bucket = int(seconds * 1e6).bit_length()
+    return bucket if bucket < BUCKET_COUNT else BUCKET_COUNT - 1
+
+
+def _histogram_percentile(histogram, pct):
+    """ Return the upper bound in microseconds of the bucket that holds the pct percentile of histogram. """
+
+    total = sum(histogram)
+    if 0 == total:
+        return 0
+
+    rank = total * pct / 100.0
+    running = 0
+    for bucket, count in enumerate(histogram):
+        running += count
+        if running >= rank:
+            return 2 ** bucket
+
+    return 2 ** (len(histogram) - 1)
+
+
+class OperationStats(object):
+    """ Counters of one instrumented method. """
+
+    __slots__ = ('calls', 'rejections', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.rejections = 0
+        self.histogram = [0] * BUCKET_COUNT
+
+    def snapshot(self):
+        return {'calls': self.calls, 'rejections': self.rejections, 'histogram': list(self.histogram),
+                'p50_us': _histogram_percentile(self.histogram, 50),
+                'p90_us': _histogram_percentile(self.histogram, 90),
+                'p99_us': _histogram_percentile(self.histogram, 99)}
+
+
+def _is_rejection(op, result):
+    """ Return True if result of op means the request was turned down: no spot, or an invalid ticket. """
+
+    if 'return_car_and_get_cost_for_ticket_number' == op:
+        return result[0] is None
+
+    if 'compactify_parking_lot' == op:
+        return False
+
+    return result is None
+
+
+class Instrumentation(object):
+    """ Counters, latency histograms, spot claims per park and relocations of one controller. """
+
+    def __init__(self, controller):
+        super(Instrumentation, self).__init__()
+
+        self._controller = controller
+        self._enabled = False
+
+        # the claim counter of the park running in this thread, if any. see _wrap_find_spot().
+        self._local = threading.local()
+
+        self.reset()
+
+    def is_enabled(self):
+        return self._enabled
+
+    def enable(self):
+        """ Start instrumenting the controller. """
+
+        if self._enabled:
+            return
+
+        for op in INSTRUMENTED_METHODS:
+            setattr(self._controller, op, self._wrap(op, getattr(self._controller, op)))
+
+        for lot_group in self._controller._lot_groups:
+            setattr(lot_group, FIND_SPOT, self._wrap_find_spot(getattr(lot_group, FIND_SPOT)))
+
+        self._enabled = True
+
+    def disable(self):
+        """ Stop instrumenting the controller and put back its original methods. Counters are kept. """
+
+        if not self._enabled:
+            return
+
+        for op in INSTRUMENTED_METHODS:
+            delattr(self._controller, op)
+
+        for lot_group in self._controller._lot_groups:
+            delattr(lot_group, FIND_SPOT)
+
+        self._enabled = False
+
+    def reset(self):
+        """ Zero every counter. """
+
+        self._stats = dict((op, OperationStats()) for op in INSTRUMENTED_METHODS + [FIND_SPOT])
+        self._claim_histogram = [0] * CLAIM_BUCKET_COUNT
+        self._relocations = 0
+
+    def _wrap(self, op, method):
+        timer = time.time
+        is_park = 'park_car_and_return_ticket_number' == op
+
+        def instrumented(*args, **kwargs):
+            # look the counters up on every call, reset() replaces them.
+            stats = self._stats[op]
+
+            if not is_park:
+                t0 = timer()
+                result = method(*args, **kwargs)
+                elapsed = timer() - t0
+            else:
+                # a counter of this call only, so parks running in other threads do not add to it.
+                claims = [0]
+                self._local.claims = claims
+                t0 = timer()
+                try:
+                    result = method(*args, **kwargs)
+                finally:
+                    self._local.claims = None
+                elapsed = timer() - t0
+                self._claim_histogram[min(claims[0], CLAIM_BUCKET_COUNT - 1)] += 1
+
+            stats.calls += 1
+            stats.histogram[_latency_bucket(elapsed)] += 1
+            if _is_rejection(op, result):
+                stats.rejections += 1
+
+            if 'compactify_parking_lot' == op:
+                self._relocations += result
+
+            return result
+
+        instrumented.__name__ = method.__name__
+        instrumented.__doc__ = method.__doc__
+        return instrumented
+
+    def _wrap_find_spot(self, method):
+        timer = time.time
+
+        def instrumented(car):
+            # look the counters up on every call, reset() replaces them.
+            stats = self._stats[FIND_SPOT]
+            claims = getattr(self._local, 'claims', None)
+            if claims is not None:
+                claims[0] += 1
+
+            t0 = timer()
+            lot_id = method(car)
+            elapsed = timer() - t0
+
+            stats.calls += 1
+            stats.histogram[_latency_bucket(elapsed)] += 1
+            if lot_id is None:
+                stats.rejections += 1
+
+            return lot_id
+
+        instrumented.__name__ = method.__name__
+        instrumented.__doc__ = method.__doc__
+        return instrumented
+
+    def snapshot(self):
+        """ Return a dict of everything counted since the last reset:
+            'operations': dict of method name to a dict of 'calls', 'rejections' (None results: no spot or invalid
+                          ticket), 'histogram' (list of counts, see BUCKET_COUNT) and 'p50_us', 'p90_us', 'p99_us'
+                          (bucket upper bounds, so accurate to a factor of 2).
+            'claims_per_park': histogram of find_spot_and_park calls per park, see CLAIM_BUCKET_COUNT.
+            'relocations': number of cars moved by compactify_parking_lot. """
+
+        return {'operations': dict((op, stats.snapshot()) for op, stats in self._stats.iteritems()),
+                'claims_per_park': list(self._claim_histogram),
+                'relocations': self._relocations}
+
+    def dump(self):
+        """ Return the snapshot as plain text. """
+
+        snapshot = self.snapshot()
+
+        lines = ["%-42s %10s %10s %9s %9s %9s" % ("operation", "calls", "rejected", "p50 us", "p90 us", "p99 us")]
+        for op in INSTRUMENTED_METHODS + [FIND_SPOT]:
+            stats = snapshot['operations'][op]
+            lines.append("%-42s %10d %10d %9d %9d %9d" % (op, stats['calls'], stats['rejections'], stats['p50_us'],
+                                                          stats['p90_us'], stats['p99_us']))
+
+        lines.append("relocations: %d" % snapshot['relocations'])
+        lines.append("spot claims per park: " + ", ".join(
+            "%d: %d" % (claims, count) for claims, count in enumerate(snapshot['claims_per_park']) if count))
+
+        return "\n".join(lines)
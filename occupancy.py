@@ -0,0 +1,328 @@
+""" Publish the occupancy of a ParkingLotController in a shared memory segment that other processes read without
+ever talking to the controller.
+
+The segment is a file, best put on a memory backed file system like /dev/shm, that the controller process and
+any number of reader processes mmap. It holds one bit per spot, set while the spot is taken, and the number of
+taken spots of every lot group:
+
+    header              magic, version, lot group count
+    lot group table     per lot group: size class, spot count, bitmap offset, taken spot count
+    bitmaps             per lot group, one bit per spot, lot_id 0 in the lowest bit of the first byte
+
+The version is a seqlock. The publisher makes it odd before it changes anything and even again after, so a reader
+that read the same even version before and after copying what it wanted knows no change ran in between.
+
+    publisher = OccupancyPublisher('/dev/shm/garage.occupancy')     # controller process
+    publisher.attach(pc)
+
+    reader = OccupancyReader('/dev/shm/garage.occupancy')           # any other process
+    print reader.read_counts()
+    snapshot = reader.snapshot()
+    print snapshot.is_occupied(0, 17)
+"""
+
+import mmap
+import os
+import struct
+import time
+
+
+_MAGIC = 'PLOCC001'
+# magic, version, lot group count.
+_HEADER = struct.Struct('<8sQQ')
+_VERSION_OFFSET = 8
+_VERSION = struct.Struct('<Q')
+# size class, spot count, bitmap offset, taken spot count.
+_GROUP = struct.Struct('<QQQQ')
+_COUNT_OFFSET = 24
+_COUNT = struct.Struct('<Q')
+
+
+def _bitmap_size(spot_count):
+    """ Return the bytes a bitmap of spot_count spots takes, rounded up to a multiple of 8. """
+
+    return ((spot_count + 63) // 64) * 8
+
+
+class OccupancyPublisher(object):
+    """ Keep the occupancy segment at path up to date with a controller. The publisher is a controller listener,
+    so the segment changes right along with the controller, and only ever from one thread at a time: listeners
+    are called under the controller's index lock. """
+
+    def __init__(self, path):
+        super(OccupancyPublisher, self).__init__()
+
+        self._path = path
+        self._controller = None
+        self._mmap = None
+        self._version = 0
+
+        # ticket number -> (lot group index, lot_id). returns and relocations only name the ticket.
+        self._spots = {}
+        # (lot group index, lot_id) -> ticket number, so a ticket only ever clears a spot it still holds.
+        self._owners = {}
+        self._occupied = []
+        self._group_offsets = []
+        self._bitmap_offsets = []
+
+    def get_path(self):
+        return self._path
+
+    def attach(self, controller):
+        """ Create the segment for controller, fill it in with the cars parked right now and keep it up to date
+        from then on. The segment shows up at path complete, readers never see it half written. """
+
+        assert self._controller is None
+
+        lot_groups = controller._lot_groups
+        group_count = len(lot_groups)
+
+        # header and lot group entries are multiples of 8 bytes, so every bitmap starts 8 byte aligned.
+        size = _HEADER.size + group_count * _GROUP.size
+        for lot_group in lot_groups:
+            self._group_offsets.append(_HEADER.size + len(self._bitmap_offsets) * _GROUP.size)
+            self._bitmap_offsets.append(size)
+            size += _bitmap_size(lot_group.get_spot_count())
+
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w+b') as segment_file:
+            segment_file.truncate(size)
+            self._mmap = mmap.mmap(segment_file.fileno(), size)
+
+        _HEADER.pack_into(self._mmap, 0, _MAGIC, 0, group_count)
+        for lot_group, group_offset, bitmap_offset in zip(lot_groups, self._group_offsets, self._bitmap_offsets):
+            _GROUP.pack_into(self._mmap, group_offset, lot_group.get_size_class(), lot_group.get_spot_count(),
+                             bitmap_offset, 0)
+        self._occupied = [0] * group_count
+
+        # listen first and then fill in from the spot index, under the index lock so no change can slip in
+        # between. changes heard before that are simply overwritten.
+        self._controller = controller
+        controller.add_listener(self)
+        with controller._index_lock:
+            self._fill(controller)
+
+        os.rename(tmp_path, self._path)
+
+    def _fill(self, controller):
+        """ Rewrite the whole segment from the spot index of controller. Call with its index lock held. """
+
+        mm = self._mmap
+        self._begin_write()
+
+        self._spots = {}
+        self._owners = {}
+        for group_idx, spot_index in enumerate(controller._spot_index):
+            bitmap_offset = self._bitmap_offsets[group_idx]
+            bitmap = bytearray(_bitmap_size(controller._lot_groups[group_idx].get_spot_count()))
+            for lot_id, ticket_no in spot_index.iteritems():
+                bitmap[lot_id >> 3] |= 1 << (lot_id & 7)
+                self._spots[ticket_no] = (group_idx, lot_id)
+                self._owners[(group_idx, lot_id)] = ticket_no
+
+            mm[bitmap_offset:bitmap_offset + len(bitmap)] = str(bitmap)
+            self._occupied[group_idx] = len(spot_index)
+            _COUNT.pack_into(mm, self._group_offsets[group_idx] + _COUNT_OFFSET, len(spot_index))
+
+        self._end_write()
+
+    def detach(self):
+        """ Stop updating the segment. It stays as it is for readers. """
+
+        if self._controller is not None:
+            self._controller.remove_listener(self)
+            self._controller = None
+
+    def close(self):
+        """ Stop updating the segment and remove it. Readers that have it open can keep reading the last state. """
+
+        self.detach()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            os.unlink(self._path)
+
+    def _begin_write(self):
+        self._version += 1
+        _VERSION.pack_into(self._mmap, _VERSION_OFFSET, self._version)
+
+    def _end_write(self):
+        self._version += 1
+        _VERSION.pack_into(self._mmap, _VERSION_OFFSET, self._version)
+
+    def _set_spot(self, group_idx, lot_id, taken):
+        mm = self._mmap
+        pos = self._bitmap_offsets[group_idx] + (lot_id >> 3)
+        if taken:
+            mm[pos] = chr(ord(mm[pos]) | (1 << (lot_id & 7)))
+            self._occupied[group_idx] += 1
+        else:
+            mm[pos] = chr(ord(mm[pos]) & ~(1 << (lot_id & 7)) & 0xFF)
+            self._occupied[group_idx] -= 1
+
+        _COUNT.pack_into(mm, self._group_offsets[group_idx] + _COUNT_OFFSET, self._occupied[group_idx])
+
+    def _take_spot(self, ticket_no, spot):
+        """ Record that ticket_no holds spot and set its bit. Call between _begin_write and _end_write. """
+
+        self._spots[ticket_no] = spot
+        if self._owners.get(spot) is None:
+            self._set_spot(spot[0], spot[1], True)
+        self._owners[spot] = ticket_no
+
+    def _give_up_spot(self, ticket_no):
+        """ Forget the spot of ticket_no and clear its bit, unless another ticket has taken the spot since.
+        Call between _begin_write and _end_write. """
+
+        spot = self._spots.pop(ticket_no, None)
+        if spot is not None and self._owners.get(spot) == ticket_no:
+            del self._owners[spot]
+            self._set_spot(spot[0], spot[1], False)
+
+    def on_park(self, ticket_no, car, lot_group_index, lot_id, now):
+        self._begin_write()
+        self._take_spot(ticket_no, (lot_group_index, lot_id))
+        self._end_write()
+
+    def on_return(self, ticket_no, now):
+        if ticket_no not in self._spots:
+            return
+
+        self._begin_write()
+        self._give_up_spot(ticket_no)
+        self._end_write()
+
+    def on_relocate(self, ticket_no, lot_group_index, lot_id, now):
+        # one write for both spots, a reader never sees the car in two spots or in none.
+        self._begin_write()
+        self._give_up_spot(ticket_no)
+        self._take_spot(ticket_no, (lot_group_index, lot_id))
+        self._end_write()
+
+
+class OccupancySnapshot(object):
+    """ A consistent copy of an occupancy segment. """
+
+    def __init__(self, version, size_classes, spot_counts, occupied, bitmaps):
+        super(OccupancySnapshot, self).__init__()
+
+        self.version = version
+        self.size_classes = size_classes
+        self.spot_counts = spot_counts
+        self.occupied = occupied
+        self.bitmaps = bitmaps
+
+    def is_occupied(self, group_idx, lot_id):
+        assert 0 <= lot_id < self.spot_counts[group_idx]
+
+        return bool(ord(self.bitmaps[group_idx][lot_id >> 3]) & (1 << (lot_id & 7)))
+
+    def get_free_count(self, group_idx):
+        return self.spot_counts[group_idx] - self.occupied[group_idx]
+
+    def count_bits(self, group_idx):
+        """ Return the number of taken spots in the bitmap of a lot group. Always equals occupied[group_idx], this
+        is for checking. """
+
+        bitmap = self.bitmaps[group_idx]
+        return bin(int(bitmap.encode('hex'), 16)).count('1') if bitmap else 0
+
+
+class OccupancyReader(object):
+    """ Read only view of an occupancy segment, for use in any process. Reads never block the publisher, they
+    retry instead if a change ran while they copied. """
+
+    # a reader gives up if the segment stays mid change for longer than this many seconds, which only happens if
+    # the controller process died in the middle of a change.
+    STALL_TIMEOUT = 1.0
+
+    def __init__(self, path):
+        super(OccupancyReader, self).__init__()
+
+        with open(path, 'rb') as segment_file:
+            self._mmap = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, _, group_count = _HEADER.unpack_from(self._mmap, 0)
+        if _MAGIC != magic:
+            raise ValueError("not a parking lot occupancy segment: " + path)
+
+        # everything but the counts and the bits is written once before the segment shows up.
+        self._group_count = group_count
+        self._size_classes = []
+        self._spot_counts = []
+        self._bitmap_ranges = []
+        for group_idx in xrange(group_count):
+            size_class, spot_count, bitmap_offset, _ = _GROUP.unpack_from(self._mmap,
+                                                                          _HEADER.size + group_idx * _GROUP.size)
+            self._size_classes.append(size_class)
+            self._spot_counts.append(spot_count)
+            self._bitmap_ranges.append((bitmap_offset, bitmap_offset + (spot_count + 7) // 8))
+
+        self._counts = struct.Struct('<' + 'QQQQ' * group_count)
+
+        # number of reads that had to be retried because a change ran at the same time.
+        self.retries = 0
+
+    def close(self):
+        self._mmap.close()
+
+    def get_size_classes(self):
+        return list(self._size_classes)
+
+    def get_spot_counts(self):
+        return list(self._spot_counts)
+
+    def _read(self, copy):
+        """ Return (version, copy()) with copy() run while no change was in progress. """
+
+        mm = self._mmap
+        version_struct = _VERSION
+        deadline = None
+        while True:
+            version = version_struct.unpack_from(mm, _VERSION_OFFSET)[0]
+            if not version & 1:
+                data = copy()
+                if version_struct.unpack_from(mm, _VERSION_OFFSET)[0] == version:
+                    return version, data
+
+            self.retries += 1
+            if deadline is None:
+                deadline = time.time() + self.STALL_TIMEOUT
+            elif time.time() > deadline:
+                raise RuntimeError("occupancy segment has been mid change for %.1f seconds" % self.STALL_TIMEOUT)
+
+            # let a publisher thread of this process finish its change.
+            time.sleep(0)
+
+    def get_version(self):
+        """ Return the version of the segment, it goes up with every change. """
+
+        return _VERSION.unpack_from(self._mmap, _VERSION_OFFSET)[0] // 2
+
+    def read_counts(self):
+        """ Return the list of taken spot counts of the lot groups, all as of the same moment. Only the lot group
+        table is read, not the bitmaps. """
+
+        _, fields = self._read(lambda: self._counts.unpack_from(self._mmap, _HEADER.size))
+        return list(fields[3::4])
+
+    def is_occupied(self, group_idx, lot_id):
+        """ Return True if spot lot_id of lot group group_idx is taken. """
+
+        assert 0 <= lot_id < self._spot_counts[group_idx]
+
+        pos = self._bitmap_ranges[group_idx][0] + (lot_id >> 3)
+        _, byte = self._read(lambda: self._mmap[pos])
+        return bool(ord(byte) & (1 << (lot_id & 7)))
+
+    def snapshot(self):
+        """ Return an OccupancySnapshot of every count and bit as of the same moment. The whole segment is copied
+        in one go, then taken apart. """
+
+        mm = self._mmap
+        version, data = self._read(lambda: mm[:])
+
+        fields = self._counts.unpack_from(data, _HEADER.size)
+        bitmaps = [data[start:end] for start, end in self._bitmap_ranges]
+        return OccupancySnapshot(version // 2, list(self._size_classes), list(self._spot_counts),
+                                 list(fields[3::4]), bitmaps)
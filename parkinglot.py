@@ -1,9 +1,18 @@
 
 
+import bisect
+import collections
+import csv
+import heapq
+import itertools
+import json
+import threading
 import time
+from array import array
 
 
-# utility time reading functions
+# utility time reading functions. this is the process wide default clock of every controller that is not given a
+# clock of its own (see RealClock, VirtualClock), kept for code that moves time with advance_time().
 class TimeHelper(object):
 
     # this helps us do things like advance time by an hour, instead of singleton just use class vars and methods.
@@ -27,6 +36,105 @@ class TimeHelper(object):
 
 
 
+class RealClock(object):
+    """ The wall clock, as a clock object for ParkingLotController. With a tick a background thread reads the
+    system time every tick seconds and get_time() returns the last reading, so reading the clock costs no system
+    call at the price of being up to tick seconds behind. """
+
+    def __init__(self, tick=None):
+        super(RealClock, self).__init__()
+
+        self._tick = tick
+        self._now = int(time.time())
+        self._stopped = False
+
+        if tick is not None:
+            assert tick > 0
+
+            ticker = threading.Thread(target=self._run_ticker, name='RealClock ticker')
+            ticker.daemon = True
+            ticker.start()
+
+    def _run_ticker(self):
+        while not self._stopped:
+            time.sleep(self._tick)
+            self._now = int(time.time())
+
+    def get_time(self):
+        """ Return the number of seconds that have passed since Jan 1 1970 as an int. """
+
+        if self._tick is None:
+            return int(time.time())
+
+        return self._now
+
+    def stop(self):
+        """ Stop the background thread of a ticking clock. The clock stays at its last reading. """
+
+        self._stopped = True
+
+
+class VirtualClock(object):
+    """ A clock that only moves when told to, for tests and simulations. """
+
+    def __init__(self, start_time=0):
+        super(VirtualClock, self).__init__()
+
+        self._now = start_time
+
+    def get_time(self):
+        """ Return the current virtual time in whole seconds. """
+
+        return int(self._now)
+
+    def get_exact_time(self):
+        return self._now
+
+    def set_time(self, now):
+        """ Move the clock to now, which may not be in the past. """
+
+        assert now >= self._now, "virtual time can not go backwards"
+
+        self._now = now
+
+    def advance(self, seconds):
+        self.set_time(self._now + seconds)
+
+
+
+class _NoLock(object):
+    """ Stand in for a threading.Lock for objects that are only ever used from one thread. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_LOCK = _NoLock()
+
+
+class _AllLocked(object):
+    """ Context manager that holds every lock of a list, taken in list order. """
+
+    def __init__(self, locks):
+        super(_AllLocked, self).__init__()
+
+        self._locks = locks
+
+    def __enter__(self):
+        for lock in self._locks:
+            lock.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for lock in reversed(self._locks):
+            lock.__exit__(exc_type, exc_value, traceback)
+        return False
+
+
+
 class LotSize(object):
     """ Enumerate different lot sizes. Python 2.7 does not have built in enums, 
     so this is the closest thing I could find. """
@@ -38,9 +146,24 @@ class LotSize(object):
 
     Sizes = {SMALL, MEDIUM, LARGE}
 
+    Names = {SMALL: "Small", MEDIUM: "Medium", LARGE: "Large"}
+
+    @classmethod
+    def register(cls, size, name):
+        """ Add a size class, e.g. LotSize.register(4, "Bus"). A car fits in any lot of its own size or bigger.
+        Register extra sizes before creating the controllers that use them. """
+
+        assert isinstance(size, int) and 0 < size < 256
+
+        cls.Sizes.add(size)
+        cls.Names[size] = name
+
 
 class Car(object):
 
+    # a car object lives as long as the car is parked, keep it small.
+    __slots__ = ('_plate', '_model', '_size')
+
     def __init__(self, plate, model, size):
         """ Initialize a new car with the given, plate, model, and size information """
 
@@ -57,26 +180,290 @@ class Car(object):
     def get_size(self):
         return self._size
 
+    def get_plate(self):
+        return self._plate
+
+    def get_model(self):
+        return self._model
+
     def __str__(self):
         result = "Car with plate: " + str(self._plate) + " model: " + str(self._model)
 
-        if LotSize.SMALL == self._size:
-            return "Small " + result
-        elif LotSize.MEDIUM == self._size:
-            return "Medium " + result
-        elif LotSize.LARGE == self._size:
-            return "Large " + result
-        else:
-            return "Unknown sized " + result
+        return LotSize.Names.get(self._size, "Unknown sized") + " " + result
+
+
+
+
+class RateSchedule(object):
+    """ Hourly rates that change with the time of day and the day of the week, repeating every period. The cost of
+    any interval is computed from a table of cumulative costs over one period, in O(log n) for n rate changes per
+    period no matter how long the interval is. """
+
+    HOUR = 3600
+    DAY = 24 * HOUR
+    WEEK = 7 * DAY
+
+    # Jan 5 1970 was a Monday, so weekly periods starting here start on Monday midnight UTC.
+    MONDAY = 4 * DAY
+
+    def __init__(self, segments, period=WEEK, period_start=MONDAY):
+        """ segments is a list of (offset, hourly_rate): from offset seconds into the period up to the next offset
+        parking costs hourly_rate per hour. Offsets must start at 0 and increase, and be less than period. Periods
+        start at period_start and every whole period before or after it, times are seconds since Jan 1 1970. """
+
+        super(RateSchedule, self).__init__()
+
+        assert segments and 0 == segments[0][0]
+        assert all(segments[i][0] < segments[i + 1][0] for i in xrange(len(segments) - 1))
+        assert segments[-1][0] < period
+
+        self._period = period
+        self._period_start = period_start
+        self._offsets = [offset for offset, _ in segments]
+        self._rates = [hourly_rate for _, hourly_rate in segments]
+
+        # self._cumulative[i] is the cost of parking from the start of a period up to self._offsets[i].
+        self._cumulative = [0.0]
+        for i in xrange(1, len(segments)):
+            self._cumulative.append(self._cumulative[-1] +
+                                    (self._offsets[i] - self._offsets[i - 1]) / 3600.0 * self._rates[i - 1])
+
+        self._period_cost = self._cumulative[-1] + (period - self._offsets[-1]) / 3600.0 * self._rates[-1]
+
+    @classmethod
+    def peak_off_peak(cls, peak_rate, off_peak_rate, weekend_rate, peak_hours=(8, 18), period_start=MONDAY):
+        """ Return a weekly schedule charging peak_rate from peak_hours[0] to peak_hours[1] o'clock on weekdays,
+        off_peak_rate the rest of the weekdays and weekend_rate all Saturday and Sunday. period_start must be a
+        Monday midnight, by default in UTC. """
+
+        peak_start, peak_end = peak_hours
+        assert 0 <= peak_start < peak_end <= 24
+
+        segments = []
+        for day in xrange(5):
+            segments.append((day * cls.DAY, off_peak_rate))
+            segments.append((day * cls.DAY + peak_start * cls.HOUR, peak_rate))
+            segments.append((day * cls.DAY + peak_end * cls.HOUR, off_peak_rate))
+        segments.append((5 * cls.DAY, weekend_rate))
+
+        # drop empty segments and segments that do not change the rate.
+        merged = []
+        for offset, rate in segments:
+            if merged and merged[-1][0] == offset:
+                merged.pop()
+            if not merged or merged[-1][1] != rate:
+                merged.append((offset, rate))
+
+        return cls(merged, period=cls.WEEK, period_start=period_start)
+
+    def _cost_since_period_start(self, when):
+        """ Return the cost of parking from period_start up to when, negative for times before period_start. """
+
+        periods, into_period = divmod(when - self._period_start, self._period)
+        segment = bisect.bisect_right(self._offsets, into_period) - 1
+
+        return (periods * self._period_cost + self._cumulative[segment] +
+                (into_period - self._offsets[segment]) / 3600.0 * self._rates[segment])
+
+    def get_cost_between(self, start, end):
+        """ Return the cost of parking from time start to time end. """
+
+        return self._cost_since_period_start(end) - self._cost_since_period_start(start)
+
+    def get_rate_at(self, when):
+        """ Return the hourly rate in effect at time when. """
+
+        into_period = (when - self._period_start) % self._period
+        return self._rates[bisect.bisect_right(self._offsets, into_period) - 1]
+
+    def __str__(self):
+        return "repeating every %d seconds: " % self._period + ", ".join(
+            "from %d: %s/hour" % (offset, rate) for offset, rate in zip(self._offsets, self._rates))
+
 
+class CapacityIndex(object):
+    """ The number of reservations held at every point in time, for one lot group. Time is cut into slots of
+    granularity seconds and a reservation holds every slot it touches. The counts live in a sparse segment tree
+    over slot numbers with range add and range max, so holding, releasing and asking for the most reservations
+    held at once during any window all take O(log(number of slots)), however many reservations there are. """
 
+    # slots cover times up to this many seconds since Jan 1 1970 (early 2106).
+    TIME_LIMIT = 2 ** 32
+
+    def __init__(self, granularity=900):
+        super(CapacityIndex, self).__init__()
+
+        assert granularity > 0
+
+        self._granularity = granularity
+        self._depth = max(1, ((self.TIME_LIMIT - 1) // granularity).bit_length())
+        self._leaf_count = 1 << self._depth
+
+        # node 1 is the root, node i has children 2i and 2i+1 and leaf node leaf_count + slot is slot.
+        # self._added[node] is the count added to the whole range of an inner node, self._max[node] the most held
+        # at once in the range of node counting only what was added at node and below it. counts never go negative,
+        # so a node missing from self._max has nothing held anywhere below it. nodes back at 0 are deleted.
+        self._added = {}
+        self._max = {}
+        self._hold_count = 0
+
+        # (slot, held) of the last get_held(), walk-ins keep asking about the current slot.
+        self._held_cache = None
+
+    def __len__(self):
+        """ Return the number of holds. """
+
+        return self._hold_count
+
+    def _slots(self, start, end):
+        """ Return the range of slots [lo, hi) the time window [start, end) touches, at least one slot. """
+
+        lo = int(start) // self._granularity
+        hi = max(lo + 1, -(-int(end) // self._granularity))
+        assert 0 <= lo and hi <= self._leaf_count
+
+        return lo, hi
+
+    def _add_to_node(self, node, delta):
+        value = self._max.get(node, 0) + delta
+        if value:
+            self._max[node] = value
+        else:
+            del self._max[node]
+
+        if node < self._leaf_count:
+            value = self._added.get(node, 0) + delta
+            if value:
+                self._added[node] = value
+            else:
+                del self._added[node]
+
+    def _update_ancestors(self, first, last):
+        """ Recompute self._max of every ancestor of leaves first and last. """
+
+        highest = self._max
+        added = self._added
+        while first > 1:
+            first >>= 1
+            last >>= 1
+            # the two paths up join at the lowest common ancestor.
+            for node in ((first,) if first == last else (first, last)):
+                value = max(highest.get(2 * node, 0), highest.get(2 * node + 1, 0)) + added.get(node, 0)
+                if value:
+                    highest[node] = value
+                else:
+                    highest.pop(node, None)
+
+    def _add(self, lo, hi, delta):
+        """ Add delta to every slot in [lo, hi). """
+
+        lo += self._leaf_count
+        hi += self._leaf_count
+        first, last = lo, hi - 1
+
+        # the O(log) nodes that exactly cover the range, bottom up.
+        while lo < hi:
+            if lo & 1:
+                self._add_to_node(lo, delta)
+                lo += 1
+            if hi & 1:
+                hi -= 1
+                self._add_to_node(hi, delta)
+            lo >>= 1
+            hi >>= 1
+
+        self._update_ancestors(first, last)
+        self._held_cache = None
+
+    def hold(self, start, end):
+        """ Hold one spot from time start to time end. """
+
+        lo, hi = self._slots(start, end)
+        self._add(lo, hi, 1)
+        self._hold_count += 1
+
+    def release(self, start, end):
+        """ Give back a spot held with hold(start, end). """
+
+        assert self._hold_count > 0
+
+        lo, hi = self._slots(start, end)
+        self._add(lo, hi, -1)
+        self._hold_count -= 1
+
+    def get_max_held(self, start, end):
+        """ Return the most spots held at once at any time from start to end. """
+
+        if not self._hold_count:
+            return 0
+
+        highest = self._max
+        added = self._added
+
+        lo, hi = self._slots(start, end)
+        lo += self._leaf_count
+        hi += self._leaf_count
+
+        # collect the nodes covering the range bottom up like _add(). what is collected on the left so far always
+        # lies in the node just left of lo, and on the right in node hi, until the two sides meet and those nodes
+        # just go up to their parents. adding what was added at them on the way up counts every ancestor of the
+        # collected nodes exactly once.
+        left = right = float('-inf')
+        left_node = right_node = 0
+        for _ in xrange(self._depth):
+            if lo < hi:
+                if lo & 1:
+                    left = max(left, highest.get(lo, 0))
+                    lo += 1
+                if hi & 1:
+                    hi -= 1
+                    right = max(right, highest.get(hi, 0))
+                lo >>= 1
+                hi >>= 1
+                left_node = lo - 1
+                right_node = hi
+            else:
+                left_node >>= 1
+                right_node >>= 1
+
+            left += added.get(left_node, 0)
+            right += added.get(right_node, 0)
+
+        # the whole time range.
+        if lo < hi:
+            left = max(left, highest.get(1, 0))
+
+        return max(left, right, 0)
+
+    def get_held(self, now):
+        """ Return the number of spots held at time now. """
+
+        if not self._hold_count:
+            return 0
+
+        slot = int(now) // self._granularity
+        cache = self._held_cache
+        if cache is not None and cache[0] == slot:
+            return cache[1]
+
+        node = self._leaf_count + slot
+        held = self._max.get(node, 0)
+        while node > 1:
+            node >>= 1
+            held += self._added.get(node, 0)
+
+        self._held_cache = (slot, held)
+        return held
 
 
 class LotGroup(object):
     """ Track a group of lots of the same size. handle allocating/free lots from this group. """
 
-    def __init__(self, lots_count, size, hourly_rate):
-        """ Initialize a new lot group with the given number of lots of the given size with the hourly price. """
+    def __init__(self, lots_count, size, hourly_rate, thread_safe=False, rate_schedule=None):
+        """ Initialize a new lot group with the given number of lots of the given size with the hourly price.
+        If thread_safe is True claim_spot and release_spot can be called from several threads at once. If a
+        RateSchedule is given parking is charged by it, and hourly_rate is only the nominal rate of the lot group,
+        e.g. for picking the cheapest lot group. """
 
         super(LotGroup, self).__init__()
 
@@ -91,6 +478,7 @@ class LotGroup(object):
         self._lot_count = lots_count
         self._size = size
         self._hourly_rate = hourly_rate
+        self._rate_schedule = rate_schedule
 
         # lot allocation table: sparse hash table of (lot_id, car object)
         # lot_id is just an int in xrange(0, lot_count)
@@ -99,32 +487,44 @@ class LotGroup(object):
         # the number of cars in this lot group.
         self._lots = {}
 
+        # free spot allocator: every lot_id >= self._high_water has never been handed out and is free. lot_ids
+        # below the high water mark that have been freed again are kept in a min-heap, so the lowest free lot_id
+        # is either the top of the heap or the high water mark. this keeps park/remove at O(log n) without
+        # materializing a list of all lot_count free ids up front.
+        self._high_water = 0
+        self._freed_lot_ids = []
+
+        # lot_ids still in the heap that park_car_at() took since, dropped when they get to the top. taking an id
+        # out of the middle of the heap would mean heapifying it again every time, and rebuilding a state parks
+        # every car with park_car_at().
+        self._taken_freed_lot_ids = set()
+
+        # guards the allocation table and the free spot allocator in claim_spot/release_spot.
+        self._lock = threading.Lock() if thread_safe else _NO_LOCK
+
+        # spots held for reservations over time, see ParkingLotController.reserve().
+        self._reservations = CapacityIndex()
+
     def __str__(self):
         """ Return a string representation of this lot group. """
 
-        size_class_str = None
-        if self._size == LotSize.SMALL:
-            size_class_str = "Small"
-        elif self._size == LotSize.MEDIUM:
-            size_class_str = "Medium"
-        elif self._size == LotSize.LARGE:
-            size_class_str = "Large"
-        else:
-            size_class_str = "Unknown size"
+        lines = [self._str_header()]
 
-        lg_state = "********** lot group with size class: " + size_class_str + "\n"
-        lg_state += "with number of spots: " + str(self._lot_count) + "\n"
-        lg_state += "with rate of: " + str(self._hourly_rate) + " dollar(s) per hour. \n"
+        if self.get_car_count():
+            lines.append("cars parked in this lot group are: \n")
+            lines.extend("++" + str(car) + "\n" for car in self.iter_cars())
+        else:
+            lines.append('no cars parked in this lot group. \n')
 
-        if len(self._lots):
-            lg_state += "cars parked in this lot group are: \n"
+        return "".join(lines)
 
-            for car in self._lots.itervalues():
-                lg_state += "++" +str(car) + "\n"
-        else:
-            lg_state += 'no cars parked in this lot group. \n'
+    def _str_header(self):
+        """ Return the first lines of __str__, the ones that describe the lot group itself. """
 
-        return lg_state
+        return ("********** lot group with size class: " + LotSize.Names.get(self._size, "Unknown size") + "\n" +
+                "with number of spots: " + str(self._lot_count) + "\n" +
+                "with rate of: " + str(self._hourly_rate) + " dollar(s) per hour. \n" +
+                ("with rate schedule " + str(self._rate_schedule) + "\n" if self._rate_schedule else ""))
 
 
     def get_spot_count(self):
@@ -133,11 +533,21 @@ class LotGroup(object):
     def get_size_class(self):
         return self._size
 
+    def get_car_count(self):
+        """ Return the number of cars parked in this lot group. """
+
+        return len(self._lots)
+
+    def iter_cars(self):
+        """ Return an iterator over the cars parked in this lot group. """
+
+        return self._lots.itervalues()
+
     def has_space(self):
         """ Return True if this lot group has space for at least one more car that can fit in this group. 
         Otherwise return False. """
 
-        if len(self._lots) < self._lot_count:
+        if self.get_car_count() < self._lot_count:
             return True
         else:
             return False
@@ -157,16 +567,76 @@ class LotGroup(object):
 
         assert self.can_fit(car)
 
-        # we could also save the last index and start the search from where we left of last time.
-        for lot_id in xrange(0, self._lot_count):
+        # every id below the high water mark is smaller than every never used id.
+        lot_id = self._pop_freed_lot_id()
+        if lot_id is None:
+            if self._high_water >= self._lot_count:
+                return None
+
+            lot_id = self._high_water
+            self._high_water += 1
+
+        self._lots[lot_id] = car
+        return lot_id
+
+    def _pop_freed_lot_id(self):
+        """ Take the lowest freed lot_id off the heap and return it, or None if there is none. """
 
-            if not self._lots.has_key(lot_id):
-                # found first non-existent lot_id
-                self._lots[lot_id] = car
+        freed = self._freed_lot_ids
+        taken = self._taken_freed_lot_ids
+        while freed:
+            lot_id = heapq.heappop(freed)
+            if lot_id not in taken:
                 return lot_id
+            taken.discard(lot_id)
 
         return None
 
+    def _push_freed_lot_id(self, lot_id):
+        """ Put lot_id, which was just freed, back on the heap. """
+
+        if lot_id in self._taken_freed_lot_ids:
+            # it never left the heap.
+            self._taken_freed_lot_ids.discard(lot_id)
+        else:
+            heapq.heappush(self._freed_lot_ids, lot_id)
+
+    def park_car_at(self, lot_id, car):
+        """ Park car at the given free lot_id. This is for rebuilding a known state, e.g. from a snapshot or a
+        journal, normal parking goes through find_spot_and_park. Rebuilding is cheapest in increasing lot_id order. """
+
+        assert self.can_fit(car)
+        assert (0 <= lot_id) and (lot_id < self._lot_count)
+        assert self.get_car(lot_id) is None
+
+        if lot_id >= self._high_water:
+            # the never used ids skipped over are now free ids below the high water mark.
+            for skipped_lot_id in xrange(self._high_water, lot_id):
+                heapq.heappush(self._freed_lot_ids, skipped_lot_id)
+            self._high_water = lot_id + 1
+        else:
+            self._taken_freed_lot_ids.add(lot_id)
+
+        self._lots[lot_id] = car
+
+    def claim_spot(self, car, keep_free=0):
+        """ Atomically check for space and park car in the lowest free lot. Return its lot_id, or None if this lot
+        group is full. Use this instead of has_space() followed by find_spot_and_park() from several threads.
+        With keep_free the car is only parked if more than keep_free spots are free, e.g. to keep spots held for
+        reservations free. """
+
+        with self._lock:
+            if keep_free and self._lot_count - self.get_car_count() <= keep_free:
+                return None
+
+            return self.find_spot_and_park(car)
+
+    def release_spot(self, lot_id):
+        """ Atomically remove and return the car object at lot_id in this lot group. """
+
+        with self._lock:
+            return self.remove_car(lot_id)
+
     def get_car(self, lot_id):
         """ Return a reference to the car object at lot_id in this lot group. Does not remove the car object. """
 
@@ -188,21 +658,113 @@ class LotGroup(object):
         if self._lots.has_key(lot_id):
             car = self._lots[lot_id]
             del self._lots[lot_id]
+            self._push_freed_lot_id(lot_id)
             return car
 
         # if there is no car at lot_id
         return None
 
+    def get_reservations(self):
+        """ Return the CapacityIndex of the spots held for reservations in this lot group. """
+
+        return self._reservations
+
+    def has_space_for_walk_in(self, now):
+        """ Return True if this lot group has a free spot that is not held for a reservation at time now. """
+
+        return self._lot_count - self.get_car_count() > self._reservations.get_held(now)
+
     def get_hourly_rate(self):
         """ Return the the hourly price of parking a car in this lot group. """
 
         return self._hourly_rate
 
+    def get_rate_schedule(self):
+        """ Return the RateSchedule of this lot group, or None if it charges a flat hourly rate. """
+
+        return self._rate_schedule
+
+    def get_cost_for_interval(self, start, end):
+        """ Return the cost of parking a car in this lot group from time start to time end. """
+
+        if self._rate_schedule is None:
+            return ((end - start) / 3600.0) * self._hourly_rate
+
+        return self._rate_schedule.get_cost_between(start, end)
+
+
+class CompactLotGroup(LotGroup):
+    """ A LotGroup that keeps its cars in a list indexed by lot_id instead of a sparse dict. This costs one pointer
+    per spot up front, which is a lot less than a dict entry and an int per parked car once the group is in use. """
+
+    def __init__(self, lots_count, size, hourly_rate, thread_safe=False, rate_schedule=None):
+        """ Initialize a new lot group with the given number of lots of the given size with the hourly price. """
+
+        super(CompactLotGroup, self).__init__(lots_count=lots_count, size=size, hourly_rate=hourly_rate,
+                                              thread_safe=thread_safe, rate_schedule=rate_schedule)
+
+        # lot allocation table: self._lots[lot_id] is the car parked at lot_id or None if lot_id is free.
+        self._lots = [None] * lots_count
+        self._car_count = 0
+
+    def get_car_count(self):
+        """ Return the number of cars parked in this lot group. """
+
+        return self._car_count
+
+    def iter_cars(self):
+        """ Return an iterator over the cars parked in this lot group. """
+
+        return (car for car in self._lots if car is not None)
+
+    def find_spot_and_park(self, car):
+        """ Find an empty lot, save the car there, and Return its lot_id if possible. 
+         Return None if no spot is available. """
+
+        lot_id = super(CompactLotGroup, self).find_spot_and_park(car)
+        if lot_id is not None:
+            self._car_count += 1
+
+        return lot_id
+
+    def park_car_at(self, lot_id, car):
+        """ Park car at the given free lot_id, see LotGroup.park_car_at. """
+
+        super(CompactLotGroup, self).park_car_at(lot_id, car)
+        self._car_count += 1
+
+    def get_car(self, lot_id):
+        """ Return a reference to the car object at lot_id in this lot group. Does not remove the car object. """
+
+        assert lot_id >= 0
+        assert lot_id < self._lot_count
+
+        return self._lots[lot_id]
+
+    def remove_car(self, lot_id):
+        """ Remove and return a the car object at lot_id in this lot group. """
+
+        assert lot_id >= 0
+        assert lot_id < self._lot_count
+
+        car = self._lots[lot_id]
+        if car is None:
+            return None
+
+        self._lots[lot_id] = None
+        self._car_count -= 1
+        self._push_freed_lot_id(lot_id)
+        return car
+
 
 class Ticket(object):
 
-    def __init__(self, lot_group, lot_id):
-        """ Create a new Ticket for a car parked at lot_group and lot_id. """
+    # one ticket object lives as long as the car is parked, keep it small.
+    __slots__ = ('_lot_id', '_lot_group', '_cost_so_far', '_start_time_ticket_issue', '_start_time_current_spot')
+
+    def __init__(self, lot_group, lot_id, now=None):
+        """ Create a new Ticket for a car parked at lot_group and lot_id. now is the issue time, if not given
+        the current time is read from TimeHelper. """
 
         super(Ticket, self).__init__()
 
@@ -216,12 +778,15 @@ class Ticket(object):
 
         self._cost_so_far = 0
 
+        if now is None:
+            now = TimeHelper.get_time()
+
         # time ticket was issued, this is only necessary if we need to print when this ticket was issued or something
         # like that. not needed for calculating cost.
-        self._start_time_ticket_issue = TimeHelper.get_time()
+        self._start_time_ticket_issue = now
 
         # time car is been resident in its current lot group. (this get reset when car is relocated to better spot)
-        self._start_time_current_spot = TimeHelper.get_time()
+        self._start_time_current_spot = now
 
 
 
@@ -233,7 +798,7 @@ class Ticket(object):
 
 
 
-    def update_car_location(self, new_lot_id, new_lot_group):
+    def update_car_location(self, new_lot_id, new_lot_group, now=None):
         """ Update the location information for the car associated with this Ticket and handle counting the 
          cost of the ticket. """
 
@@ -241,14 +806,11 @@ class Ticket(object):
         assert isinstance(new_lot_id, int)
         assert (0 <= new_lot_id) and (new_lot_id < new_lot_group.get_spot_count())
 
-        # calculate the incurred cost so far on the existing lot group before updating location.
-        hourly_rate = self._lot_group.get_hourly_rate()
+        if now is None:
+            now = TimeHelper.get_time()
 
-        now = TimeHelper.get_time()
-
-        seconds_in_this_lg = now - self._start_time_current_spot
-
-        self._cost_so_far += (seconds_in_this_lg / 3600.0) * hourly_rate
+        # calculate the incurred cost so far on the existing lot group before updating location.
+        self._cost_so_far += self._lot_group.get_cost_for_interval(self._start_time_current_spot, now)
 
 
         # now update location to new spot.
@@ -258,116 +820,1240 @@ class Ticket(object):
 
 
 
-    def get_cost(self):
-        """ Return the costs ran up on this ticket so far. s"""
+    def get_cost(self, now=None):
+        """ Return the costs ran up on this ticket so far, up to now if given or the current time otherwise. """
 
-        # calculate the incurred cost so far on the existing lot group before updating location.
-        hourly_rate = self._lot_group.get_hourly_rate()
+        if now is None:
+            now = TimeHelper.get_time()
+
+        return self._cost_so_far + self._lot_group.get_cost_for_interval(self._start_time_current_spot, now)
+
+
+class _TicketSlots(object):
+    """ Ticket numbering and slot allocation shared by the ticket tables.
+
+    Tickets are kept in slots, and the slot of a deleted ticket is reused by the next one, so a table never has
+    more slots than twice the spots of the parking lot. A ticket number is the generation of its ticket shifted
+    left by slot_bits, plus its slot. No slot ever gets the same generation twice, so no ticket number is ever
+    handed out twice, and a lookup finds a ticket only while its slot still holds the same generation: an old
+    ticket whose slot went to a newer car finds nothing.
+
+    Allocation is striped like the controller's ticket locks: slot s belongs to stripe s % stripe count, and every
+    stripe has its own lock, free slots and generation counter. Tickets are issued from the stripes in turn, picked
+    with an itertools.count, which needs no lock under the GIL. """
+
+    # stripes of a thread safe table. a power of two, so a stripe owns every stripe count-th slot.
+    _STRIPES = 16
+
+    def __init__(self, lot_groups, thread_safe):
+        """ Initialize an empty table with a slot for every spot of lot_groups. If thread_safe is True tickets can
+        be issued and deleted from several threads at once. """
+
+        super(_TicketSlots, self).__init__()
+
+        capacity = sum(lot_group.get_spot_count() for lot_group in lot_groups)
+        self._slot_bits = max(1, (capacity - 1).bit_length())
+        self._slot_mask = (1 << self._slot_bits) - 1
+
+        # every stripe owns slots up to the mask, so while there are fewer tickets than spots some stripe has one.
+        stripe_count = min(self._STRIPES, 1 << self._slot_bits) if thread_safe else 1
+        self._stripe_mask = stripe_count - 1
+        self._stripe_picks = itertools.count()
+
+        # per stripe: a lock guarding everything else of the stripe and its slots in issue, restore and __delitem__,
+        # a stack of free slots, the lowest slot never used, the next generation and the number of tickets.
+        # restore() may take a slot that is still on the stack, allocation skips those.
+        self._locks = [threading.Lock() if thread_safe else _NO_LOCK for _ in xrange(stripe_count)]
+        self._free_slots = [[] for _ in xrange(stripe_count)]
+        self._fresh_slots = range(stripe_count)
+        self._next_generations = [1] * stripe_count
+        self._counts = [0] * stripe_count
+
+        # generation of the ticket in each slot, 0 for a free slot. slots are added as needed and never removed,
+        # under the grow lock.
+        self._generations = array('l')
+        self._grow_lock = threading.Lock() if thread_safe else _NO_LOCK
+
+    def _grow_to(self, slot):
+        """ Add slots up to and including slot. """
+
+        with self._grow_lock:
+            while len(self._generations) <= slot:
+                self._generations.append(0)
+                self._add_slot()
+
+    def _issue_slot(self, fill, *args):
+        """ Take a free slot for a new ticket, call fill(slot, *args) to store the ticket in it and return the
+        ticket number. Takes the lock of one stripe. """
+
+        # only when the picked stripe has used up all its slots are the others tried, in turn.
+        first = next(self._stripe_picks)
+        for pick in xrange(first, first + self._stripe_mask + 1):
+            stripe = pick & self._stripe_mask
+            with self._locks[stripe]:
+                slot = self._allocate_slot(stripe)
+                if slot is not None:
+                    fill(slot, *args)
+                    return (self._generations[slot] << self._slot_bits) | slot
+
+        assert False, "more tickets than spots"
+
+    def _allocate_slot(self, stripe):
+        """ Take a free slot of stripe for a new ticket and return it, or None if stripe has no free slot. Call with
+        the lock of stripe held. """
+
+        generations = self._generations
+        free_slots = self._free_slots[stripe]
+        while free_slots:
+            slot = free_slots.pop()
+            if not generations[slot]:
+                break
+        else:
+            slot = self._fresh_slots[stripe]
+            if slot > self._slot_mask:
+                return None
+            self._fresh_slots[stripe] = slot + self._stripe_mask + 1
+            self._grow_to(slot)
+
+        generations[slot] = self._next_generations[stripe]
+        self._next_generations[stripe] += 1
+        self._counts[stripe] += 1
+
+        return slot
+
+    def _stripe_lock(self, ticket_no):
+        """ Return the lock of the stripe of the slot of ticket_no. """
+
+        try:
+            return self._locks[ticket_no & self._stripe_mask]
+        except TypeError:
+            # no such ticket, any lock does.
+            return self._locks[0]
+
+    def _restore_slot(self, ticket_no):
+        """ Take the slot ticket_no was issued in, with its generation, and return the slot. Call with the lock
+        of its stripe held. """
+
+        slot = ticket_no & self._slot_mask
+        generation = ticket_no >> self._slot_bits
+        assert generation > 0
+
+        stripe = slot & self._stripe_mask
+        step = self._stripe_mask + 1
+        self._grow_to(slot)
+        while self._fresh_slots[stripe] <= slot:
+            self._free_slots[stripe].append(self._fresh_slots[stripe])
+            self._fresh_slots[stripe] += step
+
+        generations = self._generations
+        assert not generations[slot], "slot of ticket %d is taken" % ticket_no
+
+        generations[slot] = generation
+        self._next_generations[stripe] = max(self._next_generations[stripe], generation + 1)
+        self._counts[stripe] += 1
+
+        return slot
+
+    def _free_slot(self, ticket_no):
+        """ Free the slot of the ticket with number ticket_no and return it. Call with the lock of its stripe
+        held. """
+
+        slot = self._slot_of(ticket_no)
+        if slot is None:
+            raise KeyError(ticket_no)
+
+        stripe = slot & self._stripe_mask
+        self._generations[slot] = 0
+        self._free_slots[stripe].append(slot)
+        self._counts[stripe] -= 1
+
+        return slot
+
+    def _slot_of(self, ticket_no):
+        """ Return the slot of the ticket with number ticket_no, or None if there is no such ticket. """
+
+        try:
+            slot = ticket_no & self._slot_mask
+            generation = ticket_no >> self._slot_bits
+        except TypeError:
+            return None
+
+        if generation > 0 and slot < len(self._generations) and self._generations[slot] == generation:
+            return slot
+
+        return None
+
+    def _all_stripes_locked(self):
+        """ Return a context manager that holds the lock of every stripe. """
+
+        return _AllLocked(self._locks)
+
+    def _live_slots(self):
+        """ Return a list of (ticket number, slot) of every ticket. """
+
+        bits = self._slot_bits
+        with self._all_stripes_locked():
+            return [((generation << bits) | slot, slot) for slot, generation in enumerate(self._generations)
+                    if generation]
+
+    def get_next_generation(self):
+        """ Return a generation no ticket issued so far has, and that is at least the one the next issued ticket
+        gets. """
+
+        with self._all_stripes_locked():
+            return max(self._next_generations)
+
+    def advance_generation(self, next_generation):
+        """ Make sure no ticket issued from now on gets a generation below next_generation, e.g. after loading a
+        snapshot of a table that had handed out generations up to there. """
+
+        with self._all_stripes_locked():
+            self._next_generations = [max(generation, next_generation) for generation in self._next_generations]
+
+    def has_key(self, ticket_no):
+        return self._slot_of(ticket_no) is not None
+
+    def __contains__(self, ticket_no):
+        return self._slot_of(ticket_no) is not None
+
+    def __len__(self):
+        return sum(self._counts)
+
+    def __getitem__(self, ticket_no):
+        slot = self._slot_of(ticket_no)
+        if slot is None:
+            raise KeyError(ticket_no)
+
+        return self._ticket_at(slot)
+
+    def iterkeys(self):
+        for ticket_no, _ in self._live_slots():
+            yield ticket_no
+
+    def itervalues(self):
+        for _, slot in self._live_slots():
+            yield self._ticket_at(slot)
+
+    def iteritems(self):
+        for ticket_no, slot in self._live_slots():
+            yield ticket_no, self._ticket_at(slot)
+
+
+class TicketTable(_TicketSlots):
+    """ Default ticket storage: one Ticket object per slot. """
+
+    def __init__(self, lot_groups, thread_safe=False):
+        super(TicketTable, self).__init__(lot_groups, thread_safe)
+
+        # ticket per slot, None for a free slot.
+        self._tickets = []
+
+    def _add_slot(self):
+        self._tickets.append(None)
+
+    def _ticket_at(self, slot):
+        return self._tickets[slot]
+
+    def issue(self, lot_group, lot_id, now=None):
+        """ Create and save a new ticket for a car parked at lot_group and lot_id. Return its ticket number. """
+
+        ticket = Ticket(lot_group=lot_group, lot_id=lot_id, now=now)
+
+        return self._issue_slot(self._tickets.__setitem__, ticket)
+
+    def restore(self, ticket_no, lot_group, lot_id, issue_time, start_time, cost_so_far):
+        """ Save a ticket with every field given under its old ticket number, e.g. when loading a snapshot. """
+
+        ticket = Ticket(lot_group=lot_group, lot_id=lot_id, now=start_time)
+        ticket._start_time_ticket_issue = issue_time
+        ticket._cost_so_far = cost_so_far
+
+        with self._stripe_lock(ticket_no):
+            self._tickets[self._restore_slot(ticket_no)] = ticket
+
+    def __delitem__(self, ticket_no):
+        with self._stripe_lock(ticket_no):
+            self._tickets[self._free_slot(ticket_no)] = None
+
+    def _live_tickets(self):
+        """ Return a list of (ticket number, Ticket) of every ticket. """
+
+        bits = self._slot_bits
+        with self._all_stripes_locked():
+            return [((generation << bits) | slot, self._tickets[slot])
+                    for slot, generation in enumerate(self._generations) if generation]
+
+    def iter_ticket_records(self, group_index):
+        """ Yield (ticket_no, lot group index, lot_id, issue time, start time in current spot, cost accrued before
+        current spot) for every ticket. """
+
+        for ticket_no, ticket in self._live_tickets():
+            yield (ticket_no, group_index[ticket._lot_group], ticket._lot_id, ticket._start_time_ticket_issue,
+                   ticket._start_time_current_spot, ticket._cost_so_far)
+
+    def group_sums(self, group_index):
+        """ Given a dict of lot group to its index, return 3 lists indexed by lot group index: the number of
+        tickets, the sum of start times in the current spot and the sum of costs accrued before the current spot. """
 
-        now = TimeHelper.get_time()
+        group_count = len(group_index)
+        counts = [0] * group_count
+        start_sums = [0.0] * group_count
+        cost_sums = [0.0] * group_count
 
-        seconds_in_this_lg = now - self._start_time_current_spot
+        # copying the slots takes a snapshot of the tickets in one step, so other threads may keep parking cars.
+        for ticket in self._tickets[:]:
+            if ticket is None:
+                continue
 
-        return self._cost_so_far + ((seconds_in_this_lg / 3600.0) * hourly_rate)
+            idx = group_index[ticket._lot_group]
+            counts[idx] += 1
+            start_sums[idx] += ticket._start_time_current_spot
+            cost_sums[idx] += ticket._cost_so_far
+
+        return counts, start_sums, cost_sums
+
+    def iter_cost_columns(self, group_index):
+        """ Yield (ticket_no, lot group index, start time in current spot, cost accrued before current spot)
+        for every ticket. """
+
+        for ticket_no, ticket in self._live_tickets():
+            yield ticket_no, group_index[ticket._lot_group], ticket._start_time_current_spot, ticket._cost_so_far
+
+
+class TicketRow(object):
+    """ Light weight view of one row of a ColumnarTicketTable. Has the same interface as Ticket. Rows get reused
+    once the ticket is deleted from the table, so do not hold on to a row view past the life of its ticket. """
+
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table, row):
+        self._table = table
+        self._row = row
+
+    def get_current_car_spot(self):
+        """ Return the spot as a 2-tuple of (lot_group, lot_id) for the car associated with this ticket"""
+
+        table = self._table
+        return (table._lot_groups[table._group_idx[self._row]], table._lot_id[self._row])
+
+    def update_car_location(self, new_lot_id, new_lot_group, now=None):
+        """ Update the location information for the car associated with this ticket and handle counting the
+         cost of the ticket. """
+
+        assert (0 <= new_lot_id) and (new_lot_id < new_lot_group.get_spot_count())
+
+        if now is None:
+            now = TimeHelper.get_time()
+
+        table = self._table
+        row = self._row
+
+        table._cost_so_far[row] = self.get_cost(now=now)
+        table._start_time_current_spot[row] = now
+        table._lot_id[row] = new_lot_id
+        table._group_idx[row] = table._group_index[new_lot_group]
+
+    def get_cost(self, now=None):
+        """ Return the costs ran up on this ticket so far, up to now if given or the current time otherwise. """
+
+        if now is None:
+            now = TimeHelper.get_time()
+
+        table = self._table
+        row = self._row
+
+        lot_group = table._lot_groups[table._group_idx[row]]
+        return table._cost_so_far[row] + lot_group.get_cost_for_interval(table._start_time_current_spot[row], now)
+
+
+class ColumnarTicketTable(_TicketSlots):
+    """ Compact ticket storage. Instead of one Ticket object per ticket, the fields of every ticket are kept in
+    parallel array columns indexed by slot, and tickets are handed out as TicketRow views. Supports the subset of
+    the dict interface the controller uses for its tickets table. """
+
+    # group index column value of a free row.
+    _FREE_ROW = 0xFFFF
+
+    def __init__(self, lot_groups, thread_safe=False):
+        """ Initialize an empty table for tickets on the given list of lot groups. If thread_safe is True
+        tickets can be issued and deleted from several threads at once. """
+
+        super(ColumnarTicketTable, self).__init__(lot_groups, thread_safe)
+
+        self._lot_groups = list(lot_groups)
+        self._group_index = dict((lot_group, idx) for idx, lot_group in enumerate(self._lot_groups))
+
+        # columns, all indexed by row, which is the slot of the ticket.
+        self._lot_id = array('l')
+        self._group_idx = array('H')
+        self._start_time_ticket_issue = array('d')
+        self._start_time_current_spot = array('d')
+        self._cost_so_far = array('d')
+
+    def _add_slot(self):
+        self._lot_id.append(0)
+        self._group_idx.append(self._FREE_ROW)
+        self._start_time_ticket_issue.append(0.0)
+        self._start_time_current_spot.append(0.0)
+        self._cost_so_far.append(0.0)
+
+    def _ticket_at(self, slot):
+        return TicketRow(self, slot)
+
+    def _fill_row(self, row, group_idx, lot_id, issue_time, start_time, cost_so_far):
+        self._lot_id[row] = lot_id
+        self._start_time_ticket_issue[row] = issue_time
+        self._start_time_current_spot[row] = start_time
+        self._cost_so_far[row] = cost_so_far
+        # last, group_sums() counts a row as soon as it has a lot group.
+        self._group_idx[row] = group_idx
+
+    def issue(self, lot_group, lot_id, now=None):
+        """ Create and save a new ticket for a car parked at lot_group and lot_id. Return its ticket number. """
+
+        assert (0 <= lot_id) and (lot_id < lot_group.get_spot_count())
+
+        if now is None:
+            now = TimeHelper.get_time()
+
+        return self._issue_slot(self._fill_row, self._group_index[lot_group], lot_id, now, now, 0.0)
+
+    def restore(self, ticket_no, lot_group, lot_id, issue_time, start_time, cost_so_far):
+        """ Save a ticket with every field given under its old ticket number, e.g. when loading a snapshot. """
+
+        assert (0 <= lot_id) and (lot_id < lot_group.get_spot_count())
+
+        group_idx = self._group_index[lot_group]
+
+        with self._stripe_lock(ticket_no):
+            self._fill_row(self._restore_slot(ticket_no), group_idx, lot_id, issue_time, start_time, cost_so_far)
+
+    def __delitem__(self, ticket_no):
+        with self._stripe_lock(ticket_no):
+            self._group_idx[self._free_slot(ticket_no)] = self._FREE_ROW
+
+    def iter_ticket_records(self, group_index):
+        """ Yield (ticket_no, lot group index, lot_id, issue time, start time in current spot, cost accrued before
+        current spot) for every ticket. """
+
+        assert group_index == self._group_index
+
+        for ticket_no, row in self._live_slots():
+            yield (ticket_no, self._group_idx[row], self._lot_id[row], self._start_time_ticket_issue[row],
+                   self._start_time_current_spot[row], self._cost_so_far[row])
+
+    def group_sums(self, group_index):
+        """ Given a dict of lot group to its index, return 3 lists indexed by lot group index: the number of
+        tickets, the sum of start times in the current spot and the sum of costs accrued before the current spot.
+        This is a single pass straight over the columns. """
+
+        assert group_index == self._group_index
+
+        group_count = len(self._lot_groups)
+        counts = [0] * group_count
+        start_sums = [0.0] * group_count
+        cost_sums = [0.0] * group_count
+
+        free_row = self._FREE_ROW
+        for idx, start, cost_so_far in itertools.izip(self._group_idx, self._start_time_current_spot,
+                                                      self._cost_so_far):
+            if idx != free_row:
+                counts[idx] += 1
+                start_sums[idx] += start
+                cost_sums[idx] += cost_so_far
+
+        return counts, start_sums, cost_sums
+
+    def iter_cost_columns(self, group_index):
+        """ Yield (ticket_no, lot group index, start time in current spot, cost accrued before current spot)
+        for every ticket. """
+
+        assert group_index == self._group_index
+
+        group_idx = self._group_idx
+        start_time = self._start_time_current_spot
+        cost_so_far = self._cost_so_far
+
+        for ticket_no, row in self._live_slots():
+            yield ticket_no, group_idx[row], start_time[row], cost_so_far[row]
+
+
+class SpotIndex(object):
+    """ Compact lot_id -> ticket number map of one lot group, for the spot index of a controller with compact
+    storage. A ticket number per spot is kept in an array, 8 bytes a spot instead of a dict entry and two int
+    objects per parked car. Supports the subset of the dict interface the controller and its listeners use.
+    Iterating goes over every spot, parked or not. """
+
+    __slots__ = ('_tickets', '_count')
+
+    # 0 is never a ticket number, see _TicketSlots.
+    _FREE = 0
+
+    def __init__(self, spot_count):
+        self._tickets = array('l', [self._FREE]) * spot_count
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def get(self, lot_id, default=None):
+        if 0 <= lot_id < len(self._tickets):
+            ticket_no = self._tickets[lot_id]
+            if ticket_no != self._FREE:
+                return ticket_no
+
+        return default
+
+    def __contains__(self, lot_id):
+        return self.get(lot_id) is not None
+
+    def __getitem__(self, lot_id):
+        ticket_no = self.get(lot_id)
+        if ticket_no is None:
+            raise KeyError(lot_id)
+
+        return ticket_no
+
+    def __setitem__(self, lot_id, ticket_no):
+        if self._tickets[lot_id] == self._FREE:
+            self._count += 1
+        self._tickets[lot_id] = ticket_no
+
+    def __delitem__(self, lot_id):
+        if self.get(lot_id) is None:
+            raise KeyError(lot_id)
+
+        self._tickets[lot_id] = self._FREE
+        self._count -= 1
+
+    def iteritems(self):
+        free = self._FREE
+        for lot_id, ticket_no in enumerate(self._tickets):
+            if ticket_no != free:
+                yield lot_id, ticket_no
+
+    def iterkeys(self):
+        return (lot_id for lot_id, _ in self.iteritems())
+
+    __iter__ = iterkeys
+
+    def itervalues(self):
+        free = self._FREE
+        return (ticket_no for ticket_no in self._tickets if ticket_no != free)
+
+    def values(self):
+        return list(self.itervalues())
 
 
 class ParkingLotController(object):
 
-    def __init__(self, small_count, small_rate, medium_count, medium_rate, large_count, large_rate):
-        """ Initialize a new parking lot controller. """
+    # number of locks ticket numbers are spread over in concurrent mode.
+    _TICKET_LOCK_STRIPES = 64
+
+    # how a car picks its lot group among the ones it fits in that have space: the smallest size class (then the
+    # cheapest rate), or the cheapest rate (then the smallest size class). ties go to the first lot group.
+    PLACEMENT_POLICIES = ['smallest', 'cheapest']
+
+    def __init__(self, small_count=None, small_rate=None, medium_count=None, medium_rate=None, large_count=None,
+                 large_rate=None, auto_compactify=False, compact_storage=False, concurrent=False, lot_groups=None,
+                 placement='smallest', clock=None):
+        """ Initialize a new parking lot controller with a small, a medium and a large lot group of the given
+        spot counts and hourly rates, or with lot_groups instead: a list of (spot count, size, hourly rate), one
+        per lot group, in any order and with any number of lot groups of a size. A lot group definition can have a
+        RateSchedule as a 4th item, see LotGroup.
+        If auto_compactify is True the parking lot is compactified on every departure. If compact_storage is True
+        cars are kept in CompactLotGroups and tickets in a ColumnarTicketTable, which need a lot less memory per
+        parked car than the default dicts of objects. If concurrent is True the public API can be called from
+        several threads at once. placement is one of PLACEMENT_POLICIES. The controller reads the time from clock,
+        any object with a get_time() method returning whole seconds since Jan 1 1970 like RealClock or
+        VirtualClock. By default that is TimeHelper, the clock shared by the whole process. """
 
         super(ParkingLotController, self).__init__()
 
-        self._lot_groups = []
-        self._lot_groups.append( LotGroup(lots_count=small_count, size=LotSize.SMALL, hourly_rate=small_rate) )
-        self._lot_groups.append( LotGroup(lots_count=medium_count, size=LotSize.MEDIUM, hourly_rate=medium_rate) )
-        self._lot_groups.append( LotGroup(lots_count=large_count, size=LotSize.LARGE, hourly_rate=large_rate) )
+        # every public call reads the clock at most once and passes that time down.
+        self._clock = TimeHelper if clock is None else clock
+
+        assert placement in self.PLACEMENT_POLICIES
 
+        if lot_groups is None:
+            lot_groups = [(small_count, LotSize.SMALL, small_rate), (medium_count, LotSize.MEDIUM, medium_rate),
+                          (large_count, LotSize.LARGE, large_rate)]
+
+        lot_group_class = CompactLotGroup if compact_storage else LotGroup
+
+        self._lot_groups = [lot_group_class(lots_count=definition[0], size=definition[1], hourly_rate=definition[2],
+                                            thread_safe=concurrent,
+                                            rate_schedule=definition[3] if len(definition) > 3 else None)
+                            for definition in lot_groups]
+
+        # lot group -> its index in self._lot_groups
+        self._lot_group_index = dict((lot_group, idx) for idx, lot_group in enumerate(self._lot_groups))
+
+        # availability. self._free_spots[car_size] is the number of free spots a car of car_size fits in, and
+        # self._counted_sizes maps a lot group to the car sizes its free spots count towards. the counters follow
+        # the spot index, see _index_spot() and _unindex_spot().
+        self._free_spots = dict((car_size, 0) for car_size in LotSize.Sizes)
+        self._counted_sizes = {}
+        for lot_group in self._lot_groups:
+            self._counted_sizes[lot_group] = [car_size for car_size in LotSize.Sizes
+                                              if car_size <= lot_group.get_size_class()]
+            for car_size in self._counted_sizes[lot_group]:
+                self._free_spots[car_size] += lot_group.get_spot_count()
+
+        # placement index. self._available[size_class] is a min-heap of (placement key, lot group index) of the lot
+        # groups of that size class that may have space, self._size_classes the sorted size classes that have lot
+        # groups. full lot groups, and ones with only held spots free, are only dropped from the heaps when a lookup
+        # runs into them, and a lot group that gets a spot back is pushed again unless it is still in its heap
+        # (self._in_available).
+        if 'smallest' == placement:
+            self._placement_keys = [(lot_group.get_size_class(), lot_group.get_hourly_rate(), idx)
+                                    for idx, lot_group in enumerate(self._lot_groups)]
+        else:
+            self._placement_keys = [(lot_group.get_hourly_rate(), lot_group.get_size_class(), idx)
+                                    for idx, lot_group in enumerate(self._lot_groups)]
+        self._placement = placement
+        self._size_classes = sorted(set(lot_group.get_size_class() for lot_group in self._lot_groups))
+        self._available = dict((size_class, []) for size_class in self._size_classes)
+        self._in_available = set()
+        for idx, lot_group in enumerate(self._lot_groups):
+            if lot_group.get_spot_count():
+                self._mark_available(idx)
 
         # table of ticket id to ticket objects. -- a ticket has:
         # lot_id of where the car is at right now
         # arrival time. total cost so far.
-        self._tickets_table = {}
+        # the table hands out the ticket ids, see _TicketSlots.
+        ticket_table_class = ColumnarTicketTable if compact_storage else TicketTable
+        self._tickets_table = ticket_table_class(self._lot_groups, thread_safe=concurrent)
+
+        # locking, only when concurrent. lock order is: compaction lock, ticket lock, index lock, lot group lock.
+        # - a striped lock per ticket number guards a ticket against being returned, moved or read at the same time.
+        # - every lot group has its own lock for claiming and releasing spots. spots are released under the index
+        #   lock, so listeners hear of a freed spot before another car can be parked in it. the tickets table
+        #   locks its own stripes, innermost of all.
+        # - the index lock guards every index below (upgradeable cars, compaction queue, plate and spot indexes).
+        # - the compaction lock lets only one thread compactify at a time.
+        self._concurrent = concurrent
+        if concurrent:
+            self._ticket_locks = [threading.Lock() for _ in xrange(self._TICKET_LOCK_STRIPES)]
+            self._index_lock = threading.Lock()
+            self._compaction_lock = threading.Lock()
+        else:
+            self._ticket_locks = [_NO_LOCK]
+            self._index_lock = _NO_LOCK
+            self._compaction_lock = _NO_LOCK
+
+        # compaction bookkeeping. a car parked in a lot group of a bigger size class than it needs is "upgradeable".
+        # self._upgradeable[car_size][(group_size, group_rate)] is the set of ticket numbers of cars of car_size
+        # currently parked in a lot group of size class group_size (group_size > car_size) and hourly rate
+        # group_rate. the rate matters to the 'cheapest' placement, which never moves a car to a dearer spot.
+        self._upgradeable = dict((car_size, {}) for car_size in LotSize.Sizes)
+
+        # min-heap of (size class, lot group) that had a spot freed while some upgradeable car could move into it.
+        # compaction only ever looks at these lot groups. self._compaction_pending dedupes the heap entries.
+        self._compaction_heap = []
+        self._compaction_pending = set()
+
+        self._auto_compactify = auto_compactify
+
+        # secondary indexes. plate -> ticket number, or a set of ticket numbers for a plate several parked cars
+        # have (plates are not guaranteed unique), and one dict per lot group (parallel to self._lot_groups) of
+        # lot_id -> ticket number of the car parked there, a SpotIndex with compact storage.
+        self._plate_index = {}
+        if compact_storage:
+            self._spot_index = [SpotIndex(lot_group.get_spot_count()) for lot_group in self._lot_groups]
+        else:
+            self._spot_index = [{} for _ in self._lot_groups]
+
+        # objects told about every park, return and relocation, see add_listener.
+        self._listeners = []
+
+        # reservations, guarded by the index lock. reservation id -> (lot group index, start, end), and a min-heap
+        # of (end, reservation id) to drop reservations nobody came for once they are over. the spots themselves
+        # are held in the CapacityIndex of each lot group.
+        self._reservations = {}
+        self._reservation_ends = []
+        self._reservation_ids = itertools.count(1)
+
+        # waitlist of cars that found no spot, guarded by the index lock. one FIFO per car size of entries
+        # [wait id, car, on_parked callback, time joined], and wait id -> entry of every car still waiting. wait ids
+        # go up, so of the cars at the front of their queues the one with the lowest wait id has waited longest. a car
+        # that leaves the waitlist is only dropped from self._waiting, its queue skips it when it gets to the front.
+        self._waitlists = dict((car_size, collections.deque()) for car_size in LotSize.Sizes)
+        self._waiting = {}
+        self._wait_ids = itertools.count(1)
+        self._waitlist_stats = dict((car_size, {'waiting': 0, 'joined': 0, 'served': 0, 'left': 0, 'total_wait': 0,
+                                                'max_wait': 0})
+                                    for car_size in LotSize.Sizes)
+
+    def _ticket_lock(self, ticket_no):
+        """ Return the lock that guards the ticket with the given ticket number. """
+
+        if not isinstance(ticket_no, (int, long)):
+            # there is no such ticket, the lookup under the lock finds nothing.
+            return self._ticket_locks[0]
+
+        return self._ticket_locks[ticket_no % len(self._ticket_locks)]
+
+    def _mark_available(self, lot_group_index):
+        """ Put the lot group at lot_group_index back in the placement index. Call with the index lock held. """
+
+        if lot_group_index not in self._in_available:
+            self._in_available.add(lot_group_index)
+            heapq.heappush(self._available[self._lot_groups[lot_group_index].get_size_class()],
+                           self._placement_keys[lot_group_index])
+
+    def _find_best_lot_group(self, car, smaller_than=None, hold_time=None):
+        """ Return the best lot group for car by the placement policy among the ones that fit car and have space,
+        or None if there is no such group. If smaller_than is given only lot groups of a size class smaller than
+        that are considered. If hold_time is given lot groups whose free spots are all held for reservations at
+        that time are skipped too. Takes O(log(number of lot groups)) per size class. Call with the index lock
+        held. """
+
+        if hold_time is not None:
+            self._expire_reservations(hold_time)
+
+        lot_groups = self._lot_groups
+        best = None
+
+        # size classes the car fits in, smallest first.
+        for size_class in self._size_classes[bisect.bisect_left(self._size_classes, car.get_size()):]:
+            if smaller_than is not None and size_class >= smaller_than:
+                break
+
+            # lot groups whose free spots are all held are dropped like full ones. spots only stop being held when
+            # their reservation is dropped, and _drop_reservation() puts the lot group back.
+            heap = self._available[size_class]
+            while heap:
+                lot_group = lot_groups[heap[0][-1]]
+                if lot_group.has_space() if hold_time is None else lot_group.has_space_for_walk_in(hold_time):
+                    break
+                self._in_available.discard(heapq.heappop(heap)[-1])
+
+            if not heap:
+                continue
+
+            top = heap[0]
+            if best is None or top < best:
+                best = top
+
+                # keys start with the size class, the first one found is the smallest.
+                if 'smallest' == self._placement:
+                    break
+
+        if best is None:
+            return None
 
-        # use this to implement an auto increment like ticket id allocation
-        self._next_ticket_id = 1000
+        return self._lot_groups[best[-1]]
 
-    def _allocate_new_ticket_id(self):
-        """ Return a new unique ticket id while keeping track of previously allocated ticket ids so as to not 
-        re-use them. """
+    def _get_best_spot(self, car, now=None):
+        """ Given a car find and return a suitable spot as a 2-tuple (lot_group, lot id) for it to park in. 
+        return (None, None) if no such spot exists. Spots held for reservations at time now, by default the
+        current time, are left free.
+        """
 
-        tid = self._next_ticket_id
-        self._next_ticket_id +=1
-        return tid
+        # turn a car away from a full lot without looking at any lot group.
+        if self._free_spots[car.get_size()] <= 0:
+            return (None, None)
 
+        hold_time = self._get_hold_time(now)
 
-    def _get_best_spot(self, car):
-        """ Given a car find and return a suitable spot as a 2-tuple (lot_group, lot id) for it to park in. 
-        return (None, None) if no such spot exists. 
-        """
+        while True:
+            with self._index_lock:
+                lot_group = self._find_best_lot_group(car, hold_time=hold_time)
+                keep_free = self._get_held_spots(lot_group, hold_time)
 
-        # lot groups are ordered from smallest to largest.
-        for lot_group in self._lot_groups:
-            if lot_group.can_fit(car) and lot_group.has_space():
+            if lot_group is None:
+                return (None, None)
+
+            # has_space() is only a hint, other threads can take the last spot right after the lookup. claim_spot()
+            # does the actual atomic check and claim, and the next lookup drops a lot group that filled up.
+            lot_id = lot_group.claim_spot(car, keep_free)
+            if lot_id is not None:
+                return (lot_group, lot_id)
+
+    def _get_hold_time(self, now):
+        """ Return the time to check for spots held for reservations at: now, or the current time if now is None.
+        Return None if there are no reservations, so nothing is held and the clock is not even read. """
+
+        if not self._reservations:
+            return None
+
+        return self._clock.get_time() if now is None else now
+
+    def _get_held_spots(self, lot_group, hold_time):
+        """ Return the number of spots of lot_group held for reservations at hold_time, see _get_hold_time().
+        Call with the index lock held. """
+
+        if lot_group is None or hold_time is None:
+            return 0
+
+        return lot_group.get_reservations().get_held(hold_time)
+
+    def _issue_ticket(self, car, lot_group, lot_id, now=None):
+        """ Issue a new ticket for car that was just parked at lot_id in lot_group. Return the ticket number. """
+
+        if now is None:
+            now = self._clock.get_time()
+
+        # save it into allocated tickets. the ticket number is new, so no other thread can look it up before the
+        # indexes below are updated.
+        ticket_id = self._tickets_table.issue(lot_group, lot_id, now=now)
+
+        with self._index_lock:
+            self._index_spot(ticket_id, car, lot_group, lot_id)
+            self._index_plate(ticket_id, car)
+
+            for listener in self._listeners:
+                listener.on_park(ticket_id, car, self._lot_group_index[lot_group], lot_id, now)
+
+        return ticket_id
+
+    def _restore_ticket(self, ticket_no, car, lot_group_index, lot_id, issue_time, start_time, cost_so_far):
+        """ Put back a parked car and its ticket exactly as recorded, e.g. in a snapshot or a journal. Listeners
+        are not told about it. """
+
+        lot_group = self._lot_groups[lot_group_index]
+        lot_group.park_car_at(lot_id, car)
+        self._tickets_table.restore(ticket_no, lot_group, lot_id, issue_time, start_time, cost_so_far)
+
+        with self._index_lock:
+            self._index_spot(ticket_no, car, lot_group, lot_id)
+            self._index_plate(ticket_no, car)
+
+    def _release_ticket(self, ticket_no, now=None):
+        """ Remove the ticket with the given ticket number, free its spot and return (car, cost).
+        Return (None, None) if there is no such ticket. """
+
+        if now is None:
+            now = self._clock.get_time()
+
+        with self._ticket_lock(ticket_no):
+            if not self._tickets_table.has_key(ticket_no):
+                return (None, None)
+
+            ticket = self._tickets_table[ticket_no]
+            cost = ticket.get_cost(now=now)
+            current_lot_group, current_lot_id = ticket.get_current_car_spot()
+
+            # read the ticket before deleting it, a columnar table may reuse its row. delete it and free the spot
+            # under the index lock, so listeners hear of the return before its slot or spot go to another car.
+            with self._index_lock:
+                del self._tickets_table[ticket_no]
+                car = current_lot_group.release_spot(lot_id=current_lot_id)
+                self._unindex_spot(ticket_no, car, current_lot_group, current_lot_id)
+                self._unindex_plate(ticket_no, car)
+                self._spot_freed(current_lot_group)
+
+                for listener in self._listeners:
+                    listener.on_return(ticket_no, now)
+
+        return car, cost
+
+    def _index_plate(self, ticket_no, car):
+        """ Record ticket_no in the plate index. """
+
+        plate = car.get_plate()
+        plate_tickets = self._plate_index.get(plate)
+        if plate_tickets is None:
+            # almost every plate has one car parked at a time, a set each would be most of the index.
+            self._plate_index[plate] = ticket_no
+        elif isinstance(plate_tickets, set):
+            plate_tickets.add(ticket_no)
+        else:
+            self._plate_index[plate] = set([plate_tickets, ticket_no])
+
+    def _unindex_plate(self, ticket_no, car):
+        """ Remove ticket_no from the plate index. """
 
-                # this code is not multi thread in general, so presumably we don't deal with possibility that
-                # space can be exhausted underneath us, just after we check for existence of empty space.
-                return (lot_group, lot_group.find_spot_and_park(car))
+        plate = car.get_plate()
+        plate_tickets = self._plate_index[plate]
+        if not isinstance(plate_tickets, set):
+            if plate_tickets == ticket_no:
+                del self._plate_index[plate]
+            return
 
-        return (None, None)
+        plate_tickets.discard(ticket_no)
+        if len(plate_tickets) == 1:
+            self._plate_index[plate] = plate_tickets.pop()
 
+    def _index_spot(self, ticket_no, car, lot_group, lot_id):
+        """ Record that car with ticket_no is now parked at lot_id in lot_group. Keeps the spot index up to date
+        and remembers ticket_no as upgradeable if car is parked in a bigger lot group than it needs. """
 
+        self._spot_index[self._lot_group_index[lot_group]][lot_id] = ticket_no
 
+        for car_size in self._counted_sizes[lot_group]:
+            self._free_spots[car_size] -= 1
 
-    def _relocate_car_to_best_spot(self, ticket):
-        """ Given a ticket for a car, see if we can park this car in a better location and do so if possible. """
+        if car.get_size() < lot_group.get_size_class():
+            group = (lot_group.get_size_class(), lot_group.get_hourly_rate())
+            self._upgradeable[car.get_size()].setdefault(group, set()).add(ticket_no)
 
-        assert isinstance(ticket, Ticket)
+    def _unindex_spot(self, ticket_no, car, lot_group, lot_id):
+        """ Record that car with ticket_no is no longer parked at lot_id in lot_group. """
+
+        spot_index = self._spot_index[self._lot_group_index[lot_group]]
+        assert spot_index.get(lot_id) == ticket_no
+        del spot_index[lot_id]
+
+        for car_size in self._counted_sizes[lot_group]:
+            self._free_spots[car_size] += 1
+
+        self._mark_available(self._lot_group_index[lot_group])
+
+        if car.get_size() < lot_group.get_size_class():
+            group = (lot_group.get_size_class(), lot_group.get_hourly_rate())
+            self._upgradeable[car.get_size()][group].discard(ticket_no)
+
+    def _find_upgradeable_ticket(self, lot_group):
+        """ Return the ticket number of an upgradeable car that could move into lot_group, or None. Prefer the
+        biggest car parked in the biggest lot group, so the most expensive spots free up first. Under the
+        'cheapest' placement only cars parked at a rate no lower than that of lot_group are considered, a move must
+        not make a car dearer. Call with the index lock held. """
+
+        size = lot_group.get_size_class()
+        rate = lot_group.get_hourly_rate() if 'cheapest' == self._placement else None
+
+        for car_size in sorted(self._upgradeable, reverse=True):
+            if car_size > size:
+                continue
+
+            by_group = self._upgradeable[car_size]
+            for group_size, group_rate in sorted(by_group, reverse=True):
+                if group_size > size and (rate is None or group_rate >= rate) and by_group[(group_size, group_rate)]:
+                    return next(iter(by_group[(group_size, group_rate)]))
+
+        return None
+
+    def _spot_freed(self, lot_group):
+        """ Note that a spot in lot_group was just freed. Queue lot_group for compaction if any upgradeable car
+        could move into it. Call with the index lock held. """
+
+        if lot_group in self._compaction_pending:
+            return
+
+        if self._find_upgradeable_ticket(lot_group) is not None:
+            self._compaction_pending.add(lot_group)
+            heapq.heappush(self._compaction_heap, (lot_group.get_size_class(), lot_group))
+
+    def _relocate_car_to_best_spot(self, ticket_no, now=None):
+        """ Given a ticket number, see if we can park its car in a better location and do so if possible.
+        Return True if the car was moved. """
+
+        with self._ticket_lock(ticket_no):
+            # the car may have left since ticket_no was picked.
+            if not self._tickets_table.has_key(ticket_no):
+                return False
+
+            ticket = self._tickets_table[ticket_no]
+            existing_lot_group, existing_lot_id = ticket.get_current_car_spot()
+
+            car = existing_lot_group.get_car(lot_id=existing_lot_id)
+
+            assert isinstance(car, Car)
+
+            hold_time = self._get_hold_time(now)
+            with self._index_lock:
+                lot_group = self._find_best_lot_group(car, smaller_than=existing_lot_group.get_size_class(),
+                                                      hold_time=hold_time)
+                keep_free = self._get_held_spots(lot_group, hold_time)
+
+            # only ever move a car to a spot the placement policy ranks better than the one it has.
+            if lot_group is None or (self._placement_keys[self._lot_group_index[lot_group]] >=
+                                     self._placement_keys[self._lot_group_index[existing_lot_group]]):
+                return False
+
+            # claim the new spot before giving up the old one, so the car always has a spot.
+            new_lot_id = lot_group.claim_spot(car=car, keep_free=keep_free)
+            if new_lot_id is None:
+                return False
+
+            self._move_car(ticket_no, ticket, car, lot_group, new_lot_id, now=now)
+
+        return True
+
+    def _move_car(self, ticket_no, ticket, car, new_lot_group, new_lot_id, now=None):
+        """ Finish moving car with ticket_no to new_lot_id in new_lot_group, which the car already holds: give up
+        its old spot, update the ticket and the indexes. Call with the ticket lock held. """
+
+        if now is None:
+            now = self._clock.get_time()
 
         existing_lot_group, existing_lot_id = ticket.get_current_car_spot()
+        ticket.update_car_location(new_lot_id=new_lot_id, new_lot_group=new_lot_group, now=now)
 
-        car = existing_lot_group.get_car(lot_id=existing_lot_id)
+        with self._index_lock:
+            car2 = existing_lot_group.release_spot(lot_id=existing_lot_id)
+            assert  car == car2
 
-        assert isinstance(car, Car)
+            self._unindex_spot(ticket_no, car, existing_lot_group, existing_lot_id)
+            self._index_spot(ticket_no, car, new_lot_group, new_lot_id)
+            self._spot_freed(existing_lot_group)
 
-        for lot_group in self._lot_groups:
+            for listener in self._listeners:
+                listener.on_relocate(ticket_no, self._lot_group_index[new_lot_group], new_lot_id, now)
 
-            if (lot_group.can_fit(car) and lot_group.has_space() and
-                (lot_group.get_size_class() < existing_lot_group.get_size_class())):
+    def _next_waiting(self, smaller_than=None):
+        """ Take the car that has waited longest among the waiting cars there is a free spot for off the waitlist,
+        and return its entry. If smaller_than is given only cars of a size smaller than that are considered.
+        Return None if there is no such car. Looks at the front of every queue, so it takes O(number of car sizes).
+        Call with the index lock held. """
 
-                car2 = existing_lot_group.remove_car(lot_id=existing_lot_id)
-                assert  car == car2
+        best = None
+        for car_size, queue in self._waitlists.iteritems():
+            if smaller_than is not None and car_size >= smaller_than:
+                continue
 
-                new_lot_id = lot_group.find_spot_and_park(car=car)
+            while queue and queue[0][0] not in self._waiting:
+                queue.popleft()
 
-                ticket.update_car_location(new_lot_id=new_lot_id, new_lot_group=lot_group)
+            if queue and self._free_spots[car_size] > 0 and (best is None or queue[0][0] < best[0][0]):
+                best = queue
+
+        if best is None:
+            return None
+
+        entry = best.popleft()
+        del self._waiting[entry[0]]
+        return entry
+
+    def _serve_waitlist(self, now=None):
+        """ Park waiting cars, longest waiting first, for as long as there are free spots they fit in. Once they
+        are all parked call on_parked(ticket_no, car) of each, outside of every lock. Return the number of cars
+        parked. """
+
+        if now is None:
+            now = self._clock.get_time()
+
+        parked = []
+        # once a car finds no spot, the free spots are held for reservations or another thread was quicker. cars of
+        # that size or bigger only fit in lot groups that car did, so only smaller cars are tried after that.
+        smaller_than = None
+        while True:
+            with self._index_lock:
+                entry = self._next_waiting(smaller_than)
+            if entry is None:
+                break
+
+            wait_id, car, on_parked, joined = entry
+            lot_group, lot_id = self._get_best_spot(car, now=now)
+            if lot_group is None:
+                # keep its place in line.
+                with self._index_lock:
+                    self._waiting[wait_id] = entry
+                    self._waitlists[car.get_size()].appendleft(entry)
+                smaller_than = car.get_size()
+                continue
+
+            ticket_no = self._issue_ticket(car, lot_group, lot_id, now=now)
+
+            with self._index_lock:
+                stats = self._waitlist_stats[car.get_size()]
+                stats['waiting'] -= 1
+                stats['served'] += 1
+                stats['total_wait'] += now - joined
+                stats['max_wait'] = max(stats['max_wait'], now - joined)
+
+            parked.append((on_parked, ticket_no, car))
+
+        for on_parked, ticket_no, car in parked:
+            on_parked(ticket_no, car)
+
+        return len(parked)
 
     def __str__(self):
+        """ Return a human readable dump of the whole parking lot, see iter_state() for a streaming one. All costs
+        are computed for one clock reading. """
 
-        parking_lot_state =  "--------------------------- Parking lot has " + str(len(self._lot_groups)) + " lot groups"
-        for lot_group in self._lot_groups:
-            parking_lot_state += "\n" + str(lot_group)
+        now = self._clock.get_time()
 
+        lines = ["--------------------------- Parking lot has " + str(len(self._lot_groups)) + " lot groups"]
+        ticket_lines = []
 
-        if len(self._tickets_table):
-            parking_lot_state += "--------------------------- Tickets table has these entries  \n"
-            parking_lot_state += "########################### Tickets table (Ticket no -- cost so far -- Car):\n"
-            for tid, ticket in self._tickets_table.iteritems():
-                lot_group, lot_id = ticket.get_current_car_spot()
-                car = lot_group.get_car(lot_id=lot_id)
-                parking_lot_state += str(tid) + " -- " + "{:16.6f}".format(ticket.get_cost()) + " -- " + str(car) + '\n'
-            parking_lot_state += "########################### End Tickets table\n"
+        for idx, lot_group in enumerate(self._lot_groups):
+            lines.append("\n" + lot_group._str_header())
 
+            if not lot_group.get_car_count():
+                lines.append('no cars parked in this lot group. \n')
+                continue
 
-        return parking_lot_state
+            lines.append("cars parked in this lot group are: \n")
+            for _, ticket_no, cost, car in self._iter_parked(idx, now):
+                car_str = str(car)
+                lines.append("++" + car_str + "\n")
+                ticket_lines.append(str(ticket_no) + " -- " + "{:16.6f}".format(cost) + " -- " + car_str + '\n')
+
+        if ticket_lines:
+            lines.append("--------------------------- Tickets table has these entries  \n")
+            lines.append("########################### Tickets table (Ticket no -- cost so far -- Car):\n")
+            lines.extend(ticket_lines)
+            lines.append("########################### End Tickets table\n")
+
+        return "".join(lines)
+
+    # number of spots whose tickets are looked up under one hold of the index lock while exporting.
+    _EXPORT_CHUNK = 1024
+
+    def _iter_parked(self, lot_group_index, now=None):
+        """ Yield (lot_id, ticket_no, cost at now, car) for every car parked in the lot group at lot_group_index,
+        in lot_id order. Without now the tickets are not looked up and cost is None. Spots are read in chunks, so
+        memory use does not grow with the size of the lot group and in concurrent mode the index lock is never
+        held for long. """
+
+        spot_count = self._lot_groups[lot_group_index].get_spot_count()
+
+        for chunk_start in xrange(0, spot_count, self._EXPORT_CHUNK):
+            chunk_end = min(chunk_start + self._EXPORT_CHUNK, spot_count)
+
+            if self._concurrent:
+                parked = self._read_parked_chunk_locked(lot_group_index, chunk_start, chunk_end, now)
+            else:
+                parked = self._read_parked_chunk(lot_group_index, chunk_start, chunk_end, now)
+
+            for spot in parked:
+                yield spot
+
+    def _read_parked_chunk(self, lot_group_index, chunk_start, chunk_end, now):
+        """ Return the list of (lot_id, ticket_no, cost, car) of the spots chunk_start..chunk_end-1 that have a car,
+        see _iter_parked(). Nothing else runs until the whole chunk is read, so the spot index and the tickets table
+        always agree. """
+
+        get_car = self._lot_groups[lot_group_index].get_car
+        get_ticket_no = self._spot_index[lot_group_index].get
+        tickets_table = self._tickets_table
+
+        parked = []
+        for lot_id in xrange(chunk_start, chunk_end):
+            ticket_no = get_ticket_no(lot_id)
+            if ticket_no is not None:
+                cost = None if now is None else tickets_table[ticket_no].get_cost(now=now)
+                parked.append((lot_id, ticket_no, cost, get_car(lot_id)))
+
+        return parked
+
+    def _read_parked_chunk_locked(self, lot_group_index, chunk_start, chunk_end, now):
+        """ Same as _read_parked_chunk(), for a controller other threads may change at the same time. """
+
+        lot_group = self._lot_groups[lot_group_index]
+        spot_index = self._spot_index[lot_group_index]
+
+        with self._index_lock:
+            occupied = [(lot_id, spot_index[lot_id]) for lot_id in xrange(chunk_start, chunk_end)
+                        if lot_id in spot_index]
+
+        parked = []
+        for lot_id, ticket_no in occupied:
+            with self._ticket_lock(ticket_no):
+                # the car may have left or moved since the spot index was read.
+                if not self._tickets_table.has_key(ticket_no):
+                    continue
+
+                ticket = self._tickets_table[ticket_no]
+                if ticket.get_current_car_spot() != (lot_group, lot_id):
+                    continue
+
+                cost = None if now is None else ticket.get_cost(now=now)
+                parked.append((lot_id, ticket_no, cost, lot_group.get_car(lot_id=lot_id)))
+
+        return parked
+
+    def iter_state(self, size_class=None):
+        """ Yield the state of the parking lot as a stream of flat dicts, in memory that does not grow with the
+        size of the lot. For every lot group, in order, there is first one record
+            {'record': 'lot_group', 'lot_group': index, 'size_class', 'spots', 'cars', 'hourly_rate'}
+        followed by one record per parked car, in lot_id order
+            {'record': 'spot', 'lot_group': index, 'lot_id', 'ticket_no', 'cost', 'plate', 'model', 'car_size'}
+        If size_class is given only lot groups of that size class are included. All costs are computed for one
+        clock reading. """
+
+        now = self._clock.get_time()
+
+        for idx, lot_group in enumerate(self._lot_groups):
+            if size_class is not None and lot_group.get_size_class() != size_class:
+                continue
+
+            yield {'record': 'lot_group', 'lot_group': idx, 'size_class': lot_group.get_size_class(),
+                   'spots': lot_group.get_spot_count(), 'cars': lot_group.get_car_count(),
+                   'hourly_rate': lot_group.get_hourly_rate()}
+
+            for lot_id, ticket_no, cost, car in self._iter_parked(idx, now):
+                yield {'record': 'spot', 'lot_group': idx, 'lot_id': lot_id, 'ticket_no': ticket_no, 'cost': cost,
+                       'plate': car.get_plate(), 'model': car.get_model(), 'car_size': car.get_size()}
+
+    EXPORT_FORMATS = ['csv', 'jsonl']
+
+    # columns of a csv export, records leave the columns they do not have empty.
+    EXPORT_FIELDS = ['record', 'lot_group', 'size_class', 'spots', 'cars', 'hourly_rate', 'lot_id', 'ticket_no',
+                     'cost', 'plate', 'model', 'car_size']
+
+    def export_state(self, out, format='csv', size_class=None):
+        """ Write the records of iter_state(size_class) to the file object out, as csv with a header row
+        (columns EXPORT_FIELDS) or as JSON lines. Return the number of records written. """
+
+        assert format in self.EXPORT_FORMATS
+
+        records = self.iter_state(size_class=size_class)
+        count = 0
+
+        if 'csv' == format:
+            writer = csv.writer(out, lineterminator='\n')
+            writer.writerow(self.EXPORT_FIELDS)
+            for record in records:
+                writer.writerow([record.get(field, '') for field in self.EXPORT_FIELDS])
+                count += 1
+        else:
+            for record in records:
+                out.write(json.dumps(record) + '\n')
+                count += 1
+
+        return count
 
 #-----------------------------------------------------------------------------------------------------------------------
 #-----------------------------------------------------------------------------------------------------------------------
 #----------------------------------------------------------------------------------------------------------- Public API
     def compactify_parking_lot(self):
+        """ Move cars parked in bigger spots than they need into smaller spots freed up since the last compaction.
+        Only lot groups that had a spot freed are visited, so the cost scales with the number of possible moves.
+        Return the number of cars moved. """
+
+        moves = 0
+        now = self._clock.get_time()
+        hold_time = self._get_hold_time(now)
+
+        with self._compaction_lock:
+            # always fill the smallest freed lot group first. a move only ever frees a spot in a bigger lot group
+            # than the one being filled, so no car is moved twice in one call.
+            while True:
+                with self._index_lock:
+                    if not self._compaction_heap:
+                        break
+
+                    _, lot_group = heapq.heappop(self._compaction_heap)
+                    self._compaction_pending.discard(lot_group)
+
+                while True:
+                    with self._index_lock:
+                        # spots held for reservations are not free for cars moving in either.
+                        if hold_time is None:
+                            has_room = lot_group.has_space()
+                        else:
+                            has_room = lot_group.has_space_for_walk_in(hold_time)
+
+                        ticket_no = self._find_upgradeable_ticket(lot_group) if has_room else None
+
+                    if ticket_no is None:
+                        break
 
-        for ticket in self._tickets_table.itervalues():
-            self._relocate_car_to_best_spot(ticket)
+                    # a failed move means the car just left or the lot group just filled up, look again.
+                    if self._relocate_car_to_best_spot(ticket_no, now=now):
+                        moves += 1
+
+        # every move frees a bigger spot than it takes, a waiting car may fit in it.
+        if moves and self._waiting:
+            self._serve_waitlist(now)
+
+        return moves
 
 
 
@@ -380,37 +2066,386 @@ class ParkingLotController(object):
         if lot_group == None or lot_id == None:
             return None
 
-        ticket = Ticket(lot_group=lot_group, lot_id=lot_id)
-        ticket_id = self._allocate_new_ticket_id()
-
-        # save it into allocated tickets
-        self._tickets_table[ticket_id] = ticket
-        return ticket_id
+        return self._issue_ticket(car, lot_group, lot_id)
 
 
     def return_car_and_get_cost_for_ticket_number(self, ticket_no):
         """ Given a ticket number previously given out by this parking lot controller, find and return 
-        the original car object as well as the total cost incurred so far as 2-tuple (car, cost) . """
+        the original car object as well as the total cost incurred so far as 2-tuple (car, cost) . If cars are
+        waiting for a spot, the freed spot goes to the one that has waited longest and fits, see join_waitlist(). """
 
-        if not self._tickets_table.has_key(ticket_no):
+        now = self._clock.get_time()
+
+        car, cost = self._release_ticket(ticket_no, now=now)
+        if car is None:
             return (None, None)
 
-        ticket = self._tickets_table[ticket_no]
-        del self._tickets_table[ticket_no]
+        if self._auto_compactify:
+            self.compactify_parking_lot()
 
-        cost = ticket.get_cost()
-        current_lot_group, current_lot_id = ticket.get_current_car_spot()
-        car = current_lot_group.remove_car(lot_id=current_lot_id)
+        # checking without the lock is only a hint, join_waitlist() serves a car that just missed this.
+        if self._waiting:
+            self._serve_waitlist(now)
 
         return car, cost
 
+    def park_cars(self, cars):
+        """ Park every car in the given iterable of cars. Return a list of ticket numbers parallel to cars, with
+        None for every car that could not be parked. The clock is read once for the whole batch. """
+
+        now = self._clock.get_time()
+
+        tickets = []
+        for car in cars:
+            lot_group, lot_id = self._get_best_spot(car, now=now)
+            if lot_group is None:
+                tickets.append(None)
+                continue
+
+            tickets.append(self._issue_ticket(car, lot_group, lot_id, now=now))
+
+        return tickets
+
+    def return_cars(self, ticket_nos):
+        """ Return the cars for every ticket number in the given iterable. Return a 2-tuple of lists (cars, costs)
+        parallel to ticket_nos, with None in both lists for every invalid ticket number. The clock is read once
+        for the whole batch, and with auto compactify on the lot is compactified once at the end. """
+
+        now = self._clock.get_time()
+
+        cars = []
+        costs = []
+        for ticket_no in ticket_nos:
+            car, cost = self._release_ticket(ticket_no, now=now)
+            cars.append(car)
+            costs.append(cost)
+
+        if self._auto_compactify:
+            self.compactify_parking_lot()
+
+        if self._waiting:
+            self._serve_waitlist(now)
+
+        return cars, costs
+
     def get_cost_for_ticket_number(self, ticket_no):
         """ Return the total cost of a ticket so far, or None if invalid ticket no supplied. """
 
-        if not self._tickets_table.has_key(ticket_no):
+        with self._ticket_lock(ticket_no):
+            if not self._tickets_table.has_key(ticket_no):
+                return None
+
+            return self._tickets_table[ticket_no].get_cost(now=self._clock.get_time())
+
+    def availability(self):
+        """ Return a dict of car size to the number of free spots a car of that size fits in, e.g. for the
+        signboard at the entrance. The counts are kept up to date on every park, return and relocation, so this
+        does not look at any lot group. Free spots held for reservations are counted too, held_spots() says how
+        many of them are held. In concurrent mode the counts may lag a park or return that is still in progress. """
+
+        with self._index_lock:
+            return dict(self._free_spots)
+
+    def held_spots(self):
+        """ Return a dict of car size to the number of the free spots counted by availability() that are held for
+        reservations right now, and so are not free for a car without a reservation. This asks every lot group how
+        many spots it holds, unless there are no reservations. """
+
+        held = dict((car_size, 0) for car_size in LotSize.Sizes)
+        hold_time = self._get_hold_time(None)
+        if hold_time is None:
+            return held
+
+        with self._index_lock:
+            for lot_group in self._lot_groups:
+                group_held = min(self._get_held_spots(lot_group, hold_time),
+                                 lot_group.get_spot_count() - lot_group.get_car_count())
+                for car_size in self._counted_sizes[lot_group]:
+                    held[car_size] += group_held
+
+            # the lot groups may be a park or return ahead of self._free_spots in concurrent mode.
+            for car_size in LotSize.Sizes:
+                held[car_size] = min(held[car_size], self._free_spots[car_size])
+
+        return held
+
+    def reserve(self, car_size, start, end):
+        """ Hold a spot a car of car_size fits in from time start to time end. The lot group is picked by the
+        placement policy among the ones with a spot free over the whole window, counting only other reservations:
+        cars parked now are expected to be gone by then. From start on cars without a reservation are kept out of
+        held spots. Return a reservation id to pass to park_reserved_car() when the car arrives, or None if every
+        lot group the car fits in is booked up. Reservations nobody came for are dropped once they are over. """
+
+        assert car_size in LotSize.Sizes
+        assert start < end
+
+        with self._index_lock:
+            self._expire_reservations(self._clock.get_time())
+
+            for key in sorted(self._placement_keys[idx] for idx, lot_group in enumerate(self._lot_groups)
+                              if lot_group.get_size_class() >= car_size):
+                lot_group = self._lot_groups[key[-1]]
+                reservations = lot_group.get_reservations()
+                if reservations.get_max_held(start, end) < lot_group.get_spot_count():
+                    reservations.hold(start, end)
+                    reservation_id = next(self._reservation_ids)
+                    self._reservations[reservation_id] = (key[-1], start, end)
+                    heapq.heappush(self._reservation_ends, (end, reservation_id))
+                    return reservation_id
+
+        return None
+
+    def get_reservation(self, reservation_id):
+        """ Return (lot group index, start, end) of a reservation, or None if there is no such reservation. """
+
+        with self._index_lock:
+            return self._reservations.get(reservation_id)
+
+    def cancel_reservation(self, reservation_id):
+        """ Give up a reservation and its spot. Return False if there is no such reservation. """
+
+        with self._index_lock:
+            cancelled = self._drop_reservation(reservation_id) is not None
+
+        # the spot it held may be the one a waiting car needs.
+        if cancelled and self._waiting:
+            self._serve_waitlist()
+
+        return cancelled
+
+    def park_reserved_car(self, reservation_id, car):
+        """ Park car, which came for a reservation, in the lot group the reservation holds a spot in and return its
+        ticket number. The reservation is used up. If that lot group has no free spot after all, e.g. because
+        cars that were there before the reservation was made have not left, the car is parked like any other.
+        Return None if there is no such reservation or no spot for the car. """
+
+        now = self._clock.get_time()
+
+        with self._index_lock:
+            self._expire_reservations(now)
+            lot_group_index = self._drop_reservation(reservation_id)
+            if lot_group_index is None:
+                return None
+
+            lot_group = self._lot_groups[lot_group_index]
+            keep_free = self._get_held_spots(lot_group, now)
+
+        lot_id = lot_group.claim_spot(car, keep_free) if lot_group.can_fit(car) else None
+        if lot_id is None:
+            lot_group, lot_id = self._get_best_spot(car, now=now)
+            if lot_group is None:
+                return None
+
+        return self._issue_ticket(car, lot_group, lot_id, now=now)
+
+    def get_reservable_count(self, car_size, start, end):
+        """ Return how many more cars of car_size could get a reservation from time start to time end. Takes
+        O(log(time range)) per lot group, see CapacityIndex. """
+
+        assert start < end
+
+        with self._index_lock:
+            return sum(max(0, lot_group.get_spot_count() - lot_group.get_reservations().get_max_held(start, end))
+                       for lot_group in self._lot_groups if lot_group.get_size_class() >= car_size)
+
+    def _drop_reservation(self, reservation_id):
+        """ Forget a reservation and release its spot. Return its lot group index, or None if there is no such
+        reservation. Call with the index lock held. """
+
+        reservation = self._reservations.pop(reservation_id, None)
+        if reservation is None:
             return None
 
-        return self._tickets_table[ticket_no].get_cost()
+        lot_group_index, start, end = reservation
+        self._lot_groups[lot_group_index].get_reservations().release(start, end)
+        # the spot may be the only one the placement index skipped the lot group for.
+        self._mark_available(lot_group_index)
+        return lot_group_index
+
+    def _expire_reservations(self, now):
+        """ Drop the reservations that were over by now. Call with the index lock held. """
+
+        ends = self._reservation_ends
+        while ends and ends[0][0] <= now:
+            # cancelled and used reservations are gone already.
+            self._drop_reservation(heapq.heappop(ends)[1])
+
+    def join_waitlist(self, car, on_parked):
+        """ Put car, which found no spot, at the back of the waitlist of its size. Whenever a spot frees up it goes
+        to the car that has waited longest among the ones it fits, which is parked right then and reported with
+        on_parked(ticket_no, car), called by the thread that freed the spot. If there is a free spot for car
+        already, it is parked before this returns. Return a wait id for leave_waitlist(). """
+
+        now = self._clock.get_time()
+
+        with self._index_lock:
+            wait_id = next(self._wait_ids)
+            entry = [wait_id, car, on_parked, now]
+            self._waitlists[car.get_size()].append(entry)
+            self._waiting[wait_id] = entry
+
+            stats = self._waitlist_stats[car.get_size()]
+            stats['waiting'] += 1
+            stats['joined'] += 1
+
+            has_spot = self._free_spots[car.get_size()] > 0
+
+        # a spot may have come free since the car was turned away.
+        if has_spot:
+            self._serve_waitlist(now)
+
+        return wait_id
+
+    def leave_waitlist(self, wait_id):
+        """ Take a car off the waitlist, e.g. because the driver gave up. Return False if it is not waiting anymore,
+        because it got a spot or already left. """
+
+        with self._index_lock:
+            entry = self._waiting.pop(wait_id, None)
+            if entry is None:
+                return False
+
+            stats = self._waitlist_stats[entry[1].get_size()]
+            stats['waiting'] -= 1
+            stats['left'] += 1
+
+        return True
+
+    def get_waitlist_depth(self, car_size=None):
+        """ Return the number of cars of car_size waiting for a spot, or of all sizes if car_size is None. """
+
+        with self._index_lock:
+            if car_size is None:
+                return len(self._waiting)
+
+            return self._waitlist_stats[car_size]['waiting']
+
+    def get_waitlist_stats(self):
+        """ Return a dict of car size to a dict with:
+            'waiting': number of cars waiting right now.
+            'joined', 'served', 'left': number of cars that joined the waitlist, got a spot from it and left it
+                                        without one, so far.
+            'average_wait', 'max_wait': mean and longest seconds the cars that got a spot waited, None if none did.
+            'oldest_wait': seconds the car at the front of the queue has waited so far, None if no car waits. """
+
+        now = self._clock.get_time()
+
+        with self._index_lock:
+            waitlist_stats = {}
+            for car_size, stats in self._waitlist_stats.iteritems():
+                oldest = next((entry for entry in self._waitlists[car_size] if entry[0] in self._waiting), None)
+                waitlist_stats[car_size] = {
+                    'waiting': stats['waiting'], 'joined': stats['joined'], 'served': stats['served'],
+                    'left': stats['left'],
+                    'average_wait': (float(stats['total_wait']) / stats['served']) if stats['served'] else None,
+                    'max_wait': stats['max_wait'] if stats['served'] else None,
+                    'oldest_wait': (now - oldest[3]) if oldest is not None else None}
+
+        return waitlist_stats
+
+    def get_clock(self):
+        return self._clock
+
+    def set_clock(self, clock):
+        """ Read the time from clock from now on, see __init__. Return the clock that was in use before. """
+
+        previous = self._clock
+        self._clock = clock
+        return previous
+
+    def add_listener(self, listener):
+        """ Tell listener about every change to the parked cars from now on. listener must have the methods
+            on_park(ticket_no, car, lot_group_index, lot_id, now)
+            on_return(ticket_no, now)
+            on_relocate(ticket_no, lot_group_index, lot_id, now)
+        which are called in the order the changes happen, right after each change. """
+
+        with self._index_lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """ Stop telling listener about changes. """
+
+        with self._index_lock:
+            self._listeners.remove(listener)
+
+    def find_tickets_by_plate(self, plate):
+        """ Return a sorted list of the ticket numbers of all parked cars with the given plate. """
+
+        with self._index_lock:
+            plate_tickets = self._plate_index.get(plate)
+
+        if plate_tickets is None:
+            return []
+        if isinstance(plate_tickets, set):
+            return sorted(plate_tickets)
+        return [plate_tickets]
+
+    def get_ticket_for_spot(self, lot_group_index, lot_id):
+        """ Return the ticket number of the car parked at lot_id in the lot group at position lot_group_index,
+        or None if that spot is free. """
+
+        with self._index_lock:
+            return self._spot_index[lot_group_index].get(lot_id)
+
+    def get_tickets_in_lot_group(self, lot_group_index):
+        """ Return a list of the ticket numbers of all cars parked in the lot group at position lot_group_index.
+        With compact storage this goes over every spot of the lot group. """
+
+        with self._index_lock:
+            return self._spot_index[lot_group_index].values()
+
+    def get_outstanding_revenue(self, per_ticket=False):
+        """ Return the current cost of every open ticket, computed in one pass over the tickets table with a
+        single clock reading. The result is a dict with:
+            'time': the time the costs were computed for.
+            'total': the sum of the cost of all open tickets.
+            'by_lot_group': list of totals, parallel to the lot groups.
+            'by_size_class': dict of lot group size class to total.
+        if per_ticket is True the dict also has 'tickets', a 2-tuple of (list of ticket numbers, array of costs). """
+
+        now = self._clock.get_time()
+
+        # sum up the columns per lot group, then apply each flat rate lot group's rate once:
+        # sum(cost_so_far + (now - start) * rate / 3600) == sum(cost_so_far) + (count * now - sum(start)) * rate / 3600
+        counts, start_sums, cost_sums = self._tickets_table.group_sums(self._lot_group_index)
+
+        # a rate schedule does not add up like that, its tickets take one more pass.
+        schedules = [lot_group.get_rate_schedule() for lot_group in self._lot_groups]
+        scheduled_sums = [0.0] * len(self._lot_groups)
+        if any(schedules):
+            for _, idx, start, _ in self._tickets_table.iter_cost_columns(self._lot_group_index):
+                if schedules[idx] is not None:
+                    scheduled_sums[idx] += schedules[idx].get_cost_between(start, now)
+
+        by_lot_group = []
+        by_size_class = dict((size, 0.0) for size in LotSize.Sizes)
+        for idx, lot_group in enumerate(self._lot_groups):
+            if schedules[idx] is None:
+                seconds_in_group = counts[idx] * now - start_sums[idx]
+                group_total = cost_sums[idx] + (seconds_in_group / 3600.0) * lot_group.get_hourly_rate()
+            else:
+                group_total = cost_sums[idx] + scheduled_sums[idx]
+            by_lot_group.append(group_total)
+            by_size_class[lot_group.get_size_class()] += group_total
+
+        revenue = {'time': now, 'total': sum(by_lot_group), 'by_lot_group': by_lot_group,
+                   'by_size_class': by_size_class}
+
+        if per_ticket:
+            rates = [lot_group.get_hourly_rate() / 3600.0 for lot_group in self._lot_groups]
+            ticket_nos = []
+            costs = array('d')
+            for ticket_no, idx, start, cost_so_far in self._tickets_table.iter_cost_columns(self._lot_group_index):
+                ticket_nos.append(ticket_no)
+                if schedules[idx] is None:
+                    costs.append(cost_so_far + (now - start) * rates[idx])
+                else:
+                    costs.append(cost_so_far + schedules[idx].get_cost_between(start, now))
+
+            revenue['tickets'] = (ticket_nos, costs)
+
+        return revenue
 
 
 
@@ -0,0 +1,461 @@
+""" Crash safe persistence for a ParkingLotController: an append only journal of park/return/relocate events
+with group commit, periodic compact binary snapshots, and recovery from the latest snapshot plus the journal tail.
+
+Everything lives in one directory:
+    journal.<epoch>     journal files. a new epoch starts every time a snapshot is taken.
+    snapshot            the latest snapshot. it names the journal epoch and offset it is current up to.
+
+typical use:
+    pc = ParkingLotController(...)
+    recover(pc, directory)                  # no-op for a new directory
+    journal = Journal(directory)
+    journal.attach(pc)                      # from now on every change is journaled
+    ...
+    journal.write_snapshot()                # every now and then, or pass snapshot_every to Journal
+"""
+
+import mmap
+import operator
+import os
+import struct
+import threading
+import time
+from array import array
+
+from parkinglot import Car, _AllLocked
+
+
+JOURNAL_PREFIX = 'journal.'
+SNAPSHOT_NAME = 'snapshot'
+
+# journal records: a header of (op, payload length) followed by the payload.
+_OP_PARK = 1
+_OP_RETURN = 2
+_OP_RELOCATE = 3
+
+_RECORD_HEADER = struct.Struct('<BH')
+# ticket_no, lot group index, lot_id, time, car size, plate length, model length. followed by plate and model.
+_PARK = struct.Struct('<qHqdBHH')
+# ticket_no, time
+_RETURN = struct.Struct('<qd')
+# ticket_no, new lot group index, new lot_id, time
+_RELOCATE = struct.Struct('<qHqd')
+
+# snapshot: header, then one entry per lot group, then the ticket columns in this order.
+_SNAPSHOT_MAGIC = 'PLSNAP02'
+# magic, journal epoch, journal offset, next ticket generation, lot group count, ticket count.
+_SNAPSHOT_HEADER = struct.Struct('<8sQQqHQ')
+# lot group size class, spot count, hourly rate.
+_SNAPSHOT_GROUP = struct.Struct('<Bqd')
+# columns are written straight from native arrays ('l' is 8 bytes on 64 bit linux, the array module of python 2
+# has no fixed size 'q'), so a snapshot only loads on a machine with the same word size and byte order.
+_SNAPSHOT_COLUMNS = [('ticket_no', 'l'), ('group_idx', 'H'), ('lot_id', 'l'), ('issue_time', 'd'),
+                     ('start_time', 'd'), ('cost_so_far', 'd'), ('car_size', 'B'), ('plate_len', 'H'),
+                     ('model_len', 'H')]
+
+
+def _journal_epochs(directory):
+    """ Return the sorted list of journal epochs in directory. """
+
+    epochs = []
+    for name in os.listdir(directory):
+        if name.startswith(JOURNAL_PREFIX) and name[len(JOURNAL_PREFIX):].isdigit():
+            epochs.append(int(name[len(JOURNAL_PREFIX):]))
+
+    return sorted(epochs)
+
+
+def _journal_path(directory, epoch):
+    return os.path.join(directory, JOURNAL_PREFIX + str(epoch))
+
+
+class Journal(object):
+    """ Append only journal of every change to a controller. Records are buffered and written with one write
+    (and one fsync) per batch: when batch_size records are waiting, or max_delay seconds after the oldest waiting
+    record, whichever comes first. Batches are written by a background thread, so the controller only ever pays
+    for adding a record to the buffer. A change is only durable once its batch is written, call sync() where a
+    caller must not go on before that. """
+
+    def __init__(self, directory, batch_size=256, max_delay=0.005, fsync=True, snapshot_every=None):
+        """ Start a new journal epoch in directory. If snapshot_every is given a snapshot is written every that many
+        records, see write_snapshot(). """
+
+        super(Journal, self).__init__()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._directory = directory
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._fsync = fsync
+        self._snapshot_every = snapshot_every
+
+        self._controller = None
+
+        # guards the buffer, the current epoch and file, and the record count. the controller appends records
+        # under its index lock, so nothing slow ever runs with this lock held.
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._oldest_buffered = None
+        self._records_since_snapshot = 0
+        # (file, records) of epochs a snapshot closed, still to be written out and closed, oldest first.
+        self._retired = []
+
+        # held while batches are written, so they reach the files in the order they were taken off the buffer.
+        self._write_lock = threading.Lock()
+
+        epochs = _journal_epochs(directory)
+        self._open_epoch((epochs[-1] + 1) if epochs else 1)
+
+        # the flusher writes full batches as soon as it is woken up and the rest once they are max_delay old.
+        self._closed = threading.Event()
+        self._wake = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, name='journal flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _open_epoch(self, epoch):
+        self._epoch = epoch
+        self._file = open(_journal_path(self._directory, epoch), 'ab')
+
+    def attach(self, controller):
+        """ Start journaling every change to controller. """
+
+        self._controller = controller
+        controller.add_listener(self)
+
+    def on_park(self, ticket_no, car, lot_group_index, lot_id, now):
+        plate = car.get_plate()
+        model = car.get_model()
+        payload = _PARK.pack(ticket_no, lot_group_index, lot_id, now, car.get_size(), len(plate), len(model))
+        self._append(_OP_PARK, payload + plate + model)
+
+    def on_return(self, ticket_no, now):
+        self._append(_OP_RETURN, _RETURN.pack(ticket_no, now))
+
+    def on_relocate(self, ticket_no, lot_group_index, lot_id, now):
+        self._append(_OP_RELOCATE, _RELOCATE.pack(ticket_no, lot_group_index, lot_id, now))
+
+    def _append(self, op, payload):
+        with self._lock:
+            self._buffer.append(_RECORD_HEADER.pack(op, len(payload)) + payload)
+            self._records_since_snapshot += 1
+
+            if self._oldest_buffered is None:
+                self._oldest_buffered = time.time()
+
+            snapshot_due = self._snapshot_due()
+            wake = len(self._buffer) >= self._batch_size or snapshot_due
+
+        # nothing else may touch a controller that is not concurrent, so its snapshots are taken right here, in
+        # between two changes. the flusher takes them for a concurrent one.
+        if snapshot_due and not self._controller._concurrent:
+            self.write_snapshot()
+        elif wake:
+            self._wake.set()
+
+    def _snapshot_due(self):
+        return self._snapshot_every and self._records_since_snapshot >= self._snapshot_every
+
+    def _write_out(self):
+        """ Write out every buffered record, in order, and finish the epochs a snapshot closed. Call without
+        holding self._lock. """
+
+        with self._write_lock:
+            with self._lock:
+                retired = self._retired
+                self._retired = []
+                records = self._buffer
+                self._buffer = []
+                self._oldest_buffered = None
+                current_file = self._file
+
+            for retired_file, retired_records in retired:
+                self._write_batch(retired_file, retired_records)
+                retired_file.close()
+
+            self._write_batch(current_file, records)
+
+    def _write_batch(self, journal_file, records):
+        if records:
+            journal_file.write(''.join(records))
+            journal_file.flush()
+            if self._fsync:
+                os.fsync(journal_file.fileno())
+
+    def _flush_periodically(self):
+        while not self._closed.is_set():
+            self._wake.wait(self._max_delay or None)
+            self._wake.clear()
+
+            with self._lock:
+                oldest = self._oldest_buffered
+                due = len(self._buffer) >= self._batch_size or (
+                    oldest is not None and self._max_delay and time.time() - oldest >= self._max_delay)
+                snapshot_due = self._snapshot_due()
+
+            if due or self._retired:
+                self._write_out()
+
+            # records only come in once a controller is attached.
+            if snapshot_due and self._controller._concurrent:
+                self.write_snapshot()
+
+    def sync(self):
+        """ Write out every buffered record now. """
+
+        self._write_out()
+
+    def close(self):
+        """ Write out every buffered record and close the journal. """
+
+        self._closed.set()
+        self._wake.set()
+        self._flusher.join()
+
+        self._write_out()
+        with self._lock:
+            self._file.close()
+
+    def write_snapshot(self):
+        """ Write a snapshot of the attached controller and start a new journal epoch. Journal files older than
+        the snapshot are deleted. The snapshot is taken while no change is in progress in the controller, see
+        capture_snapshot(), and written out after the controller goes on. """
+
+        assert self._controller is not None
+
+        # the snapshot is current up to the very start of the new epoch: records of changes that finish after the
+        # capture go into the new epoch, the ones before into the old one.
+        with _quiesced(self._controller):
+            state = capture_snapshot(self._controller)
+
+            with self._lock:
+                self._retired.append((self._file, self._buffer))
+                self._buffer = []
+                self._oldest_buffered = None
+                self._records_since_snapshot = 0
+                old_epoch = self._epoch
+                self._open_epoch(old_epoch + 1)
+                epoch = self._epoch
+
+        # if we crash before the snapshot is in place the previous snapshot plus the journal files still recover
+        # the same state.
+        self._write_out()
+        write_snapshot_file(state, os.path.join(self._directory, SNAPSHOT_NAME), epoch, 0)
+
+        for journal_epoch in _journal_epochs(self._directory):
+            if journal_epoch <= old_epoch:
+                os.remove(_journal_path(self._directory, journal_epoch))
+
+
+def _quiesced(controller):
+    """ Return a context manager that holds every ticket lock and the index lock of controller. No return or
+    relocation is in progress while they are held, and the spot index holds exactly the parked cars the listeners
+    have been told about. Parks can still be half way, with a ticket issued but not indexed yet. """
+
+    return _AllLocked(list(controller._ticket_locks) + [controller._index_lock])
+
+
+def capture_snapshot(controller):
+    """ Return the state of controller a snapshot holds: (lot groups, next ticket generation, records), with a
+    record of (ticket_no, group_idx, lot_id, issue_time, start_time, cost_so_far, car) per parked car, in lot
+    group and lot_id order. Only cars in the spot index are included, a park that has not got that far shows up
+    in the journal after the snapshot. Call with the controller quiesced, see _quiesced(). """
+
+    indexed = set()
+    for spot_index in controller._spot_index:
+        indexed.update(spot_index.itervalues())
+
+    lot_groups = controller._lot_groups
+    records = [record + (lot_groups[record[1]].get_car(record[2]),)
+               for record in controller._tickets_table.iter_ticket_records(controller._lot_group_index)
+               if record[0] in indexed]
+
+    # tickets go out in lot group and lot_id order, so loading them back only ever parks above the high water mark.
+    records.sort(key=operator.itemgetter(1, 2))
+
+    return list(lot_groups), controller._tickets_table.get_next_generation(), records
+
+
+def write_snapshot(controller, path, journal_epoch, journal_offset):
+    """ Write a compact binary snapshot of controller to path, stating it is current up to journal_offset in the
+    journal of journal_epoch. """
+
+    with _quiesced(controller):
+        state = capture_snapshot(controller)
+
+    write_snapshot_file(state, path, journal_epoch, journal_offset)
+
+
+def write_snapshot_file(state, path, journal_epoch, journal_offset):
+    """ Write the state from capture_snapshot() to path as a compact binary snapshot. The file is written next to
+    path and renamed over it, so path always holds a complete snapshot. """
+
+    lot_groups, next_generation, records = state
+    columns = dict((name, array(typecode)) for name, typecode in _SNAPSHOT_COLUMNS)
+    strings = []
+
+    for ticket_no, group_idx, lot_id, issue_time, start_time, cost_so_far, car in records:
+        columns['ticket_no'].append(ticket_no)
+        columns['group_idx'].append(group_idx)
+        columns['lot_id'].append(lot_id)
+        columns['issue_time'].append(issue_time)
+        columns['start_time'].append(start_time)
+        columns['cost_so_far'].append(cost_so_far)
+        columns['car_size'].append(car.get_size())
+        columns['plate_len'].append(len(car.get_plate()))
+        columns['model_len'].append(len(car.get_model()))
+        strings.append(car.get_plate())
+        strings.append(car.get_model())
+
+    ticket_count = len(columns['ticket_no'])
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, journal_epoch, journal_offset, next_generation,
+                                                  len(lot_groups), ticket_count))
+        for lot_group in lot_groups:
+            snapshot_file.write(_SNAPSHOT_GROUP.pack(lot_group.get_size_class(), lot_group.get_spot_count(),
+                                                     lot_group.get_hourly_rate()))
+        for name, _ in _SNAPSHOT_COLUMNS:
+            columns[name].tofile(snapshot_file)
+        snapshot_file.write(''.join(strings))
+
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+
+    os.rename(tmp_path, path)
+
+
+def load_snapshot(controller, path):
+    """ Load the snapshot at path into controller, which must be empty and have the same lot groups as the
+    controller the snapshot was taken of. Return (journal epoch, journal offset) the snapshot is current up to. """
+
+    with open(path, 'rb') as snapshot_file:
+        snapshot = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        magic, epoch, offset, next_generation, group_count, ticket_count = \
+            _SNAPSHOT_HEADER.unpack_from(snapshot, 0)
+        if _SNAPSHOT_MAGIC != magic:
+            raise ValueError("not a parking lot snapshot: " + path)
+
+        pos = _SNAPSHOT_HEADER.size
+        lot_groups = controller._lot_groups
+        if group_count != len(lot_groups):
+            raise ValueError("snapshot has %d lot groups, controller has %d" % (group_count, len(lot_groups)))
+
+        for lot_group in lot_groups:
+            size, spot_count, _ = _SNAPSHOT_GROUP.unpack_from(snapshot, pos)
+            pos += _SNAPSHOT_GROUP.size
+            if (size, spot_count) != (lot_group.get_size_class(), lot_group.get_spot_count()):
+                raise ValueError("snapshot lot groups do not match the controller")
+
+        # each column is one contiguous block of the mapped file.
+        columns = {}
+        for name, typecode in _SNAPSHOT_COLUMNS:
+            column = array(typecode)
+            nbytes = column.itemsize * ticket_count
+            column.fromstring(snapshot[pos:pos + nbytes])
+            columns[name] = column
+            pos += nbytes
+
+        strings = snapshot[pos:]
+    finally:
+        snapshot.close()
+
+    assert len(controller._tickets_table) == 0
+
+    str_pos = 0
+    plate_lens = columns['plate_len']
+    model_lens = columns['model_len']
+    for row in xrange(ticket_count):
+        plate = strings[str_pos:str_pos + plate_lens[row]]
+        str_pos += plate_lens[row]
+        model = strings[str_pos:str_pos + model_lens[row]]
+        str_pos += model_lens[row]
+
+        controller._restore_ticket(columns['ticket_no'][row], Car(plate=plate, model=model,
+                                                                  size=columns['car_size'][row]),
+                                   columns['group_idx'][row], columns['lot_id'][row], columns['issue_time'][row],
+                                   columns['start_time'][row], columns['cost_so_far'][row])
+
+    # tickets returned before the snapshot left no trace of their generations, so no restored ticket number
+    # alone says how far the generations went.
+    controller._tickets_table.advance_generation(next_generation)
+    return epoch, offset
+
+
+def replay_journal(controller, path, offset=0):
+    """ Apply the journal at path from offset on to controller. A torn record at the end, from a crash in the
+    middle of a write, is ignored. Return the number of records applied. """
+
+    with open(path, 'rb') as journal_file:
+        journal_file.seek(offset)
+        data = journal_file.read()
+
+    pos = 0
+    applied = 0
+    while pos + _RECORD_HEADER.size <= len(data):
+        op, length = _RECORD_HEADER.unpack_from(data, pos)
+        start = pos + _RECORD_HEADER.size
+        if start + length > len(data):
+            break
+
+        if _OP_PARK == op:
+            ticket_no, group_idx, lot_id, now, size, plate_len, model_len = _PARK.unpack_from(data, start)
+            strings_pos = start + _PARK.size
+            plate = data[strings_pos:strings_pos + plate_len]
+            model = data[strings_pos + plate_len:strings_pos + plate_len + model_len]
+            controller._restore_ticket(ticket_no, Car(plate=plate, model=model, size=size), group_idx, lot_id,
+                                       now, now, 0)
+
+        elif _OP_RETURN == op:
+            ticket_no, now = _RETURN.unpack_from(data, start)
+            controller._release_ticket(ticket_no, now=now)
+
+        elif _OP_RELOCATE == op:
+            ticket_no, group_idx, lot_id, now = _RELOCATE.unpack_from(data, start)
+            ticket = controller._tickets_table[ticket_no]
+            lot_group, current_lot_id = ticket.get_current_car_spot()
+            car = lot_group.get_car(current_lot_id)
+            new_lot_group = controller._lot_groups[group_idx]
+            new_lot_group.park_car_at(lot_id, car)
+            controller._move_car(ticket_no, ticket, car, new_lot_group, lot_id, now=now)
+
+        else:
+            raise ValueError("corrupt journal record at offset %d of %s" % (offset + pos, path))
+
+        pos = start + length
+        applied += 1
+
+    return applied
+
+
+def recover(controller, directory):
+    """ Rebuild the state saved in directory into controller, which must be empty and set up with the same lot
+    groups as the one that was journaled. Loads the latest snapshot and replays only the journal after it.
+    Attach journals after recovering, so the replay itself is not journaled again. Return the number of journal
+    records replayed. """
+
+    if not os.path.isdir(directory):
+        return 0
+
+    epochs = _journal_epochs(directory)
+    snapshot_path = os.path.join(directory, SNAPSHOT_NAME)
+
+    if os.path.exists(snapshot_path):
+        epoch, offset = load_snapshot(controller, snapshot_path)
+    else:
+        epoch, offset = (epochs[0] if epochs else 0), 0
+
+    replayed = 0
+    for journal_epoch in epochs:
+        if journal_epoch < epoch:
+            continue
+
+        replayed += replay_journal(controller, _journal_path(directory, journal_epoch),
+                                   offset if journal_epoch == epoch else 0)
+
+    return replayed
@@ -0,0 +1,165 @@
+""" Discrete event simulation of a ParkingLotController on a virtual clock.
+
+The simulation keeps a heap of timed events. Running it pops them in time order, moves the virtual clock to each
+event's time and runs it, so the controller sees days of gate traffic go by at CPU speed instead of wall clock speed.
+Built in events are car arrivals and departures, periodic compaction and periodic sampling of occupancy and revenue.
+
+typical use:
+    pc = ParkingLotController(...)
+    sim = Simulation(pc, start_time=0)
+    sim.add_arrivals(arrivals)              # iterable of (arrival time, car, dwell seconds), in time order
+    sim.add_compaction(interval=900)
+    sim.add_sampling(interval=3600)
+    sim.run(until=30 * 24 * 3600)
+    for sample in sim.get_samples(): ...
+"""
+
+import heapq
+import itertools
+
+from parkinglot import VirtualClock
+
+
+class Simulation(object):
+    """ Drive a ParkingLotController with scheduled events on a VirtualClock and record what happens. """
+
+    def __init__(self, controller, start_time=0):
+        """ Set up a simulation of controller starting at start_time. The controller reads its time from the
+        virtual clock from now on, also between and after runs, so costs and revenue asked for after a run are
+        at virtual time like the tickets they are computed from. """
+
+        super(Simulation, self).__init__()
+
+        self._controller = controller
+        self._clock = VirtualClock(start_time)
+        controller.set_clock(self._clock)
+
+        # heap of (time, sequence no, callback, args). the sequence no keeps events at the same time in the order
+        # they were scheduled, and keeps the heap from ever comparing callbacks.
+        self._events = []
+        self._sequence = itertools.count()
+
+        self._parked_count = 0
+        self._rejected_count = 0
+        self._returned_count = 0
+        self._collected_revenue = 0.0
+        self._samples = []
+
+    def get_clock(self):
+        return self._clock
+
+    def get_time(self):
+        return self._clock.get_exact_time()
+
+    def get_samples(self):
+        """ Return the samples taken so far, a list of dicts. see add_sampling(). """
+
+        return self._samples
+
+    def get_stats(self):
+        """ Return a dict with the number of cars parked, rejected for lack of space and returned so far, and the
+        revenue collected from returned cars. """
+
+        return {'parked': self._parked_count, 'rejected': self._rejected_count, 'returned': self._returned_count,
+                'collected_revenue': self._collected_revenue}
+
+#-----------------------------------------------------------------------------------------------------------------------
+#-----------------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------------ Scheduling
+    def schedule(self, at, callback, *args):
+        """ Run callback(*args) when the virtual clock reaches at. """
+
+        assert at >= self._clock.get_exact_time(), "can not schedule an event in the past"
+
+        heapq.heappush(self._events, (at, next(self._sequence), callback, args))
+
+    def schedule_every(self, interval, callback, start_time=None):
+        """ Run callback() every interval seconds, first at start_time, by default one interval from now. """
+
+        assert interval > 0
+
+        if start_time is None:
+            start_time = self._clock.get_exact_time() + interval
+
+        self.schedule(start_time, self._run_periodic, interval, callback)
+
+    def _run_periodic(self, interval, callback):
+        callback()
+        self.schedule(self._clock.get_exact_time() + interval, self._run_periodic, interval, callback)
+
+    def run(self, until):
+        """ Run every event scheduled up to and including time until, then leave the clock at until. Return the
+        number of events run. """
+
+        events = self._events
+        clock = self._clock
+        event_count = 0
+
+        while events and events[0][0] <= until:
+            at, _, callback, args = heapq.heappop(events)
+            clock.set_time(at)
+            callback(*args)
+            event_count += 1
+
+        clock.set_time(max(until, clock.get_exact_time()))
+
+        return event_count
+
+#-----------------------------------------------------------------------------------------------------------------------
+#-----------------------------------------------------------------------------------------------------------------------
+#------------------------------------------------------------------------------------------------------- Built in events
+    def add_arrivals(self, arrivals):
+        """ Feed cars to the controller. arrivals is an iterable, possibly endless, of (arrival time, car, dwell)
+        in time order. Every car is parked at its arrival time and returned dwell seconds later, or counted as
+        rejected if there is no spot for it. The iterable is read lazily, one arrival ahead. """
+
+        self._schedule_next_arrival(iter(arrivals))
+
+    def _schedule_next_arrival(self, arrivals):
+        for arrival_time, car, dwell in arrivals:
+            self.schedule(arrival_time, self._arrive, arrivals, car, dwell)
+            return
+
+    def _arrive(self, arrivals, car, dwell):
+        ticket_no = self._controller.park_car_and_return_ticket_number(car)
+        if ticket_no is None:
+            self._rejected_count += 1
+        else:
+            self._parked_count += 1
+            self.schedule(self._clock.get_exact_time() + dwell, self._depart, ticket_no)
+
+        self._schedule_next_arrival(arrivals)
+
+    def _depart(self, ticket_no):
+        car, cost = self._controller.return_car_and_get_cost_for_ticket_number(ticket_no)
+        if car is not None:
+            self._returned_count += 1
+            self._collected_revenue += cost
+
+    def add_compaction(self, interval, start_time=None):
+        """ Compactify the parking lot every interval seconds. """
+
+        self.schedule_every(interval, self._controller.compactify_parking_lot, start_time)
+
+    def add_sampling(self, interval, start_time=None, outstanding_revenue=False):
+        """ Record a sample every interval seconds. A sample is a dict with:
+            'time': the virtual time of the sample.
+            'occupied': the number of parked cars.
+            'occupied_by_lot_group': list of the number of parked cars, parallel to the lot groups.
+            'parked', 'rejected', 'returned', 'collected_revenue': as in get_stats(), so far.
+        with outstanding_revenue the sample also has 'outstanding_revenue', the cost of all open tickets. that
+        takes a pass over every open ticket, so it is off by default. """
+
+        self.schedule_every(interval, lambda: self._take_sample(outstanding_revenue), start_time)
+
+    def _take_sample(self, outstanding_revenue):
+        occupied_by_lot_group = [lot_group.get_car_count() for lot_group in self._controller._lot_groups]
+
+        sample = self.get_stats()
+        sample['time'] = self._clock.get_exact_time()
+        sample['occupied'] = sum(occupied_by_lot_group)
+        sample['occupied_by_lot_group'] = occupied_by_lot_group
+        if outstanding_revenue:
+            sample['outstanding_revenue'] = self._controller.get_outstanding_revenue()['total']
+
+        self._samples.append(sample)